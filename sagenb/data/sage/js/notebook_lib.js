@@ -119,6 +119,12 @@ var update_error_threshold = 30;
 var update_error_delta = 1024;
 var update_normal_delta = update_falloff_deltas[0];
 var cell_output_delta = update_normal_delta;
+// The server's output generation seen in the last update, and how
+// long (in seconds) the server may wait for new output before it
+// answers an update request.
+var update_generation = -1;
+var update_long_poll_timeout = 20;
+var update_request_number = 0;
 
 // Introspection data.
 var introspect = {};
@@ -3401,14 +3407,17 @@ function cell_set_done(id) {
 function check_for_cell_update() {
     /*
     Ask the server if there is any new output that should be placed in
-    an output cell.
+    the output cells of the queued cells.  The server holds the
+    request until the worksheet process produces output (for at most
+    update_long_poll_timeout seconds, unless it is busy) and answers
+    for all queued cells at once.
 
     OUTPUT:
         * if the queued cell list is empty, cancel update checking.
         * makes an async request
         * causes the title bar compute spinner to spin
     */
-    var cell_id, busy_text, num_queued;
+    var busy_text, num_queued, request_number;
 
     // Cancel update checks if no cells are doing computations.
     if (queue_id_list.length === 0) {
@@ -3419,12 +3428,18 @@ function check_for_cell_update() {
     // Record in a global variable when the last update occurred.
     update_time = time_now();
 
-    // Check on the "lead" cell currently computing to see what's up.
-    cell_id = queue_id_list[0];
-
-    async_request(worksheet_command('cell_update'),
-                  check_for_cell_update_callback, { 
-                      id: cell_id 
+    // Only the answer to the latest request continues the checks.
+    update_request_number += 1;
+    request_number = update_request_number;
+
+    async_request(worksheet_command('cell_updates'),
+                  function (status, response) {
+                      check_for_cell_update_callback(status, response,
+                          request_number === update_request_number);
+                  }, {
+                      ids: encode_response(queue_id_list),
+                      generation: update_generation,
+                      timeout: update_long_poll_timeout
                   });
 
     // Spin the little title spinner in the title bar.
@@ -3440,7 +3455,7 @@ function check_for_cell_update() {
 }
 
 
-function check_for_cell_update_callback(status, response) {
+function check_for_cell_update_callback(status, response, latest) {
     /*
     Updates cell data from the server
 
@@ -3448,20 +3463,33 @@ function check_for_cell_update_callback(status, response) {
         status -- string
         response -- string; encoded JSON object with parsed keys
 
-            id -- string or integer; queried cell's id
-            status -- string; 'e' (empty queue), 'd' (done with
-                      queried cell), or 'w' (still working)
-            output -- string; cell's latest output text
-            output_wrapped -- string; word-wrapped output
-            output_html -- string; HTML output
-            new_input -- string; updated input (e.g., from tab
-                         completion)
-            interrupted -- string; 'restart', 'false', or 'true',
-                           whether/how the cell's computation was 
-                           interrupted
-            introspect_html -- string; updated introspection text
-    */
-    var elapsed_time, eval_hook, msg, X;
+            generation -- integer; the worksheet's output generation,
+                          to send with the next request
+            long_poll -- boolean; false if the server did not wait for
+                         output, so we should wait before asking again
+            status -- string; 'e' if the server's queue is empty
+            cells -- list of objects with keys
+
+                id -- string or integer; queried cell's id
+                status -- string; 'd' (done with queried cell), or 'w'
+                          (still working)
+                output -- string; cell's latest output text
+                output_wrapped -- string; word-wrapped output
+                output_html -- string; HTML output
+                new_input -- string; updated input (e.g., from tab
+                             completion)
+                interrupted -- string; 'restart', 'false', or 'true',
+                               whether/how the cell's computation was
+                               interrupted
+                introspect_html -- string; updated introspection text
+
+        latest -- boolean; whether this answers the latest request
+    */
+    var elapsed_time, msg, X, i, halted = false;
+
+    if (!latest) {
+        return;
+    }
 
     // Make sure the update happens again in a few hundred
     // milliseconds, unless a problem occurs below.
@@ -3478,6 +3506,7 @@ function check_for_cell_update_callback(status, response) {
         }
         cell_output_delta = update_error_delta;
         update_error_count += 1;
+        update_generation = -1;
         continue_update_check();
         return;
     } else {
@@ -3497,50 +3526,86 @@ function check_for_cell_update_callback(status, response) {
     }
 
     X = decode_response(response);
+    update_generation = X.generation;
+
+    if (X.long_poll) {
+        // The server waits for output, so we can ask again right away.
+        update_count = 0;
+        update_falloff_level = 0;
+        cell_output_delta = update_normal_delta;
+    } else if (update_count > update_falloff_threshold &&
+               update_falloff_level + 1 < update_falloff_deltas.length) {
+        update_falloff_level += 1;
+        update_count = 0;
+        cell_output_delta = update_falloff_deltas[update_falloff_level];
+    } else {
+        update_count += 1;
+    }
+
+    for (i = 0; i < X.cells.length; i += 1) {
+        if (update_cell_from_server(X.cells[i])) {
+            halted = true;
+        }
+    }
 
     if (X.status === 'e') {
+        // The server is not computing anything for us.
         cancel_update_check();
         halt_queued_cells();
         return;
     }
 
+    if (!halted && updating) {
+        continue_update_check();
+    }
+}
+
+
+function update_cell_from_server(X) {
+    /*
+    Update a cell with the data sent by the server in answer to a
+    cell_updates request.
+
+    INPUT:
+        X -- object; see check_for_cell_update_callback
+
+    OUTPUT:
+        boolean; whether update checking was cancelled
+    */
+    var eval_hook;
+
     // Evaluate and update the cell's output.
     eval_hook = set_output_text(X.id, X.status, X.output, X.output_wrapped,
                                 X.output_html, X.introspect_html, false);
 
     if (X.status === 'd') {
         cell_set_done(X.id);
-        queue_id_list.splice($.inArray(X.id, queue_id_list), 1);
+        if ($.inArray(X.id, queue_id_list) !== -1) {
+            queue_id_list.splice($.inArray(X.id, queue_id_list), 1);
+        }
+
+        if (X.new_input !== '') {
+            set_input_text(X.id, X.new_input);
+        }
 
         if (X.interrupted === 'restart') {
             restart_sage();
+            return true;
         } else if (X.interrupted === 'false') {
             cell_set_evaluated(X.id);
         } else {
             cancel_update_check();
             halt_queued_cells();
+            return true;
         }
 
         if (queue_id_list.length === 0) {
             cancel_update_check();
         }
 
-        if (X.new_input !== '') {
-            set_input_text(X.id, X.new_input);
-        }
-
         update_count = 0;
         update_falloff_level = 0;
         cell_output_delta = update_falloff_deltas[0];
-    } else {
-        if (update_count > update_falloff_threshold &&
-            update_falloff_level + 1 < update_falloff_deltas.length) {
-            update_falloff_level += 1;
-            update_count = 0;
-            cell_output_delta = update_falloff_deltas[update_falloff_level];
-        } else {
-            update_count += 1;
-        }
     }
 
     if (eval_hook === 'trigger_interact') {
@@ -3548,8 +3613,7 @@ function check_for_cell_update_callback(status, response) {
     } else if (eval_hook === 'restart_interact') {
         evaluate_cell(X.id, 0);
     }
-
-    continue_update_check();
+    return false;
 }
 
 
@@ -3587,6 +3651,8 @@ function start_update_check() {
     updating = true;
     update_count = 0;
     update_falloff_level = 0;
+    // Do not let the server wait for output on the first check.
+    update_generation = -1;
 
     // The starting value for how long we wait between checks for new
     // updates.
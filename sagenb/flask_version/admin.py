@@ -120,3 +120,28 @@ def notebook_settings():
     return render_template(os.path.join('html', 'settings', 'notebook_settings.html'),
                            **template_dict)
 
+
+@admin.route('/serverpool')
+@admin_required
+def server_pool():
+    from sagenb.misc.misc import SAGE_VERSION, walltime
+    scheduler = g.notebook.server_scheduler()
+    pool = g.notebook.server_pool() or []
+    hosts = [h for h in scheduler.stats() if h['host'] in pool]
+    now = walltime()
+    for h in hosts:
+        if h['checked'] is not None:
+            h['checked'] = int(now - h['checked'])
+
+    template_dict = {}
+    template_dict['sage_version'] = SAGE_VERSION
+    template_dict['hosts'] = hosts
+    template_dict['unknown'] = [host for host in pool
+                                if host not in [h['host'] for h in hosts]]
+    template_dict['policy'] = scheduler.policy()
+    template_dict['placed'] = scheduler.placed()
+    template_dict['admin'] = g.notebook.user_manager().user(g.username).is_admin()
+    template_dict['username'] = g.username
+
+    return render_template(os.path.join('html', 'settings', 'server_pool.html'),
+                           **template_dict)
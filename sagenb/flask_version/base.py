@@ -5,8 +5,7 @@ import time
 import re
 from functools import partial
 from flask import Flask, Module, url_for, request, session, redirect, g, make_response, current_app, render_template
-from .decorators import login_required, guest_or_login_required, with_lock
-from .decorators import global_lock
+from .decorators import login_required, guest_or_login_required, with_read_lock
 # Make flask use the old session foo from <=flask-0.9
 from flask_oldsessions import OldSecureCookieSessionInterface
 
@@ -16,6 +15,7 @@ SRC = os.path.join(SAGE_SRC, 'sage')
 from flask.ext.openid import OpenID
 from flask.ext.babel import Babel, gettext, ngettext, lazy_gettext, get_locale
 from sagenb.misc.misc import SAGENB_ROOT, DATA, translations_path, N_, nN_, unicode_str
+from sagenb.misc.locking import TimedLock
 from json import dumps
 from sagenb.notebook.cell import number_of_rows
 from sagenb.notebook.template import (css_escape, clean_name,
@@ -249,7 +249,7 @@ def loginoid():
     #render_template('html/login.html', next=oid.get_next_url(), error=oid.fetch_error())
 
 @oid.after_login
-@with_lock
+@with_read_lock
 def create_or_login(resp):
     if not g.notebook.conf()['openid']:
         return redirect(url_for('base.index'))
@@ -351,6 +351,9 @@ def set_profiles():
 # Notebook autosave.
 ############################
 # save if make a change to notebook and at least some seconds have elapsed since last save.
+save_lock = TimedLock('save')
+idle_lock = TimedLock('idle_check')
+
 def init_updates():
     global save_interval, idle_interval, last_save_time, last_idle_time
     from sagenb.misc.misc import walltime
@@ -365,15 +368,17 @@ def notebook_save_check():
     from sagenb.misc.misc import walltime
 
     t = walltime()
-    if t > last_save_time + save_interval:
-        with global_lock:
+    # Only one thread saves at a time; the others do not wait for it,
+    # since the notebook is being saved anyway.
+    if t > last_save_time + save_interval and save_lock.acquire(False):
+        try:
             # if someone got the lock before we did, they might have saved,
             # so we check against the last_save_time again
-            # we don't put the global_lock around the outer loop since we don't need
-            # it unless we are actually thinking about saving.
             if t > last_save_time + save_interval:
-                notebook.save()
+                notebook.save(background=True)
                 last_save_time = t
+        finally:
+            save_lock.release()
 
 def notebook_idle_check():
     global last_idle_time
@@ -381,16 +386,18 @@ def notebook_idle_check():
 
     t = walltime()
 
-    if t > last_idle_time + idle_interval:
-        with global_lock:
+    if t > last_idle_time + idle_interval and idle_lock.acquire(False):
+        try:
             # if someone got the lock before we did, they might have already idled,
             # so we check against the last_idle_time again
-            # we don't put the global_lock around the outer loop since we don't need
-            # it unless we are actually thinking about quitting worksheets
             if t > last_idle_time + idle_interval:
+                # Idle worksheet processes are quit by the notebook's
+                # idle reaper thread.
                 notebook.update_worksheet_processes()
-                notebook.quit_idle_worksheet_processes()
+                notebook.evict_idle_worksheets()
                 last_idle_time = t
+        finally:
+            idle_lock.release()
 
 def notebook_updates():
     notebook_save_check()
@@ -415,6 +422,9 @@ def create_app(path_to_notebook, *args, **kwds):
     notebook.MATHJAX = True
     notebook = notebook.load_notebook(path_to_notebook, *args, **kwds)
     init_updates()
+    notebook.start_process_pool()
+    notebook.start_idle_reaper()
+    notebook.start_server_scheduler()
 
     ##############
     # Create app #
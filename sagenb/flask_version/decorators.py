@@ -3,9 +3,6 @@ from flask import Flask, url_for, render_template, request, session, redirect, g
 from flask.ext.babel import Babel, gettext, ngettext, lazy_gettext
 _ = gettext
 
-from threading import Lock
-global_lock = Lock()
-
 def login_required(f):
     @wraps(f)
     def wrapper(*args, **kwds):
@@ -43,8 +40,21 @@ def guest_or_login_required(f):
     return wrapper
 
 def with_lock(f):
+    """
+    Hold the user manager's lock for writing while ``f`` runs.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        with g.notebook.user_manager().lock().write():
+            return f(*args, **kwds)
+    return wrapper
+
+def with_read_lock(f):
+    """
+    Hold the user manager's lock for reading while ``f`` runs.
+    """
     @wraps(f)
     def wrapper(*args, **kwds):
-        with global_lock:
+        with g.notebook.user_manager().lock().read():
             return f(*args, **kwds)
     return wrapper
@@ -1,12 +1,13 @@
 from __future__ import absolute_import
 import re
 import os
-import threading
+import json
 import collections
-from functools import wraps
+import threading
+import time
+from functools import wraps, partial
 from flask import Module, make_response, url_for, render_template, request, session, redirect, g, current_app
 from .decorators import login_required, with_lock
-from collections import defaultdict
 from werkzeug.utils import secure_filename
 from flask.ext.babel import Babel, gettext, ngettext, lazy_gettext
 _ = gettext
@@ -15,13 +16,15 @@ from sagenb.notebook.interact import INTERACT_UPDATE_PREFIX
 from sagenb.notebook.misc import encode_response
 
 ws = Module('sagenb.flask_version.worksheet')
-worksheet_locks = defaultdict(threading.Lock)
 
-def worksheet_view(f):
+def worksheet_view(f, lock=True):
     """
     The `username` in the wrapper function is the username in the URL to the worksheet, which normally
     is the owner of the worksheet.  Don't confuse this with `g.username`, the actual username of the
     user looking at the worksheet.
+
+    If `lock` is False, the view is called without holding the worksheet's lock, e.g., because it
+    waits for output; the view must take the lock itself while it uses the worksheet.
     """
     @login_required
     @wraps(f)
@@ -32,7 +35,7 @@ def worksheet_view(f):
         except KeyError:
             return current_app.message(_("You do not have permission to access this worksheet"), username=g.username)
 
-        with worksheet_locks[worksheet]:
+        with (worksheet.lock() if lock else _no_lock):
             owner = worksheet.owner()
 
             if owner != '_sage_' and g.username != owner:
@@ -52,6 +55,15 @@ def worksheet_view(f):
 
     return wrapper
 
+class _NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+_no_lock = _NoLock()
+
 def url_for_worksheet(worksheet):
     """
     Returns the url for a given worksheet.
@@ -98,7 +110,7 @@ def worksheet(username, id, worksheet=None):
                         username=g.username)
     return s
 
-published_commands_allowed = set(['alive', 'cells', 'cell_update',
+published_commands_allowed = set(['alive', 'cells', 'cell_update', 'cell_updates',
                           'data', 'download', 'edit_published_page', 'eval',
                           'quit_sage', 'rate', 'rating_info', 'new_cell_before',
                           'new_cell_after', 'introspect', 'delete_all_output',
@@ -106,13 +118,21 @@ published_commands_allowed = set(['alive', 'cells', 'cell_update',
 
 readonly_commands_allowed = set(['alive', 'cells', 'data', 'datafile', 'download', 'quit_sage', 'rating_info', 'delete_all_output', 'jsmol'])
 
-def worksheet_command(target, **route_kwds):
+# Commands that do not change the worksheet; all others mark it as
+# changed, so that the next save writes it.
+unchanging_commands = set(['alive', 'cells', 'cell_list', 'cell_update',
+                           'cell_updates', 'conf',
+                           'data', 'datafile', 'download', 'edit', 'jsmol',
+                           'print', 'rating_info', 'revisions', 'share', 'text',
+                           'upload_data'])
+
+def worksheet_command(target, lock=True, **route_kwds):
     if 'methods' not in route_kwds:
         route_kwds['methods'] = ['GET', 'POST']
 
     def decorator(f):
         @ws.route('/home/<username>/<id>/' + target, **route_kwds)
-        @worksheet_view
+        @partial(worksheet_view, lock=lock)
         @wraps(f)
         def wrapper(*args, **kwds):
             #We remove the first two arguments corresponding to the
@@ -136,6 +156,8 @@ def worksheet_command(target, **route_kwds):
             worksheet = kwds.pop('worksheet', None)
             if worksheet is not None:
                 args = (worksheet,) + args
+                if target.split('/')[0] not in unchanging_commands:
+                    worksheet.mark_dirty()
 
             return f(*args, **kwds)
 
@@ -448,15 +470,104 @@ def worksheet_eval(worksheet):
 
 @worksheet_command('cell_update')
 def worksheet_cell_update(worksheet):
-    import time
-
-    r = {}
-    r['id'] = id = get_cell_id()
-
     # update the computation one "step".
     worksheet.check_comp()
 
     # now get latest status on our cell
+    r = cell_update(worksheet, get_cell_id())
+
+    # Compute 'em, if we got 'em.
+    worksheet.start_next_comp()
+
+    return encode_response(r)
+
+# The longest time (in seconds) a cell_updates request waits for output.
+CELL_UPDATES_MAX_TIMEOUT = 30
+
+# How many cell_updates requests may wait for output at the same time.
+# A waiting request holds a thread of the web server, so the scripts
+# made by sagenb.notebook.run_notebook add this many threads to the
+# thread pool of the server, or set it to 0 if the server cannot spare
+# a thread (e.g., tornado, which runs the app in its only thread).
+# When all are taken, cell_updates answers right away and the browser
+# falls back to polling.
+CELL_UPDATES_MAX_WAITING = 8
+
+class _WaitingRequests(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def acquire(self):
+        """
+        Return True and count one more waiting request, unless there
+        are already CELL_UPDATES_MAX_WAITING of them.
+        """
+        with self._lock:
+            if self._count >= CELL_UPDATES_MAX_WAITING:
+                return False
+            self._count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._count -= 1
+
+_waiting_requests = _WaitingRequests()
+
+@worksheet_command('cell_updates', lock=False)
+def worksheet_cell_updates(worksheet):
+    """
+    Return the status and output of several cells at once, as a
+    list of dictionaries like those returned by cell_update, in
+    'cells'.  The cell IDs are given as a JSON list in 'ids'.  The
+    'status' is that of the computation queue, 'e' if it is empty.
+
+    If 'generation' is the worksheet's output generation returned by
+    the previous request, i.e., nothing happened since then, wait up
+    to 'timeout' seconds for the worksheet's process to print
+    something before answering.  The worksheet is not locked while
+    waiting.  If too many requests are waiting already, answer right
+    away with 'long_poll' false, so that the browser waits before it
+    asks again.
+    """
+    ids = []
+    for id in json.loads(request.values.get('ids', '[]')):
+        try:
+            ids.append(int(id))
+        except ValueError:
+            ids.append(id)
+    generation = int(request.values.get('generation', -1))
+    timeout = min(float(request.values.get('timeout', 0)), CELL_UPDATES_MAX_TIMEOUT)
+
+    long_poll = True
+    if timeout > 0 and worksheet.computing() and worksheet.output_generation() == generation:
+        long_poll = _waiting_requests.acquire()
+        if long_poll:
+            try:
+                worksheet.wait_for_output(generation, timeout)
+            finally:
+                _waiting_requests.release()
+
+    with worksheet.lock():
+        # Read this before collecting output, so that output arriving
+        # in the meantime makes the next request answer right away.
+        r = {'generation': worksheet.output_generation(), 'long_poll': long_poll}
+        status, C = worksheet.check_comp()
+        r['status'] = status
+        r['cells'] = [cell_update(worksheet, id) for id in ids]
+        worksheet.start_next_comp()
+
+    return encode_response(r)
+
+def cell_update(worksheet, id):
+    """
+    Return a dictionary with the status and output of the cell with
+    the given id, as sent to the browser.
+    """
+    r = {}
+    r['id'] = id
+
     r['status'], cell = worksheet.check_cell(id)
 
     if r['status'] == 'd':
@@ -488,11 +599,7 @@ def worksheet_cell_update(worksheet):
     r['output_wrapped'] = cell.output_text(g.notebook.conf()['word_wrap_cols'],
                                            html=True) + ' '
     r['introspect_html'] = cell.introspect_html()
-
-    # Compute 'em, if we got 'em.
-    worksheet.start_next_comp()
-
-    return encode_response(r)
+    return r
 
 
 ########################################################
@@ -625,17 +732,14 @@ def worksheet_revisions(worksheet):
         rev = request.values['rev']
         action = request.values['action']
         if action == 'revert':
-            import bz2
+            txt = worksheet.snapshot_text(rev)
             worksheet.save_snapshot(g.username)
-            #XXX: Requires access to filesystem
-            txt = bz2.decompress(open(worksheet.get_snapshot_text_filename(rev)).read())
             worksheet.delete_cells_directory()
             worksheet.edit_save(txt)
             return redirect(url_for_worksheet(worksheet))
         elif action == 'publish':
-            import bz2
             W = g.notebook.publish_worksheet(worksheet, g.username)
-            txt = bz2.decompress(open(worksheet.get_snapshot_text_filename(rev)).read())
+            txt = worksheet.snapshot_text(rev)
             W.delete_cells_directory()
             W.edit_save(txt)
             return redirect(url_for_worksheet(W))
@@ -941,21 +1045,18 @@ def worksheet_download(worksheet, title):
     return unconditional_download(worksheet, title)
 
 def unconditional_download(worksheet, title):
-    from sagenb.misc.misc import tmp_filename
-    from flask.helpers import send_file
-    filename = tmp_filename() + '.sws'
+    from flask import Response
 
     if title.endswith('.sws'):
         title = title[:-4]
 
     try:
-        #XXX: Accessing the hard disk.
-        g.notebook.export_worksheet(worksheet.filename(), filename, title)
+        # The sws file is produced while it is sent.
+        sws = g.notebook.export_worksheet_stream(worksheet.filename(), title)
     except KeyError:
         return current_app.message(_('No such worksheet.'))
 
-    from flask.helpers import send_file
-    return send_file(filename, mimetype='application/sage')
+    return Response(sws, mimetype='application/sage')
 
 
 @worksheet_command('restart_sage')
@@ -1008,12 +1109,17 @@ def worksheet_print(worksheet):
 doc_worksheet_number = -1
 def doc_worksheet():
     global doc_worksheet_number
-    doc_worksheet_number = doc_worksheet_number % g.notebook.conf()['doc_pool_size']
+    # Take the next worksheet of the pool that is not computing,
+    # looking it up by name instead of listing all '_sage_' worksheets.
+    pool_size = g.notebook.conf()['doc_pool_size']
     W = None
-    for X in g.notebook.users_worksheets('_sage_'):
-        if X.compute_process_has_been_started():
-            continue
-        if X.id_number() == doc_worksheet_number:
+    for i in range(pool_size):
+        doc_worksheet_number = (doc_worksheet_number + 1) % pool_size
+        try:
+            X = g.notebook.get_worksheet_with_filename('_sage_/%s' % doc_worksheet_number)
+        except KeyError:
+            break
+        if not X.compute_process_has_been_started():
             W = X
             W.clear()
             break
@@ -1024,39 +1130,31 @@ def doc_worksheet():
         W = g.notebook.create_new_worksheet('', '_sage_')
     return W
 
-def extract_title(html_page):
-    #XXX: This might be better as a regex
-    h = html_page.lower()
-    i = h.find('<title>')
-    if i == -1:
-        return gettext("Untitled")
-    j = h.find('</title>')
-    return html_page[i + len('<title>') : j]
-
 @login_required
 def worksheet_file(path):
     # Create a live Sage worksheet from the given path.
     if not os.path.exists(path):
         return current_app.message(_('Document does not exist.'), username=g.username)
 
-    doc_page_html = open(path).read()
-    from sagenb.notebook.docHTMLProcessor import SphinxHTMLProcessor
-    doc_page = SphinxHTMLProcessor().process_doc_html(doc_page_html)
-
-    title = (extract_title(doc_page_html).replace('&mdash;', '--') or
-             'Live Sage Documentation')
+    # The processed page comes from the cache unless the file changed.
+    from sagenb.notebook.doc_cache import doc_page_cache
+    title, doc_page = doc_page_cache().get(path)
+    title = title or _('Live Sage Documentation')
 
     W = doc_worksheet()
     W.edit_save(doc_page)
     W.set_system('sage')
     W.set_name(title)
-    W.save()
     W.quit()
 
     # FIXME: For some reason, an extra cell gets added so we
     # remove it here.
     W.cell_list().pop()
 
+    # The pool worksheet is only a view of the page, so there is no
+    # need to save it (or for the background writer to do so).
+    W.mark_saved(W.dirty_number())
+
     return g.notebook.html(worksheet_filename=W.filename(),
                            username=g.username)
 
@@ -6,10 +6,63 @@ import urllib, urlparse
 from flask import Module, url_for, render_template, request, session, redirect, g, current_app
 from .decorators import login_required, guest_or_login_required, with_lock
 from flask.ext.babel import Babel, gettext, ngettext, lazy_gettext
+from sagenb.notebook.misc import encode_response
 _ = gettext
 
 worksheet_listing = Module('sagenb.flask_version.worksheet_listing')
 
+# Default number of worksheets on a page of a worksheet listing.
+PAGE_SIZE = 100
+
+def worksheet_list_page(args, pub, username):
+    """
+    Returns one page of a worksheet listing.
+
+    INPUT:
+
+    -  ``args`` - the request arguments: ``typ``, ``search``,
+       ``sort``, ``reverse``, ``page`` and ``limit`` (the number of
+       worksheets per page)
+
+    -  ``pub`` - boolean, True if this is a listing of
+       public worksheets
+
+    -  ``username`` - the user whose worksheets we are
+       listing
+
+    OUTPUT:
+
+    a dictionary with the worksheets on the page and the parsed
+    arguments; raises a ValueError if the sort key is not valid
+    """
+    from sagenb.misc.misc import unicode_str
+
+    typ = args['typ'] if 'typ' in args else 'active'
+    search = unicode_str(args['search']) if 'search' in args else None
+    sort = args['sort'] if 'sort' in args else 'last_edited'
+    reverse = (args['reverse'] == 'True') if 'reverse' in args else False
+    try:
+        page = max(1, int(args.get('page', 1)))
+        limit = max(1, min(PAGE_SIZE, int(args.get('limit', PAGE_SIZE))))
+    except ValueError:
+        page, limit = 1, PAGE_SIZE
+    if not pub:
+        count = g.notebook.worksheet_count_for_user(username, typ=typ, search=search)
+    else:
+        count = g.notebook.public_worksheet_count(search=search)
+    pages = max(1, (count + limit - 1) // limit)
+    page = min(page, pages)
+    if not pub:
+        worksheets = g.notebook.worksheet_list_for_user(username, typ=typ, sort=sort,
+                                                          search=search, reverse=reverse,
+                                                          offset=(page - 1) * limit, limit=limit)
+    else:
+        worksheets = g.notebook.worksheet_list_for_public(username, sort=sort,
+                                                            search=search, reverse=reverse,
+                                                            offset=(page - 1) * limit, limit=limit)
+    return dict(worksheets=worksheets, typ=typ, search=search, sort=sort,
+                reverse=reverse, page=page, pages=pages, count=count)
+
 def render_worksheet_list(args, pub, username):
     """
     Returns a rendered worksheet listing.
@@ -29,27 +82,17 @@ def render_worksheet_list(args, pub, username):
 
     a string
     """
+    from sagenb.misc.misc import SAGE_VERSION
 
-    from sagenb.notebook.notebook import sort_worksheet_list
-    from sagenb.misc.misc import unicode_str, SAGE_VERSION
-
-    typ = args['typ'] if 'typ' in args else 'active'
-    search = unicode_str(args['search']) if 'search' in args else None
-    sort = args['sort'] if 'sort' in args else 'last_edited'
-    reverse = (args['reverse'] == 'True') if 'reverse' in args else False
     readonly = g.notebook.readonly_user(g.username)
     try:
-        if not pub:
-            worksheets = g.notebook.worksheet_list_for_user(username, typ=typ, sort=sort,
-                                                              search=search, reverse=reverse)
-        else:
-            worksheets = g.notebook.worksheet_list_for_public(username, sort=sort,
-                                                                search=search, reverse=reverse)
+        listing = worksheet_list_page(args, pub, username)
     except ValueError as E:
         # for example, the sort key was not valid
         print("Error displaying worksheet listing: {}".format(E))
         return current_app.message(_("Error displaying worksheet listing."))
 
+    worksheets = listing['worksheets']
     worksheet_filenames = [x.filename() for x in worksheets]
 
     if pub and (not username or username == tuple([])):
@@ -57,7 +100,30 @@ def render_worksheet_list(args, pub, username):
 
     accounts = g.notebook.user_manager().get_accounts()
     sage_version = SAGE_VERSION
-    return render_template('html/worksheet_listing.html', **locals())
+    return render_template('html/worksheet_listing.html', readonly=readonly,
+                           worksheet_filenames=worksheet_filenames, pub=pub,
+                           username=username, accounts=accounts,
+                           sage_version=sage_version, **listing)
+
+def worksheet_list_json(args, pub, username):
+    """
+    Returns one page of a worksheet listing as JSON; the arguments
+    are as for :func:`render_worksheet_list`.
+    """
+    try:
+        listing = worksheet_list_page(args, pub, username)
+    except ValueError as E:
+        return encode_response({'error': str(E)}), 400
+    listing['worksheets'] = [{'filename': W.filename(),
+                              'name': W.name(),
+                              'owner': W.owner(),
+                              'last_edited': W.last_edited(),
+                              'last_edited_by': W.last_to_edit(),
+                              'rating': W.rating(),
+                              'running': W.compute_process_has_been_started()}
+                             for W in listing['worksheets']]
+    return current_app.response_class(encode_response(listing),
+                                      mimetype='application/json')
 
 @worksheet_listing.route('/home/<username>/')
 @login_required
@@ -67,6 +133,13 @@ def home(username):
     else:
         return render_worksheet_list(request.args, pub=False, username=username)
 
+@worksheet_listing.route('/home/<username>/worksheets.json')
+@login_required
+def home_json(username):
+    if not g.notebook.user_manager().user_is_admin(g.username) and username != g.username:
+        return encode_response({'error': 'permission denied'}), 403
+    return worksheet_list_json(request.args, pub=False, username=username)
+
 @worksheet_listing.route('/home/')
 @login_required
 def bare_home():
@@ -144,6 +217,11 @@ def empty_trash():
 def pub():
     return render_worksheet_list(request.args, pub=True, username=g.username)
 
+@worksheet_listing.route('/pub/worksheets.json')
+@guest_or_login_required
+def pub_json():
+    return worksheet_list_json(request.args, pub=True, username=g.username)
+
 @worksheet_listing.route('/home/pub/<id>/')
 @guest_or_login_required
 def public_worksheet(id):
@@ -210,16 +288,14 @@ def download_worksheets():
     import zipfile
     zip = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_STORED)
     for worksheet in worksheets:
-        sws_filename = tmp_filename() + '.sws'
-        g.notebook.export_worksheet(worksheet.filename(), sws_filename)
+        sws = ''.join(g.notebook.export_worksheet_stream(worksheet.filename()))
         entry_name = worksheet.name()
         if entry_name in worksheet_names:
             i = 2
             while ("%s_%s" % (entry_name, i)) in worksheet_names:
                 i += 1
             entry_name = "%s_%s" % (entry_name, i)
-        zip.write(sws_filename, entry_name + ".sws")
-        os.unlink(sws_filename)
+        zip.writestr(entry_name + ".sws", sws)
     zip.close()
     r = open(zip_filename, 'rb').read()
     os.unlink(zip_filename)
@@ -344,6 +420,7 @@ def upload_worksheet():
 
     url = request.values['url'].strip()
     dir = ''
+    fileobj = None
     if url != '':
         #Downloading a file from the internet
         # The file will be downloaded from the internet and saved
@@ -381,7 +458,11 @@ def upload_worksheet():
             return current_app.message(_("Invalid filename.\n%(backlinks)s",backlinks=backlinks), username=g.username)
 
         filename = os.path.join(dir, filename)
-        file.save(filename)
+        if filename.lower().endswith('.sws'):
+            # Worksheets are imported straight from the upload.
+            fileobj = file.stream
+        else:
+            file.save(filename)
 
     new_name = request.values.get('name', None)
 
@@ -419,14 +500,16 @@ def upload_worksheet():
                             print('Importing {0}, linked to from {1}'.format(linked_sws[0]['url'], url))
                         except RetrieveError as err:
                             return current_app.message(str(err), username=g.username)
-                W = g.notebook.import_worksheet(filename, g.username)
+                W = g.notebook.import_worksheet(filename, g.username,
+                                                fileobj=fileobj)
         except Exception as msg:
             print('error uploading worksheet {}'.format(msg))
             s = _('There was an error uploading the worksheet.  It could be an old unsupported format or worse.  If you desperately need its contents contact the <a href="http://groups.google.com/group/sage-support">sage-support group</a> and post a link to your worksheet.  Alternatively, an sws file is just a bzip2 tarball; take a look inside!\n%(backlinks)s', backlinks=backlinks)
             return current_app.message(s, url_for('home', username=g.username), username=g.username)
         finally:
             # Clean up the temporarily uploaded filename.
-            os.unlink(filename)
+            if os.path.exists(filename):
+                os.unlink(filename)
             # if a temp directory was created, we delete it now.
             if dir:
                 import shutil
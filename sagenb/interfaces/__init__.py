@@ -18,3 +18,7 @@ from .expect import (WorksheetProcess_ExpectImplementation,
                     WorksheetProcess_RemoteExpectImplementation)
 
 from .limits import ProcessLimits
+
+from .pool import WorksheetProcessPool
+
+from .scheduler import ServerScheduler
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*
+r"""
+Talking to expect worksheet processes
+
+Every computation in a
+:class:`~sagenb.interfaces.expect.WorksheetProcess_ExpectImplementation`
+used to create a temporary directory, symlink the data directory of
+the worksheet into it, write the code to a file ``_sage_input_N.py``
+there and type ``os.chdir(...); execfile(...)`` into the interactive
+Python prompt of the subprocess.  The code printed ``START<N>`` and
+set the prompt, and the output was whatever the subprocess printed
+between ``START<N>`` and the next prompt.
+
+Instead, once the subprocess is started, the lines returned by
+:func:`install_lines` are typed into it, which run :func:`sagenb.interfaces.channel_server.serve`
+in place of the interactive prompt.  From then on, every computation
+is one line, made by :func:`frame`: the number of the computation and
+the base64 encoded code.  Other nonempty lines are executed as Python
+code.  The computations run in the directory of the worksheet process,
+which is created once per subprocess.
+
+The subprocess answers with messages (see
+:mod:`sagenb.interfaces.channel_server`), each of which starts with
+``MAGIC`` and a header line giving its type, the number of the
+computation and the length of its payload.  A :class:`MessageReader`
+collects the output, the files and the completion status of one
+computation from them as they arrive; it never looks at the output
+itself, so the output may contain anything.
+
+Control-C still interrupts the computation, since the terminal still
+generates signals, and base64 never contains it.
+
+EXAMPLES::
+
+    sage: from sagenb.interfaces.channel import frame
+    sage: frame('2+3', 4)
+    '4 Misz\n'
+"""
+import base64
+import inspect
+import zlib
+
+from . import channel_server
+from .channel_server import MAGIC, message
+
+
+# Longest line typed into the interactive prompt.  A terminal in
+# canonical mode drops the characters of a line beyond the 4095th.
+LINE_LENGTH = 2000
+
+# Number of bytes at the end of the raw output kept for error reports.
+RAW_TAIL = 65536
+
+
+def install_lines(directory):
+    """
+    Return the list of lines to type into the interactive prompt of a
+    new subprocess, so that it runs the computations sent with
+    :func:`frame` in ``directory``.  Executing the last line does not
+    return until the subprocess exits.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.channel import install_lines, LINE_LENGTH
+        sage: max([len(line) for line in install_lines(tmp_dir())]) <= LINE_LENGTH
+        True
+    """
+    code = inspect.getsource(channel_server) + '\nserve(%r)\n' % directory
+    code = base64.b64encode(zlib.compress(code, 9))
+    n = LINE_LENGTH - 30
+    lines = ["_sagenb_channel_ = ''"]
+    lines += ["_sagenb_channel_ += '%s'" % code[i:i + n] for i in range(0, len(code), n)]
+    lines.append("exec(__import__('zlib').decompress(__import__('base64').b64decode("
+                 "globals().pop('_sagenb_channel_'))), {'__name__': '_sagenb_channel_'})")
+    return lines
+
+
+def frame(code, number):
+    """
+    Return the line to send to a subprocess in which
+    :func:`install_lines` was run, to execute the string ``code`` as
+    computation number ``number``.
+    """
+    return '%s %s\n' % (number, base64.b64encode(code))
+
+
+class MessageReader(object):
+    def __init__(self, number):
+        """
+        Collect the messages about computation number ``number`` from
+        the output of a subprocess.
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces.channel import MessageReader
+            sage: from sagenb.interfaces.channel_server import message
+            sage: R = MessageReader(2)
+            sage: data = ('junk' + message('o', 1, 'old') + message('o', 2, '5\\n') +
+            ....:         message('h', 2, '<b>x</b>') + message('f', 2, 'a.png\\nb.png') +
+            ....:         message('d', 2, 'ok'))
+            sage: R.feed(data[:20]); R.feed(data[20:35])
+            sage: R.output(), R.done()
+            ('', False)
+            sage: R.feed(data[35:])
+            sage: R.output(), R.files(), R.status(), R.done()
+            ('5\\n<html><b>x</b></html>', ['a.png', 'b.png'], 'ok', True)
+        """
+        self._number = str(number)
+        # what was fed but not parsed yet
+        self._buffer = ''
+        self._raw = bytearray()
+        self._output = bytearray()
+        self._files = []
+        self._status = None
+
+    def __repr__(self):
+        return "Message reader (%s bytes of output, done=%s)" % (len(self._output), self.done())
+
+    def feed(self, data):
+        """
+        Add ``data``, which is the next piece of output of the
+        subprocess, and handle the messages completed by it.
+
+        Only the headers of the messages are scanned.  Anything
+        between messages (e.g., what the subprocess printed before
+        :func:`install_lines` were run) is ignored.
+
+        INPUT:
+
+        - ``data`` -- a string
+        """
+        self._raw.extend(data)
+        if len(self._raw) > RAW_TAIL:
+            del self._raw[:-RAW_TAIL]
+        buf = self._buffer + data
+        while buf:
+            i = buf.find(MAGIC)
+            if i == -1:
+                # keep what may be the start of MAGIC
+                j = buf.rfind(MAGIC[0], max(0, len(buf) - len(MAGIC) + 1))
+                if j == -1 or not MAGIC.startswith(buf[j:]):
+                    j = len(buf)
+                buf = buf[j:]
+                break
+            j = buf.find('\n', i)
+            if j == -1:
+                buf = buf[i:]
+                break
+            try:
+                kind, number, length = buf[i + len(MAGIC):j].split(' ')
+                end = j + 1 + int(length)
+            except ValueError:
+                # not a message after all
+                buf = buf[i + 1:]
+                continue
+            if len(buf) < end:
+                buf = buf[i:]
+                break
+            if number == self._number:
+                self._handle(kind, buf[j + 1:end])
+            buf = buf[end:]
+        self._buffer = buf
+
+    def _handle(self, kind, payload):
+        if self._status is not None:
+            return
+        if kind == 'o':
+            self._output.extend(payload)
+        elif kind == 'h':
+            self._output.extend('<html>%s</html>' % payload)
+        elif kind == 'f':
+            self._files = payload.split('\n') if payload else []
+        elif kind == 'd':
+            self._status = payload
+
+    def done(self):
+        """
+        Return True if the computation is done.
+        """
+        return self._status is not None
+
+    def status(self):
+        """
+        Return None if the computation is not done, ``'ok'`` if it
+        finished and ``'error'`` if it raised an exception.
+        """
+        return self._status
+
+    def output(self):
+        """
+        Return the output of the computation so far.
+
+        OUTPUT:
+
+        - a string
+        """
+        return str(self._output)
+
+    def files(self):
+        """
+        Return the list of the names of the files in the directory of
+        the computation, as last reported by the subprocess.
+        """
+        return self._files
+
+    def raw(self):
+        """
+        Return the last ``RAW_TAIL`` bytes fed to this reader (for
+        error reports; everything else is in :meth:`output`).
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces.channel import MessageReader, RAW_TAIL
+            sage: R = MessageReader(1)
+            sage: R.feed('abc'); R.feed('def')
+            sage: R.raw()
+            'abcdef'
+            sage: R.feed('x' * RAW_TAIL)
+            sage: len(R.raw()) == RAW_TAIL, R.raw()[:1]
+            (True, 'x')
+        """
+        return str(self._raw)
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*
+"""
+The worksheet process end of :mod:`sagenb.interfaces.channel`
+
+The notebook server does not run this module.  Its source is sent to
+every expect worksheet process when it starts (see
+:func:`~sagenb.interfaces.channel.install_lines`), which then calls
+:func:`serve`.  So it must not import anything from sagenb.
+
+:func:`serve` turns off echo, line editing and output processing of
+the terminal of the process, points file descriptors 1 and 2 to a
+pipe and then reads one computation per line from the terminal (see
+:func:`~sagenb.interfaces.channel.frame`) and runs it.  A thread reads
+what the computation writes to the pipe and sends it to the terminal
+as messages made by :func:`message`:
+
+- ``o`` -- output of the computation
+
+- ``h`` -- HTML, sent by ``_sagenb_html_(s)`` from the computation
+
+- ``f`` -- the names of the files in the directory of the
+  computations, one per line; sent whenever they change while a
+  computation runs (checked every ``FILES_INTERVAL`` seconds and when
+  there is output), and when it is done
+
+- ``d`` -- the computation is done; the payload is ``ok`` or
+  ``error`` (if it raised an exception)
+
+To keep the output and the other messages in order, the main thread
+sends the latter through the pipe too, prefixed by a random token that
+the output of the computation cannot contain by accident.
+"""
+import base64
+import linecache
+import os
+import select
+import sys
+import termios
+import threading
+import traceback
+
+# Start of every message.
+MAGIC = '\x00sagenb:'
+
+# How often (in seconds) to look for new files while a computation runs.
+FILES_INTERVAL = 1
+
+# Maximum number of bytes read from the pipe at once.
+READ_SIZE = 65536
+
+
+def message(kind, number, payload):
+    """
+    Return the message of type ``kind`` (a letter) about computation
+    number ``number`` carrying the string ``payload``.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.channel_server import message
+        sage: message('o', 3, '5\\n')
+        '\\x00sagenb:o 3 2\\n5\\n'
+    """
+    return '%s%s %s %s\n%s' % (MAGIC, kind, number, len(payload), payload)
+
+
+def _write(fd, data):
+    while data:
+        try:
+            data = data[os.write(fd, data):]
+        except OSError:
+            # interrupted by a signal
+            pass
+
+
+class Server(object):
+    def __init__(self, directory):
+        """
+        INPUT:
+
+        - ``directory`` -- string; the directory the computations run in
+        """
+        self._directory = directory
+        self._main = sys.modules['__main__'].__dict__
+        self._token = '\x00' + base64.b16encode(os.urandom(16))
+        self._names = []
+        # state of the forwarding thread
+        self._number = 0
+        self._running = False
+        self._files = None
+
+    def _setup_terminal(self):
+        try:
+            mode = termios.tcgetattr(0)
+            mode[1] &= ~termios.OPOST
+            mode[3] &= ~(termios.ICANON | termios.ECHO)
+            mode[6][termios.VMIN] = 1
+            mode[6][termios.VTIME] = 0
+            termios.tcsetattr(0, termios.TCSANOW, mode)
+        except termios.error:
+            pass
+
+    def _capture_output(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._terminal = os.dup(1)
+        r, w = os.pipe()
+        os.dup2(w, 1)
+        os.dup2(w, 2)
+        os.close(w)
+        T = threading.Thread(target=self._forward, args=(r,))
+        T.daemon = True
+        T.start()
+
+    ###########################################################
+    # The forwarding thread
+    ###########################################################
+    def _send(self, kind, payload):
+        _write(self._terminal, message(kind, self._number, payload))
+
+    def _send_files(self, force=False):
+        if not self._running:
+            return
+        try:
+            files = '\n'.join(sorted(os.listdir(self._directory)))
+        except OSError:
+            files = ''
+        if force or files != self._files:
+            self._files = files
+            self._send('f', files)
+
+    def _control(self, kind, payload):
+        if kind == 'b':
+            self._number = payload
+            self._running = True
+            self._files = None
+        elif kind == 'h':
+            self._send('h', payload)
+        elif kind == 'd':
+            self._send_files(force=True)
+            self._send('d', payload)
+            self._running = False
+
+    def _process(self, buf):
+        """
+        Send the output and the control records in ``buf`` and return
+        what is left for later (an incomplete control record, or the
+        start of one).
+        """
+        token = self._token
+        while buf:
+            i = buf.find(token)
+            if i == -1:
+                # keep what may be the start of a token
+                j = buf.rfind('\x00', max(0, len(buf) - len(token) + 1))
+                if j == -1 or not token.startswith(buf[j:]):
+                    j = len(buf)
+                if j:
+                    self._send('o', buf[:j])
+                return buf[j:]
+            if i:
+                self._send('o', buf[:i])
+                buf = buf[i:]
+            j = buf.find('\n')
+            if j == -1:
+                return buf
+            kind, length = buf[len(token):j].split(' ')
+            end = j + 1 + int(length)
+            if len(buf) < end:
+                return buf
+            self._control(kind, buf[j + 1:end])
+            buf = buf[end:]
+        return buf
+
+    def _forward(self, r):
+        buf = ''
+        while True:
+            try:
+                ready = select.select([r], [], [], FILES_INTERVAL)[0]
+            except select.error:
+                continue
+            if ready:
+                try:
+                    data = os.read(r, READ_SIZE)
+                except OSError:
+                    continue
+                if not data:
+                    return
+                buf = self._process(buf + data)
+            self._send_files()
+
+    ###########################################################
+    # The main thread
+    ###########################################################
+    def control(self, kind, payload):
+        """
+        Send the control record ``kind`` with string ``payload`` to
+        the forwarding thread, after the output so far.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _write(1, '%s%s %s\n%s' % (self._token, kind, len(payload), payload))
+
+    def html(self, s):
+        """
+        Send the HTML ``s`` to the notebook.
+        """
+        if not isinstance(s, str):
+            s = s.encode('utf-8')
+        self.control('h', s)
+
+    def execute(self, number, code):
+        """
+        Run the string ``code`` as computation number ``number``
+        (None for a line of Python that is not a computation).
+
+        The code is registered with :mod:`linecache` as
+        ``_sage_input_N.py``, so that tracebacks show it.
+        """
+        for name in self._names:
+            linecache.cache.pop(name, None)
+        if number is None:
+            name = '<stdin>'
+        else:
+            name = '_sage_input_%s.py' % number
+            self._names = [name]
+            linecache.cache[name] = (len(code), None, code.splitlines(True), name)
+            self.control('b', str(number))
+        status = 'ok'
+        try:
+            os.chdir(self._directory)
+            try:
+                exec(compile(code, name, 'exec', 0, True), self._main)
+            except SystemExit:
+                raise
+            except BaseException:
+                status = 'error'
+                t, v, tb = sys.exc_info()
+                sys.last_type, sys.last_value, sys.last_traceback = t, v, tb
+                # Leave out this frame, but not the heading that the
+                # notebook looks for (e.g., for a syntax error).
+                if tb.tb_next is None:
+                    sys.stderr.write('Traceback (most recent call last):\n')
+                traceback.print_exception(t, v, tb.tb_next)
+        finally:
+            if number is not None:
+                self.control('d', status)
+
+    def run(self):
+        """
+        Run the computations read from the terminal, until it is
+        closed.
+        """
+        self._setup_terminal()
+        self._capture_output()
+        # Cells expect os to be imported, as it was when they were run
+        # with os.chdir(...); execfile(...).
+        self._main['os'] = os
+        self._main['_sagenb_html_'] = self.html
+        buf = ''
+        while True:
+            try:
+                while '\n' not in buf:
+                    try:
+                        data = os.read(0, READ_SIZE)
+                    except OSError:
+                        continue
+                    if not data:
+                        return
+                    buf += data
+                line, buf = buf.split('\n', 1)
+                number, _, code = line.strip().partition(' ')
+                if number.isdigit():
+                    self.execute(int(number), base64.b64decode(code))
+                elif line.strip():
+                    self.execute(None, line + '\n')
+            except KeyboardInterrupt:
+                # between two computations
+                pass
+
+
+def serve(directory):
+    """
+    Run the computations sent by the notebook server in
+    ``directory``; see :class:`Server`.
+    """
+    Server(directory).run()
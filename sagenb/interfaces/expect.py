@@ -2,16 +2,24 @@
 import os
 import tempfile
 import shutil
+import threading
 import pexpect
 
 from .status import OutputStatus
-from sagenb.misc.format import format_for_pexpect
+from .channel import install_lines, frame, MessageReader
+from sagenb.misc.format import format_for_channel
 from .worksheet_process import WorksheetProcess
 from sagenb.misc.misc import (walltime,
                               set_restrictive_permissions,
                               set_permissive_permissions)
 
 
+# Maximum number of bytes the reader thread reads from the pty at
+# once, and how long (in seconds) it blocks waiting for output before
+# checking whether the process it is reading from was quit.
+READ_SIZE = 65536
+READ_TIMEOUT = 1
+
 ###################################################################
 # Expect-based implementation
 ###################################################################
@@ -23,11 +31,16 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
 
     - ``process_limits`` -- None or a ProcessLimits objects as defined by
       the ``sagenb.interfaces.ProcessLimits`` object.
+
+    - ``pool`` -- None or a
+      :class:`~sagenb.interfaces.pool.WorksheetProcessPool` from which
+      a pre-started subprocess is claimed when this process starts.
     """
     def __init__(self,
                  process_limits=None,
                  timeout=0.05,
-                 python='python'):
+                 python='python',
+                 pool=None):
         """
         Initialize this worksheet process.
         """
@@ -36,14 +49,28 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
         self._is_started = False
         self._is_computing = False
         self._timeout = timeout
-        self._prompt = "__SAGE__"
-        self._filename = ''
+        self._tempdir = None
+        self._data = ''
         self._all_tempdirs = []
         self._process_limits = process_limits
         self._max_walltime = None
         self._start_walltime = None
         self._data_dir = None
         self._python = python
+        self._pool = pool
+
+        # Output of the subprocess is drained by a reader thread (see
+        # _reader) into self._chunks; output_status() feeds it to
+        # self._parser, which picks the messages about the current
+        # computation.
+        self._output_lock = threading.Lock()
+        # Notified whenever self._generation changes, i.e., when new
+        # output arrives or the subprocess goes away.
+        self._output_cond = threading.Condition(self._output_lock)
+        self._generation = 0
+        self._chunks = []
+        self._parser = MessageReader(0)
+        self._eof = False
 
         if process_limits:
             u = ''
@@ -71,6 +98,15 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
         # is available before even doing this.
         return '&&'.join([x for x in [self._ulimit, self._python] if x])
 
+    def pool_key(self):
+        """
+        Return the key of the bucket of the process pool that
+        subprocesses for this worksheet process are taken from.  Two
+        worksheet processes with the same key run interchangeable
+        subprocesses.
+        """
+        return (self.command(), self._ulimit)
+
     def __del__(self):
         try:
             self._cleanup_tempfiles()
@@ -130,24 +166,102 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
             os.kill(self._expect.pid, 9)
         except OSError:
             pass
-        self._expect = None
+        with self._output_lock:
+            self._expect = None
+            self._new_generation()
         self._is_started = False
         self._is_computing = False
         self._start_walltime = None
+        self._tempdir = None
+        self._data = ''
         self._cleanup_tempfiles()
         self._cleanup_data_dir()
 
     def start(self):
         """
         Start this worksheet process running.
+
+        If this process has a pool, a pre-started subprocess is taken
+        from it; otherwise, or if the pool has none left, a new one is
+        spawned.  The computations of the subprocess all run in one
+        temporary directory, and their code is sent over the pty (see
+        :mod:`sagenb.interfaces.channel`).
         """
-        self._expect = pexpect.spawn(self.command())
+        E = None
+        if self._pool is not None:
+            E = self._pool.claim(self.pool_key(), self.command())
+        if E is None:
+            E = pexpect.spawn(self.command())
+        self._expect = E
         self._is_started = True
         self._is_computing = False
         self._number = 0
-        self._read()
+        self._eof = False
+        reader = threading.Thread(target=self._reader, args=(self._expect,))
+        reader.daemon = True
+        reader.start()
+        # Give the process a chance to crash right away, e.g., if the
+        # command does not exist.
+        reader.join(self._timeout)
+        self._check_for_eof()
+        if self._expect is None:
+            return
+        local, remote = self.get_tmpdir()
+        self._tempdir = local
+        self._data = ''
+        self._all_tempdirs.append(local)
+        try:
+            for line in install_lines(remote):
+                self._expect.sendline(line)
+        except OSError as msg:
+            print("error sending input to subprocess: %s" % msg)
         self._start_walltime = walltime()
 
+    def _reader(self, E):
+        """
+        Continuously read the output of the pexpect process ``E`` into
+        ``self._chunks``, until the process exits or this worksheet
+        process stops using it (e.g., because it was quit).
+
+        This runs in its own thread, so that asking for the output
+        never has to wait for the subprocess.
+        """
+        while True:
+            try:
+                data = E.read_nonblocking(READ_SIZE, READ_TIMEOUT)
+            except pexpect.TIMEOUT:
+                if self._expect is not E:
+                    return
+                continue
+            except Exception:
+                # EOF, or the pty was closed: the subprocess is gone.
+                with self._output_lock:
+                    if self._expect is E:
+                        self._eof = True
+                        self._new_generation()
+                return
+            with self._output_lock:
+                if self._expect is not E:
+                    return
+                self._chunks.append(data)
+                self._new_generation()
+
+    def _new_generation(self):
+        # call with self._output_lock held
+        self._generation += 1
+        self._output_cond.notify_all()
+
+    def _check_for_eof(self):
+        """
+        If the reader thread saw the subprocess exit, clean up.
+        """
+        if self._eof and self._expect is not None:
+            # got EOF subprocess must have crashed; cleanup
+            print("got EOF subprocess must have crashed...")
+            with self._output_lock:
+                print(self._parser.raw() + ''.join(self._chunks))
+            self.quit()
+
     def update(self):
         """
         This should be called periodically by the server processes.
@@ -168,6 +282,28 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
     ###########################################################
     # Query the state of the subprocess
     ###########################################################
+    def output_generation(self):
+        """
+        Return a number that changes whenever the subprocess produces
+        output, exits or is quit.
+        """
+        return self._generation
+
+    def wait_for_output(self, generation, timeout):
+        """
+        Wait at most ``timeout`` seconds until
+        :meth:`output_generation` is different from ``generation``,
+        and return it.  This is woken up by the reader thread.
+        """
+        deadline = walltime() + timeout
+        with self._output_cond:
+            while self._generation == generation:
+                remaining = deadline - walltime()
+                if remaining <= 0:
+                    break
+                self._output_cond.wait(remaining)
+            return self._generation
+
     def is_computing(self):
         """
         Return True if a computation is currently running in this
@@ -231,44 +367,50 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
 
         self._number += 1
 
-        local, remote = self.get_tmpdir()
-
-        if data is not None:
-            # make a symbolic link from the data directory into local
+        # Files left over by the previous computation (e.g., one whose
+        # output was not wanted) would be taken for output of this one.
+        for X in os.listdir(self._tempdir):
+            if X != self._data:
+                X = os.path.join(self._tempdir, X)
+                if os.path.isdir(X) and not os.path.islink(X):
+                    shutil.rmtree(X, ignore_errors=True)
+                else:
+                    try:
+                        os.unlink(X)
+                    except OSError:
+                        pass
+
+        if data is not None and (not self._data or data != self._data_dir):
+            # make a symbolic link from the data directory into the
             # tmp directory
+            if self._data:
+                os.unlink(os.path.join(self._tempdir, self._data))
             self._data = os.path.split(data)[1]
             self._data_dir = data
             set_permissive_permissions(data)
-            os.symlink(data, os.path.join(local, self._data))
-        else:
-            self._data = ''
+            os.symlink(data, os.path.join(self._tempdir, self._data))
 
-        self._tempdir = local
-        sage_input = '_sage_input_%s.py' % self._number
-        self._filename = os.path.join(self._tempdir, sage_input)
-        self._so_far = ''
+        with self._output_lock:
+            self._chunks = []
+            self._parser = MessageReader(self._number)
         self._is_computing = True
 
-        self._all_tempdirs.append(self._tempdir)
-        open(self._filename, 'w').write(format_for_pexpect(string, self._prompt,
-                                                           self._number))
         try:
-            txt = '\nimport os;os.chdir("%s");\nexecfile("%s")' % (remote,
-                                                                   sage_input)
-            self._expect.sendline(txt)
+            self._expect.send(frame(format_for_channel(string), self._number))
         except OSError as msg:
             self._is_computing = False
-            self._so_far = str(msg)
+            print("error sending input to subprocess: %s" % msg)
 
     def _read(self):
-        try:
-            self._expect.expect(pexpect.EOF, self._timeout)
-            # got EOF subprocess must have crashed; cleanup
-            print("got EOF subprocess must have crashed...")
-            print(self._expect.before)
-            self.quit()
-        except:
-            pass
+        """
+        Feed the output collected by the reader thread so far to the
+        output parser.  This never blocks on the subprocess.
+        """
+        with self._output_lock:
+            for data in self._chunks:
+                self._parser.feed(data)
+            self._chunks = []
+        self._check_for_eof()
 
     ###########################################################
     # Getting the output so far from a subprocess
@@ -287,30 +429,17 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
         self._read()
         if self._expect is None:
             self._is_computing = False
-        else:
-            self._so_far = self._expect.before
 
-        import re
-        v = re.findall('START%s.*%s' % (self._number, self._prompt),
-                       self._so_far, re.DOTALL)
-        if len(v):
+        if self._parser.done():
             self._is_computing = False
-            s = v[0][len('START%s' % self._number):-len(self._prompt)]
-        else:
-            v = re.findall('START%s.*' % self._number, self._so_far, re.DOTALL)
-            if len(v) > 0:
-                s = v[0][len('START%s' % self._number):]
-            else:
-                s = ''
-
-        if s.endswith(self._prompt):
-            s = s[:-len(self._prompt)]
+        s = self._parser.output()
 
+        # The subprocess tells which files there are; they are in
+        # self._tempdir on this machine.
         files = []
-        if os.path.exists(self._tempdir):
+        if self._tempdir is not None:
             files = [os.path.join(self._tempdir, x)
-                     for x in os.listdir(self._tempdir) if x != self._data]
-            files = [x for x in files if x != self._filename]
+                     for x in self._parser.files() if x != self._data]
 
         return OutputStatus(s, files, not self._is_computing)
 
@@ -364,9 +493,11 @@ class WorksheetProcess_RemoteExpectImplementation(WorksheetProcess_ExpectImpleme
                  local_directory=None,
                  remote_directory=None,
                  process_limits=None,
-                 timeout=0.05):
+                 timeout=0.05,
+                 pool=None):
         WorksheetProcess_ExpectImplementation.__init__(self, process_limits,
-                                                       timeout=timeout)
+                                                       timeout=timeout,
+                                                       pool=pool)
         self._user_at_host = user_at_host
 
         if local_directory is None:
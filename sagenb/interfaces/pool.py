@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*
+"""
+A pool of pre-started worksheet processes
+
+Starting Sage takes several seconds, which used to be spent the first
+time each worksheet evaluated a cell.  A :class:`WorksheetProcessPool`
+keeps a few idle subprocesses running for every command that worksheet
+processes have been started with (the command includes the remote
+host and the ulimit options, so every combination of host and
+:class:`~sagenb.interfaces.limits.ProcessLimits` gets its own bucket).
+:meth:`WorksheetProcess_ExpectImplementation.start` claims one of
+these if there is one, and a background thread starts new ones to
+replace those that were claimed or got too old.
+
+AUTHORS:
+
+  - The Sage notebook developers
+"""
+import os
+import threading
+
+import pexpect
+
+from sagenb.misc.misc import walltime
+
+# How often (in seconds) the background thread checks the pool if
+# nothing wakes it up earlier.
+REPLENISH_INTERVAL = 60
+
+
+class WorksheetProcessPool(object):
+    def __init__(self, size=0, max_age=3600, warmup=None):
+        """
+        INPUT:
+
+        - ``size`` -- integer (default: 0); number of idle processes
+          to keep for each command.  If 0, no process is pre-started.
+
+        - ``max_age`` -- number (default: 3600); idle processes that
+          were started more than this many seconds ago are killed
+          instead of being handed out; 0 means no maximum age
+
+        - ``warmup`` -- string or None (default); a line of code sent
+          to each new process, e.g., to import the Sage library
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces import WorksheetProcessPool
+            sage: WorksheetProcessPool(2)
+            Pool of pre-started worksheet processes (size 2, 0 idle)
+        """
+        self._size = size
+        self._max_age = max_age
+        self._warmup = warmup
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # key -> command, for every bucket ever asked for
+        self._commands = {}
+        # key -> list of pairs (walltime when started, pexpect process)
+        self._idle = {}
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._thread = None
+        self._stopped = False
+
+    def __repr__(self):
+        return "Pool of pre-started worksheet processes (size %s, %s idle)" % (
+            self._size, sum([len(v) for v in self._idle.values()]))
+
+    def configure(self, size, max_age):
+        """
+        Change the number of idle processes kept per command and their
+        maximum age.
+        """
+        if size != self._size or max_age != self._max_age:
+            self._size = size
+            self._max_age = max_age
+            self._wakeup.set()
+
+    def register(self, key, command):
+        """
+        Make sure the pool keeps idle processes for the given command.
+
+        INPUT:
+
+        - ``key`` -- a hashable object identifying the bucket
+
+        - ``command`` -- string; the command to spawn
+        """
+        with self._lock:
+            self._commands[key] = command
+        self._wakeup.set()
+
+    def claim(self, key, command):
+        """
+        Return an idle pre-started pexpect process for the given
+        command, or None if there is none, in which case the caller
+        should start one itself.
+
+        The command is registered, so that from now on the pool also
+        keeps idle processes for it.
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces import WorksheetProcessPool
+            sage: P = WorksheetProcessPool(0)
+            sage: P.claim('python', 'python') is None
+            True
+            sage: P.stats()['misses']
+            1
+        """
+        E = None
+        discard = []
+        with self._lock:
+            self._commands[key] = command
+            idle = self._idle.get(key, [])
+            while idle:
+                started, X = idle.pop()
+                if self._fresh(started, X):
+                    E = X
+                    break
+                discard.append(X)
+                self._expired += 1
+            if E is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        for X in discard:
+            self._kill(X)
+        self._wakeup.set()
+        return E
+
+    def stats(self):
+        """
+        Return a dictionary with the pool hits, misses, expired
+        processes and the number of idle processes.
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces import WorksheetProcessPool
+            sage: sorted(WorksheetProcessPool(0).stats().items())
+            [('expired', 0), ('hits', 0), ('idle', 0), ('max_age', 3600), ('misses', 0), ('size', 0)]
+        """
+        with self._lock:
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'expired': self._expired,
+                    'idle': sum([len(v) for v in self._idle.values()]),
+                    'size': self._size,
+                    'max_age': self._max_age}
+
+    def _fresh(self, started, E):
+        if self._max_age and walltime() - started >= self._max_age:
+            return False
+        return E.isalive()
+
+    def _spawn(self, command):
+        E = pexpect.spawn(command)
+        if self._warmup:
+            E.sendline(self._warmup)
+        return E
+
+    def _kill(self, E):
+        try:
+            os.killpg(E.pid, 9)
+        except OSError:
+            pass
+        try:
+            os.kill(E.pid, 9)
+        except OSError:
+            pass
+
+    def replenish(self):
+        """
+        Kill idle processes that are too old and start new ones until
+        there are ``size`` idle processes for every registered
+        command.  This is called by the background thread, but may
+        also be called directly.
+        """
+        discard = []
+        needed = []
+        with self._lock:
+            for key, command in self._commands.items():
+                idle = self._idle.setdefault(key, [])
+                fresh = [(t, X) for t, X in idle if self._fresh(t, X)]
+                discard.extend([X for t, X in idle if (t, X) not in fresh])
+                self._expired += len(idle) - len(fresh)
+                idle[:] = fresh
+                # too many idle processes if the size was decreased
+                while len(idle) > self._size:
+                    discard.append(idle.pop(0)[1])
+                needed.extend([(key, command)] * (self._size - len(idle)))
+        for X in discard:
+            self._kill(X)
+        for key, command in needed:
+            if self._stopped:
+                return
+            try:
+                E = self._spawn(command)
+            except Exception as msg:
+                print("Error pre-starting worksheet process '%s': %s" % (command, msg))
+                return
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self._size:
+                    idle.append((walltime(), E))
+                    E = None
+            if E is not None:
+                self._kill(E)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(REPLENISH_INTERVAL)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            try:
+                self.replenish()
+            except Exception as msg:
+                print("Error replenishing worksheet process pool: %s" % msg)
+
+    def start(self):
+        """
+        Start the background thread that keeps the pool filled.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stop the background thread and kill all idle processes.
+        """
+        self._stopped = True
+        self._wakeup.set()
+        with self._lock:
+            idle = [X for v in self._idle.values() for t, X in v]
+            self._idle = {}
+        for X in idle:
+            self._kill(X)
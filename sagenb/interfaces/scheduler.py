@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*
+"""
+Placing worksheet processes on the hosts of the server pool
+
+If the notebook server is configured with a pool of remote compute
+servers (``server_pool``, a list of ``user@host`` strings), every new
+worksheet process runs on one of them.  A :class:`ServerScheduler`
+chooses the host.  It keeps track of
+
+- the worksheet processes it placed on every host that were not quit
+  yet,
+
+- the load average, the number of CPUs and the fraction of memory in
+  use on every host, as reported by a health check that a background
+  thread runs over ssh every ``check_interval`` seconds, and
+
+- the number of health checks in a row that failed.
+
+A host whose last ``max_failures`` health checks failed is not used
+until a health check succeeds again.  Among the other hosts, the
+*policy* chooses one.  A policy is a function that gets the list of
+dictionaries returned by :meth:`ServerScheduler.stats` for the
+healthy hosts and returns one of their ``host`` entries; new policies
+can be added with :func:`register_policy`.  The following are
+predefined:
+
+- ``least_loaded`` -- the host with the smallest :func:`load_score`
+
+- ``round_robin`` -- the hosts in turn
+
+- ``random`` -- a random host
+
+AUTHORS:
+
+  - The Sage notebook developers
+"""
+import itertools
+import random
+import subprocess
+import threading
+import weakref
+
+from sagenb.misc.misc import walltime
+
+# How often (in seconds) the background thread checks the hosts.
+CHECK_INTERVAL = 60
+
+# Seconds to wait for a health check to answer.
+CHECK_TIMEOUT = 10
+
+# Number of failed health checks in a row after which a host is not
+# used any more.
+MAX_FAILURES = 3
+
+# Hosts with more than this fraction of memory in use are only used
+# if all hosts are.
+MEMORY_LIMIT = 0.95
+
+# The command run on every host by the health check.
+PROBE_COMMAND = 'cat /proc/loadavg /proc/meminfo; getconf _NPROCESSORS_ONLN'
+
+
+def parse_probe(output):
+    """
+    Return a dictionary with the load average (``load``), the number
+    of CPUs (``cpus``) and the fraction of memory in use (``memory``)
+    from the output of ``PROBE_COMMAND``.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.scheduler import parse_probe
+        sage: out = '0.50 0.40 0.30 1/100 1234\\nMemTotal: 1000 kB\\nMemAvailable: 250 kB\\n4\\n'
+        sage: sorted(parse_probe(out).items())
+        [('cpus', 4), ('load', 0.5), ('memory', 0.75)]
+    """
+    lines = output.strip().splitlines()
+    load = float(lines[0].split()[0])
+    try:
+        cpus = max(1, int(lines[-1].strip()))
+    except ValueError:
+        cpus = 1
+    mem = {}
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].endswith(':'):
+            try:
+                mem[fields[0][:-1]] = int(fields[1])
+            except ValueError:
+                pass
+    total = mem.get('MemTotal')
+    if not total:
+        memory = None
+    else:
+        if 'MemAvailable' in mem:
+            available = mem['MemAvailable']
+        else:
+            # kernels older than 3.14
+            available = sum([mem.get(k, 0) for k in ('MemFree', 'Buffers', 'Cached')])
+        memory = max(0.0, min(1.0, 1 - float(available) / total))
+    return {'load': load, 'cpus': cpus, 'memory': memory}
+
+
+def ssh_probe(user_at_host, timeout=CHECK_TIMEOUT):
+    """
+    Run ``PROBE_COMMAND`` on the given host over ssh and return the
+    result of :func:`parse_probe`.  Raise a RuntimeError if ssh fails
+    or does not finish within ``timeout`` seconds.
+    """
+    P = subprocess.Popen(['ssh', '-o', 'BatchMode=yes',
+                          '-o', 'ConnectTimeout=%d' % timeout,
+                          user_at_host, PROBE_COMMAND],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, close_fds=True)
+    timer = threading.Timer(timeout, P.kill)
+    timer.start()
+    try:
+        out, err = P.communicate()
+    finally:
+        timer.cancel()
+    if P.returncode != 0:
+        raise RuntimeError(err.strip() or "ssh exited with status %s" % P.returncode)
+    return parse_probe(out)
+
+
+def load_score(host):
+    """
+    Return a number measuring how busy the host described by the
+    dictionary ``host`` (see :meth:`ServerScheduler.stats`) is: the
+    number of worksheet processes and the load average, both per CPU,
+    plus the fraction of memory in use.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.scheduler import load_score
+        sage: load_score({'processes': 4, 'load': 2.0, 'cpus': 4, 'memory': 0.5})
+        2.0
+        sage: load_score({'processes': 1, 'load': None, 'cpus': None, 'memory': None})
+        1.0
+    """
+    cpus = host['cpus'] or 1
+    score = float(host['processes']) / cpus
+    if host['load'] is not None:
+        score += host['load'] / cpus
+    if host['memory'] is not None:
+        score += host['memory']
+    return score
+
+
+def least_loaded(hosts):
+    """
+    Return the host with the smallest :func:`load_score`, avoiding
+    hosts that are short of memory.  Ties are broken at random.
+    """
+    ok = [h for h in hosts if h['memory'] is None or h['memory'] <= MEMORY_LIMIT]
+    return min(ok or hosts, key=lambda h: (load_score(h), random.random()))['host']
+
+
+_turn = itertools.count()
+
+def round_robin(hosts):
+    """
+    Return the hosts in turn.
+    """
+    return hosts[next(_turn) % len(hosts)]['host']
+
+
+def random_host(hosts):
+    """
+    Return a random host.
+    """
+    return random.choice(hosts)['host']
+
+
+POLICIES = {'least_loaded': least_loaded,
+            'round_robin': round_robin,
+            'random': random_host}
+
+def register_policy(name, policy):
+    """
+    Make the function ``policy`` available as a scheduling policy
+    called ``name``; see :mod:`sagenb.interfaces.scheduler`.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.scheduler import ServerScheduler, register_policy
+        sage: register_policy('first', lambda hosts: hosts[0]['host'])
+        sage: ServerScheduler('first').choose(['a@x', 'b@y'])
+        'a@x'
+    """
+    POLICIES[name] = policy
+
+
+class ServerScheduler(object):
+    def __init__(self, policy='least_loaded', check_interval=CHECK_INTERVAL,
+                 max_failures=MAX_FAILURES, probe=ssh_probe):
+        """
+        INPUT:
+
+        - ``policy`` -- string (default: 'least_loaded'); the name of
+          a policy in ``POLICIES``
+
+        - ``check_interval`` -- number (default: 60); seconds between
+          health checks; 0 means no health checks
+
+        - ``max_failures`` -- integer (default: 3); number of failed
+          health checks in a row after which a host is not used
+
+        - ``probe`` -- function (default: :func:`ssh_probe`); called
+          with a host, returns a dictionary like :func:`parse_probe`
+          or raises an exception
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces import ServerScheduler
+            sage: S = ServerScheduler(probe=lambda h: {'load': 0.0, 'cpus': 2, 'memory': 0.1})
+            sage: S
+            Server scheduler (least_loaded, 0 hosts)
+            sage: S.check(['a@x', 'b@y'])
+            sage: P = sagenb.interfaces.WorksheetProcess_ReferenceImplementation()
+            sage: S.assign('a@x', P)
+            sage: S.choose(['a@x', 'b@y'])
+            'b@y'
+        """
+        self._policy = policy
+        self._check_interval = check_interval
+        self._max_failures = max_failures
+        self._probe = probe
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # host -> dictionary with the last health check results
+        self._hosts = {}
+        # host -> weak set of the processes placed there
+        self._processes = {}
+        self._placed = 0
+        self._thread = None
+        self._stopped = False
+
+    def __repr__(self):
+        return "Server scheduler (%s, %s hosts)" % (self._policy, len(self._hosts))
+
+    def configure(self, policy, check_interval):
+        """
+        Change the policy and the interval between health checks.
+        """
+        if policy != self._policy or check_interval != self._check_interval:
+            self._policy = policy
+            self._check_interval = check_interval
+            self._wakeup.set()
+
+    def _host(self, host):
+        try:
+            return self._hosts[host]
+        except KeyError:
+            self._processes[host] = weakref.WeakSet()
+            h = self._hosts[host] = {'host': host, 'load': None, 'cpus': None,
+                                     'memory': None, 'failures': 0,
+                                     'checked': None, 'error': None}
+            return h
+
+    def _stats(self, host):
+        h = dict(self._hosts[host])
+        h['processes'] = len(self._processes[host])
+        h['healthy'] = h['failures'] < self._max_failures
+        return h
+
+    def choose(self, hosts):
+        """
+        Return the host among ``hosts`` on which the next worksheet
+        process should run, or None if ``hosts`` is empty.  If no host
+        is healthy, they are all considered.
+        """
+        if not hosts:
+            return None
+        with self._lock:
+            for host in hosts:
+                self._host(host)
+            stats = [self._stats(host) for host in hosts]
+        healthy = [h for h in stats if h['healthy']]
+        try:
+            policy = POLICIES[self._policy]
+        except KeyError:
+            print("Unknown server pool policy %r; using least_loaded" % self._policy)
+            policy = least_loaded
+        return policy(healthy or stats)
+
+    def assign(self, host, process):
+        """
+        Record that the worksheet process ``process`` runs on ``host``
+        (until :meth:`release` is called or the process is garbage
+        collected).
+        """
+        with self._lock:
+            self._host(host)
+            self._processes[host].add(process)
+            self._placed += 1
+
+    def release(self, process):
+        """
+        Record that the worksheet process ``process`` was quit.
+        """
+        with self._lock:
+            for processes in self._processes.values():
+                processes.discard(process)
+
+    def _check(self, host):
+        try:
+            result = self._probe(host)
+        except Exception as msg:
+            with self._lock:
+                h = self._host(host)
+                h['failures'] += 1
+                h['error'] = str(msg)
+                h['checked'] = walltime()
+                if h['failures'] == self._max_failures:
+                    print("Server pool host %s failed %s health checks: %s" % (
+                        host, h['failures'], msg))
+            return
+        with self._lock:
+            h = self._host(host)
+            h.update(result)
+            h['failures'] = 0
+            h['error'] = None
+            h['checked'] = walltime()
+
+    def check(self, hosts=None):
+        """
+        Run the health check on the given hosts (default: all hosts
+        known to this scheduler) in parallel and wait for them.
+        """
+        if hosts is None:
+            with self._lock:
+                hosts = list(self._hosts)
+        threads = []
+        for host in hosts:
+            T = threading.Thread(target=self._check, args=(host,))
+            T.daemon = True
+            T.start()
+            threads.append(T)
+        for T in threads:
+            T.join(CHECK_TIMEOUT + 5)
+
+    def stats(self):
+        """
+        Return a list of dictionaries, one per host, sorted by host,
+        with the entries
+
+        - ``host`` -- the host, as ``user@host``
+        - ``processes`` -- number of worksheet processes placed there
+        - ``load``, ``cpus``, ``memory`` -- as in :func:`parse_probe`
+          for the last successful health check, None if there was none
+        - ``failures`` -- number of failed health checks in a row
+        - ``error`` -- the error of the last health check, if it failed
+        - ``checked`` -- walltime of the last health check, or None
+        - ``healthy`` -- whether the host is used
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces import ServerScheduler
+            sage: S = ServerScheduler(probe=lambda h: 1/0)
+            sage: S.check(['a@x'])
+            sage: [(h['host'], h['failures'], h['healthy']) for h in S.stats()]
+            [('a@x', 1, True)]
+        """
+        with self._lock:
+            return [self._stats(host) for host in sorted(self._hosts)]
+
+    def policy(self):
+        """
+        Return the name of the scheduling policy.
+        """
+        return self._policy
+
+    def placed(self):
+        """
+        Return the number of worksheet processes placed so far.
+        """
+        return self._placed
+
+    def _run(self, hosts):
+        while not self._stopped:
+            if self._check_interval:
+                try:
+                    self.check(hosts())
+                except Exception as msg:
+                    print("Error checking the server pool: %s" % msg)
+            self._wakeup.wait(self._check_interval or None)
+            self._wakeup.clear()
+
+    def start(self, hosts):
+        """
+        Start the background thread that runs the health checks.
+
+        INPUT:
+
+        - ``hosts`` -- function; returns the list of hosts to check
+          (the server pool may change while the notebook runs)
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(hosts,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stop the background thread.
+        """
+        self._stopped = True
+        self._wakeup.set()
@@ -95,6 +95,41 @@ class WorksheetProcess:
         """
         raise NotImplementedError                
 
+    def output_generation(self):
+        """
+        Return a number that changes whenever the subprocess produces
+        output or exits.
+
+        The default implementation, for worksheet processes that do
+        not notice new output on their own, always returns 0.
+
+        OUTPUT:
+
+            - ``int``
+        """
+        return 0
+
+    def wait_for_output(self, generation, timeout):
+        """
+        Wait at most ``timeout`` seconds until
+        :meth:`output_generation` is different from ``generation``,
+        and return it.
+
+        The default implementation returns right away.
+
+        INPUT:
+
+            - ``generation`` -- integer; a previous value of
+              :meth:`output_generation`
+
+            - ``timeout`` -- number of seconds
+
+        OUTPUT:
+
+            - ``int``
+        """
+        return self.output_generation()
+
     ###########################################################
     # Sending a string to be executed in the subprocess
     ###########################################################
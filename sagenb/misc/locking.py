@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*
+"""
+Locks used by the notebook server
+
+The locks in this module record how long threads waited to acquire
+them, so that lock contention can be measured with :func:`lock_stats`.
+Locks with the same name share their statistics; e.g., all worksheet
+locks are called ``'worksheet'``.
+
+EXAMPLES::
+
+    sage: from sagenb.misc.locking import TimedLock, lock_stats
+    sage: L = TimedLock('example')
+    sage: with L:
+    ....:     pass
+    sage: lock_stats()['example']['acquisitions']
+    1
+"""
+import threading
+import time
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(name, wait):
+    with _stats_lock:
+        try:
+            S = _stats[name]
+        except KeyError:
+            S = _stats[name] = {'acquisitions': 0, 'wait': 0.0, 'max_wait': 0.0}
+        S['acquisitions'] += 1
+        S['wait'] += wait
+        if wait > S['max_wait']:
+            S['max_wait'] = wait
+
+
+def lock_stats():
+    """
+    Return a dictionary mapping lock names to dictionaries with the
+    number of acquisitions, the total time spent waiting for the lock
+    and the longest wait (in seconds).
+    """
+    with _stats_lock:
+        return dict([(name, dict(S)) for name, S in _stats.items()])
+
+
+def reset_lock_stats():
+    """
+    Forget all lock statistics.
+    """
+    with _stats_lock:
+        _stats.clear()
+
+
+class TimedLock(object):
+    def __init__(self, name, lock=None):
+        """
+        A lock that records how long it takes to acquire it.
+
+        INPUT:
+
+        - ``name`` -- string; the name under which the wait times are
+          recorded
+
+        - ``lock`` -- the underlying lock (default: a new
+          ``threading.Lock``); pass a ``threading.RLock`` for a
+          reentrant lock
+        """
+        self._name = name
+        self._lock = threading.Lock() if lock is None else lock
+
+    def __repr__(self):
+        return "Timed lock '%s'" % self._name
+
+    def acquire(self, blocking=True):
+        t = time.time()
+        if self._lock.acquire(blocking):
+            _record(self._name, time.time() - t)
+            return True
+        return False
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RWLock(object):
+    def __init__(self, name):
+        """
+        A reader/writer lock: any number of threads may hold it for
+        reading at the same time, but a writer has it alone.  Waiting
+        writers have priority over new readers.
+
+        A thread that holds the lock may acquire it again, for
+        reading or, if it is the writer, for writing.
+
+        Wait times are recorded as ``name + ':read'`` and
+        ``name + ':write'``.
+
+        EXAMPLES::
+
+            sage: from sagenb.misc.locking import RWLock
+            sage: L = RWLock('example')
+            sage: with L.read():
+            ....:     with L.read():
+            ....:         pass
+            sage: with L.write():
+            ....:     with L.read():
+            ....:         pass
+            sage: L
+            Reader/writer lock 'example' (0 readers, no writer)
+        """
+        self._name = name
+        self._cond = threading.Condition(threading.Lock())
+        # thread ident -> number of times it holds the read lock
+        self._readers = {}
+        self._writer = None
+        self._writer_count = 0
+        self._waiting_writers = 0
+
+    def __repr__(self):
+        return "Reader/writer lock '%s' (%s readers, %s writer)" % (
+            self._name, len(self._readers),
+            'no' if self._writer is None else 'a')
+
+    def acquire_read(self):
+        me = threading.current_thread().ident
+        t = time.time()
+        with self._cond:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+        _record(self._name + ':read', time.time() - t)
+
+    def release_read(self):
+        me = threading.current_thread().ident
+        with self._cond:
+            n = self._readers[me] - 1
+            if n:
+                self._readers[me] = n
+            else:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread().ident
+        t = time.time()
+        with self._cond:
+            if self._writer != me:
+                if me in self._readers:
+                    raise RuntimeError("cannot upgrade a read lock to a write lock")
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self._writer = me
+            self._writer_count += 1
+        _record(self._name + ':write', time.time() - t)
+
+    def release_write(self):
+        with self._cond:
+            self._writer_count -= 1
+            if self._writer_count == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    def read(self):
+        """
+        Return a context manager holding this lock for reading.
+        """
+        return _Holder(self.acquire_read, self.release_read)
+
+    def write(self):
+        """
+        Return a context manager holding this lock for writing.
+        """
+        return _Holder(self.acquire_write, self.release_write)
+
+
+class _Holder(object):
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, *args):
+        self._release()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*
+r"""
+A long-running Sphinx renderer process
+
+The first call of :func:`~sagenb.misc.sphinxify.sphinxify` in a
+worksheet process imports Sphinx and reads its configuration, which
+takes much longer than rendering a docstring.  A
+:class:`SphinxRenderer` keeps a separate Python process running that
+did this once, when it started, and renders docstrings on request.
+The worksheet process starts it without waiting for it when it is
+initialized (see :func:`sagenb.misc.support.init`), so that it is
+ready by the time somebody first asks for a docstring.
+
+The protocol is one JSON object per line: a request
+``{"docstring": ..., "format": ...}`` on the standard input of the
+renderer is answered by ``{"output": ...}`` or ``{"error": ...}`` on
+its standard output.  Anything else the renderer prints (e.g., Sphinx
+warnings) is thrown away, since the standard error of the worksheet
+process would end up in the output of a cell.
+
+The renderer runs in its own process group and ignores SIGINT, so
+interrupting a computation does not interrupt it.  If it exited, it is
+started again.  Its first answer may take until ``STARTUP_TIMEOUT``
+seconds after it was started, since it may still be importing Sphinx.
+If it does not answer in time or fails, it is killed and
+:meth:`SphinxRenderer.render` returns None, so that the caller renders
+the docstring itself; after ``MAX_FAILURES`` failures in a row the
+renderer is not used any more.  None of this is reported, since it
+would end up in the output of a cell too.
+
+AUTHORS:
+
+  - The Sage notebook developers
+"""
+import json
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# Seconds to wait for the renderer to answer a request; the first
+# request may also wait for the renderer to start.
+TIMEOUT = 15
+
+# Seconds after starting the renderer until which the first request
+# may wait for it to be ready.
+STARTUP_TIMEOUT = 60
+
+# Number of failures in a row after which the renderer is given up.
+MAX_FAILURES = 3
+
+
+class SphinxRenderer(object):
+    def __init__(self, timeout=TIMEOUT, command=None):
+        """
+        INPUT:
+
+        - ``timeout`` -- number (default: 15); seconds to wait for an
+          answer
+
+        - ``command`` -- list of strings or None (default); the
+          command starting the renderer process (default: this module
+          run by the current Python interpreter)
+
+        EXAMPLES::
+
+            sage: from sagenb.misc.sphinx_worker import SphinxRenderer
+            sage: SphinxRenderer()
+            Sphinx renderer (not running)
+        """
+        if command is None:
+            command = [sys.executable, '-m', 'sagenb.misc.sphinx_worker']
+        self._command = command
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._process = None
+        self._buffer = ''
+        # time the renderer was started, until it first answered
+        self._starting = None
+        self._failures = 0
+
+    def __repr__(self):
+        if self._process is None:
+            state = 'not running'
+        else:
+            state = 'pid %s' % self._process.pid
+        return "Sphinx renderer (%s)" % state
+
+    def start(self):
+        """
+        Start the renderer process, unless it is running or was given
+        up.  This does not wait for the renderer to be ready.
+        """
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._process is not None and self._process.poll() is not None:
+            # it exited since the last request
+            self._stop()
+        if self._process is not None or self._failures >= MAX_FAILURES:
+            return
+        try:
+            with open(os.devnull, 'w') as devnull:
+                self._process = subprocess.Popen(self._command, stdin=subprocess.PIPE,
+                                                 stdout=subprocess.PIPE, stderr=devnull,
+                                                 close_fds=True, preexec_fn=os.setpgrp)
+            self._starting = time.time()
+        except OSError:
+            self._failures = MAX_FAILURES
+        self._buffer = ''
+
+    def stop(self):
+        """
+        Kill the renderer process.
+        """
+        with self._lock:
+            self._stop()
+
+    def _stop(self):
+        P, self._process = self._process, None
+        if P is None:
+            return
+        try:
+            P.kill()
+            P.wait()
+        except OSError:
+            pass
+
+    def _readline(self, deadline):
+        fd = self._process.stdout.fileno()
+        while '\n' not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError("timed out")
+            if not select.select([fd], [], [], remaining)[0]:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                raise RuntimeError("the renderer exited")
+            self._buffer += data
+        line, self._buffer = self._buffer.split('\n', 1)
+        return line
+
+    def render(self, docstring, format='html', timeout=None):
+        """
+        Return the output of :func:`~sagenb.misc.sphinxify.sphinxify`
+        for the given docstring and format, computed by the renderer
+        process (which is started if needed), or None if the renderer
+        failed or did not answer within ``timeout`` seconds (default:
+        the timeout given when creating this renderer).
+        """
+        if timeout is None:
+            timeout = self._timeout
+        if isinstance(docstring, str):
+            docstring = docstring.decode('utf-8', 'replace')
+        with self._lock:
+            self._start()
+            if self._process is None:
+                return None
+            try:
+                self._process.stdin.write(json.dumps({'docstring': docstring,
+                                                      'format': format}) + '\n')
+                self._process.stdin.flush()
+                deadline = time.time() + timeout
+                if self._starting is not None:
+                    deadline = max(deadline, self._starting + STARTUP_TIMEOUT)
+                answer = json.loads(self._readline(deadline))
+                self._starting = None
+                if 'error' in answer:
+                    raise RuntimeError(answer['error'])
+                output = answer['output']
+            except Exception:
+                self._failures += 1
+                self._stop()
+                return None
+            self._failures = 0
+            return output.encode('utf-8')
+
+
+def serve():
+    """
+    Answer requests of a :class:`SphinxRenderer` on the standard input
+    and output until the standard input is closed.
+    """
+    # Interrupting the worksheet process must not stop us.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from sagenb.misc.sphinxify import sphinxify
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    # Everything else printed, e.g., by Sphinx, goes to stderr.
+    sys.stdout = sys.stderr
+    # Import Sphinx and read its configuration before the first
+    # request arrives.
+    try:
+        sphinxify('*warm up*', cache=False, worker=False)
+    except Exception as msg:
+        print("Error warming up the Sphinx renderer: %s" % msg)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        try:
+            request = json.loads(line)
+            output = sphinxify(request['docstring'].encode('utf-8'),
+                               request.get('format', 'html'),
+                               cache=False, worker=False)
+            answer = {'output': output.decode('utf-8', 'replace')}
+        except Exception as msg:
+            answer = {'error': str(msg)}
+        out.write(json.dumps(answer) + '\n')
+        out.flush()
+
+
+_renderer = None
+
+def renderer():
+    """
+    Return the Sphinx renderer of this process.
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = SphinxRenderer()
+    return _renderer
+
+
+if __name__ == '__main__':
+    serve()
@@ -7,6 +7,13 @@ Processes docstrings with Sphinx. Can also be used as a commandline script:
 
 ``python sphinxify.py <text>``
 
+Running Sphinx on a docstring takes a good fraction of a second, so
+the output is cached, both in memory and on disk in the directory
+``sphinxify_cache`` of ``DOT_SAGENB``, keyed by a hash of the
+docstring and the output format.  The disk cache is shared by all
+worksheet processes and limited to ``CACHE_SIZE`` bytes; the least
+recently used entries are removed first.
+
 AUTHORS:
 
 - Tim Joseph Dumol (2009-09-29): initial version
@@ -16,15 +23,33 @@ AUTHORS:
 #
 # Distributed under the terms of the BSD License
 #**************************************************
+import hashlib
 import os
 import re
 import shutil
+import time
+from collections import OrderedDict
 from tempfile import mkdtemp
 
 # We import Sphinx on demand, to reduce Sage startup time.
 Sphinx = None
 
 from sage.env import SAGE_DOC_SRC
+from sagenb.misc.misc import DOT_SAGENB
+
+# Bump this when the processing of the Sphinx output changes, so that
+# outdated cache entries are not used.
+CACHE_VERSION = 1
+CACHE_DIR = os.path.join(DOT_SAGENB, 'sphinxify_cache')
+# Maximum total size (in bytes) of the disk cache
+CACHE_SIZE = 32 * 2**20
+# Number of outputs also kept in memory
+MEMORY_CACHE_ENTRIES = 128
+
+_memory_cache = OrderedDict()
+# The generated Sphinx configuration, if there is no Sage one; it is
+# generated once per process.
+_confdir = None
 
 
 def is_sphinx_markup(docstring):
@@ -43,7 +68,119 @@ def is_sphinx_markup(docstring):
     return ("`" in docstring or "::" in docstring)
 
 
-def sphinxify(docstring, format='html'):
+def _cache_key(docstring, format):
+    """
+    Return the key of the output of Sphinx for the given docstring and
+    format in the cache.
+
+    EXAMPLES::
+
+        sage: from sagenb.misc.sphinxify import _cache_key
+        sage: _cache_key('A test', 'html') == _cache_key(u'A test', 'html')
+        True
+        sage: _cache_key('A test', 'html') == _cache_key('A test', 'text')
+        False
+    """
+    if isinstance(docstring, unicode):
+        docstring = docstring.encode('utf-8')
+    return hashlib.sha1('%s\0%s\0%s' % (CACHE_VERSION, format, docstring)).hexdigest()
+
+
+def cached_output(docstring, format='html'):
+    """
+    Return the cached output of :func:`sphinxify` for the given
+    docstring and format, or None if it is not cached.
+    """
+    key = _cache_key(docstring, format)
+    try:
+        output = _memory_cache.pop(key)
+    except KeyError:
+        filename = os.path.join(CACHE_DIR, key)
+        try:
+            with open(filename) as f:
+                output = f.read()
+            # the modification time tells which entries were used last
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+    _remember(key, output)
+    return output
+
+
+def _remember(key, output):
+    _memory_cache[key] = output
+    while len(_memory_cache) > MEMORY_CACHE_ENTRIES:
+        _memory_cache.popitem(last=False)
+
+
+def cache_output(docstring, format, output):
+    r"""
+    Put the output of :func:`sphinxify` for the given docstring and
+    format in the cache, and make room in the disk cache if needed.
+    If the disk cache cannot be written, only the memory cache is
+    used.
+
+    EXAMPLES::
+
+        sage: import sagenb.misc.sphinxify as S
+        sage: S.CACHE_DIR = tmp_dir()
+        sage: S.cache_output('A test', 'text', 'A test\n')
+        sage: S._memory_cache.clear()
+        sage: S.cached_output('A test', 'text')
+        'A test\n'
+        sage: S.cached_output('Another test', 'text') is None
+        True
+    """
+    key = _cache_key(docstring, format)
+    _remember(key, output)
+    try:
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        filename = os.path.join(CACHE_DIR, key)
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(output)
+        os.rename(tmp, filename)
+        trim_cache()
+    except (IOError, OSError):
+        # E.g., the cache directory is not writable.  Do not say so:
+        # this runs in the worksheet process, so it would end up in
+        # the output of a cell every time a docstring is shown.
+        pass
+
+
+def trim_cache(size=None):
+    """
+    Remove the least recently used entries of the disk cache until
+    it takes at most ``size`` bytes (default: ``CACHE_SIZE``).
+    """
+    if size is None:
+        size = CACHE_SIZE
+    entries = []
+    total = 0
+    for name in os.listdir(CACHE_DIR):
+        try:
+            st = os.stat(os.path.join(CACHE_DIR, name))
+        except OSError:
+            # removed by another process
+            continue
+        if name.endswith('.tmp') and st.st_mtime > time.time() - 3600:
+            # being written by another process
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+        total += st.st_size
+    entries.sort()
+    for mtime, entry_size, name in entries:
+        if total <= size:
+            break
+        try:
+            os.unlink(os.path.join(CACHE_DIR, name))
+        except OSError:
+            pass
+        total -= entry_size
+
+
+def sphinxify(docstring, format='html', cache=True, worker=True):
     r"""
     Runs Sphinx on a ``docstring``, and outputs the processed
     documentation.
@@ -55,6 +192,13 @@ def sphinxify(docstring, format='html'):
     - ``format`` -- string (optional, default 'html') -- either 'html' or
       'text'
 
+    - ``cache`` -- bool (optional, default True) -- whether to look up
+      and store the output in the cache
+
+    - ``worker`` -- bool (optional, default True) -- whether to let the
+      :mod:`Sphinx renderer process <sagenb.misc.sphinx_worker>` do
+      the work; if it fails, Sphinx is run in this process
+
     OUTPUT:
 
     - string -- Sphinx-processed documentation, in either HTML or
@@ -77,10 +221,23 @@ def sphinxify(docstring, format='html'):
     TESTS::
 
         sage: n = len(sys.path)
-        sage: _ = sphinxify('A test')
+        sage: _ = sphinxify('A test', cache=False, worker=False)
         sage: assert n == len(sys.path)
     """
-    global Sphinx
+    if cache:
+        output = cached_output(docstring, format)
+        if output is not None:
+            return output
+
+    if worker:
+        from sagenb.misc.sphinx_worker import renderer
+        output = renderer().render(docstring, format)
+        if output is not None:
+            if cache:
+                cache_output(docstring, format, output)
+            return output
+
+    global Sphinx, _confdir
     if not Sphinx:
         from sphinx.application import Sphinx
 
@@ -100,14 +257,14 @@ def sphinxify(docstring, format='html'):
 
     # Sphinx constructor: Sphinx(srcdir, confdir, outdir, doctreedir,
     # buildername, confoverrides, status, warning, freshenv).
-    temp_confdir = False
     confdir = os.path.join(SAGE_DOC_SRC, 'en', 'introspect')
     if not SAGE_DOC_SRC and not os.path.exists(confdir):
-        # If we don't have Sage, we need to do our own configuration
-        # This may be inefficient or broken.  TODO: Find a faster way to do this.
-        temp_confdir = True
-        confdir = mkdtemp()
-        generate_configuration(confdir)
+        # If we don't have Sage, we need to do our own configuration,
+        # which we keep for the next docstrings.
+        if _confdir is None or not os.path.exists(_confdir):
+            _confdir = mkdtemp()
+            generate_configuration(_confdir)
+        confdir = _confdir
 
     doctreedir = os.path.join(srcdir, 'doctrees')
     confoverrides = {'html_context': {}, 'master_doc': 'docstring'}
@@ -138,6 +295,8 @@ def sphinxify(docstring, format='html'):
                           output)
         # Remove spurious \(, \), \[, \].
         output = output.replace('\\(', '').replace('\\)', '').replace('\\[', '').replace('\\]', '')
+        if cache:
+            cache_output(docstring, format, output)
     else:
         print("BUG -- Sphinx error")
         if format == 'html':
@@ -145,8 +304,6 @@ def sphinxify(docstring, format='html'):
         else:
             output = docstring
 
-    if temp_confdir:
-        shutil.rmtree(confdir, ignore_errors=True)
     shutil.rmtree(srcdir, ignore_errors=True)
 
     return output
@@ -10,13 +10,14 @@ AUTHORS:
 """
 
 import inspect
+import linecache
 import os
 import base64
 import string
 import sys
 import pydoc
 
-from six import iteritems
+from six import iteritems, text_type
 import __builtin__
 
 try:
@@ -95,6 +96,13 @@ def init(object_directory=None, globs={}):
         sage.misc.sageinspect.EMBEDDED_MODE = True
     except ImportError:
         pass
+    # Start the Sphinx renderer now, so that it is ready when somebody
+    # first asks for a docstring.
+    try:
+        from sagenb.misc.sphinx_worker import renderer
+        renderer().start()
+    except ImportError:
+        pass
 
 
 def setup_systems(globs):
@@ -694,3 +702,41 @@ def preparse_worksheet_cell(s, globals):
     if _automatic_names:
         s = automatic_name_filter(s)
     return s
+
+# The name under which execute_worksheet_cell registers the code of
+# the last cell with linecache.  The brackets tell inspect not to look
+# for a file of that name.
+CODE_NAME = '<___code___.py>'
+
+def execute_worksheet_cell(s, globals):
+    """
+    Preparse the contents ``s`` of a worksheet cell with
+    :func:`preparse_worksheet_cell` and execute the result in
+    ``globals``.
+
+    The preparsed code is kept by :mod:`linecache` as ``CODE_NAME``
+    (until the next cell is executed), so tracebacks and source code
+    introspection show it without writing it to a file.
+
+    INPUT:
+
+    - ``s`` - a string containing code
+
+    - ``globals`` - a string:object dictionary
+
+    EXAMPLES::
+
+        sage: from sagenb.misc.support import execute_worksheet_cell
+        sage: G = {}
+        sage: execute_worksheet_cell('def f():\n    return 1\nf()', G)
+        1
+        sage: import inspect
+        sage: print(inspect.getsource(G['f']))
+        def f():
+            return 1
+    """
+    code = "# -*- coding: utf-8 -*-\n" + preparse_worksheet_cell(s, globals) + "\n"
+    if isinstance(code, text_type):
+        code = code.encode('utf-8')
+    linecache.cache[CODE_NAME] = (len(code), None, code.splitlines(True), CODE_NAME)
+    exec(compile(code, CODE_NAME, 'exec', 0, True), globals)
@@ -51,6 +51,18 @@ re_script = re.compile(r'<script[^>]*?>.*?</script>', re.DOTALL | re.I)
 JEDITABLE_TINYMCE = True
 
 
+def _current_locale():
+    """
+    Return the name of the locale the templates are rendered in, which
+    is part of the key of cached cell HTML.
+    """
+    try:
+        from flask.ext.babel import get_locale
+        return str(get_locale())
+    except Exception:
+        return None
+
+
 ###########################
 # Generic (abstract) cell #
 ###########################
@@ -84,6 +96,67 @@ class Cell_generic(object):
 
         self._worksheet = worksheet
 
+    def __getstate__(self):
+        """
+        Returns the state of this cell for pickling, without the cached
+        HTML and output text.
+
+        EXAMPLES::
+
+            sage: C = sagenb.notebook.cell.TextCell(0, '2+3', None)
+            sage: C._cached('x', 1, lambda: 'y')
+            'y'
+            sage: '_render_cache' in C.__getstate__()
+            False
+        """
+        state = self.__dict__.copy()
+        state.pop('_render_cache', None)
+        return state
+
+    def _cached(self, name, key, render):
+        """
+        Returns the result of ``render()``, which is cached under
+        ``name`` until ``key`` changes.
+
+        INPUT:
+
+        - ``name`` - a hashable object; what is rendered, including
+          any rendering options
+
+        - ``key`` - an object that changes whenever the result of
+          ``render`` would; e.g., a tuple of the cell's input, output
+          and version
+
+        - ``render`` - a function taking no arguments
+
+        OUTPUT:
+
+        - the result of ``render()``
+
+        EXAMPLES::
+
+            sage: C = sagenb.notebook.cell.Cell_generic(0, None)
+            sage: L = []
+            sage: f = lambda: L.append(1) or len(L)
+            sage: C._cached('x', 'a', f), C._cached('x', 'a', f)
+            (1, 1)
+            sage: C._cached('x', 'b', f)
+            2
+        """
+        try:
+            cache = self._render_cache
+        except AttributeError:
+            cache = self._render_cache = {}
+        try:
+            cached_key, value = cache[name]
+            if cached_key == key:
+                return value
+        except KeyError:
+            pass
+        value = render()
+        cache[name] = (key, value)
+        return value
+
     def __repr__(self):
         """
         Returns a string representation of this generic cell.
@@ -598,10 +671,16 @@ class TextCell(Cell_generic):
             sage: C.set_input_text("$2+3$")
         """
         from .template import template
-        return template(os.path.join('html', 'notebook', 'text_cell.html'),
-                        cell = self, wrap = wrap, div_wrap = div_wrap,
-                        do_print = do_print,
-                        editing = editing, publish = publish)
+        W = self.worksheet()
+        key = (self._id, self._text, _current_locale(),
+               W is not None and W.docbrowser(),
+               W is not None and W.is_published())
+        return self._cached(
+            ('html', do_print, editing, publish), key,
+            lambda: template(os.path.join('html', 'notebook', 'text_cell.html'),
+                             cell = self, wrap = wrap, div_wrap = div_wrap,
+                             do_print = do_print,
+                             editing = editing, publish = publish))
 
 
     def plain_text(self, prompts=False):
@@ -1190,9 +1269,21 @@ class Cell(Cell_generic):
             sage: C = sagenb.notebook.cell.Cell(0, 'ěščřžýáíéďĎ', 'ěščřžýáíéďĎ', None)
             sage: C.edit_text()
             u'{{{id=0|\n\u011b\u0161\u010d\u0159\u017e\xfd\xe1\xed\xe9\u010f\u010e\n///\n\u011b\u0161\u010d\u0159\u017e\xfd\xe1\xed\xe9\u010f\u010e\n}}}'
+
+        The edit text is cached until the ID, the input or the output
+        of the cell changes, so saving a worksheet only serializes the
+        cells that changed::
+
+            sage: C.edit_text() is C.edit_text()
+            True
+            sage: C.set_input_text('2+3')
+            sage: C.edit_text()
+            u'{{{id=0|\n2+3\n///\n\u011b\u0161\u010d\u0159\u017e\xfd\xe1\xed\xe9\u010f\u010e\n}}}'
         """
-        s = self.plain_text(ncols, prompts, max_out)
-        return u'{{{id=%s|\n%s\n}}}' % (self.id(), s)
+        key = (self._id, self._in, self._out, ncols or self.word_wrap_cols())
+        return self._cached(('edit_text', prompts, max_out), key,
+                            lambda: u'{{{id=%s|\n%s\n}}}' % (
+                                self.id(), self.plain_text(ncols, prompts, max_out)))
 
     def next_compute_id(self):
         r"""
@@ -1798,6 +1889,28 @@ class Cell(Cell_generic):
             u'<pre class="shrunk">\u011b\u0161\u010d\u0159\u017e\xfd\xe1\xed\xe9\u010f\u010e</pre>'
             sage: C.output_text(raw=True)
             u'\u011b\u0161\u010d\u0159\u017e\xfd\xe1\xed\xe9\u010f\u010e'
+
+        The output text is cached until the input, the output or the
+        version of the cell changes::
+
+            sage: C.output_text() is C.output_text()
+            True
+            sage: C.set_output_text('6', '')
+            sage: C.output_text()
+            u'<pre class="shrunk">6</pre>'
+        """
+        interacting = allow_interact and hasattr(self, '_interact_output')
+        url = self.url_to_self() if self._worksheet is not None else None
+        key = (self._out, self._in, self.version(), url,
+               getattr(self, '_interact_output', None))
+        return self._cached(('output_text', ncols, html, raw, interacting), key,
+                            lambda: self._output_text(ncols, html, raw,
+                                                      allow_interact))
+
+    def _output_text(self, ncols, html, raw, allow_interact):
+        """
+        Returns this compute cell's output text, without caching.  See
+        :meth:`output_text`.
         """
         if allow_interact and hasattr(self, '_interact_output'):
             # Get the input template
@@ -2252,9 +2365,18 @@ class Cell(Cell_generic):
         if wrap is None:
             wrap = self.notebook().conf()['word_wrap_cols']
 
-        return template(os.path.join('html', 'notebook', 'cell.html'),
-                        cell=self, wrap=wrap, div_wrap=div_wrap,
-                        do_print=do_print, publish=publish)
+        # Everything the template looks at.
+        key = (self._id, self._in, self._out, self.output_html(),
+               self.version(), self.cell_output_type(), self.evaluated(),
+               self.computing(), bool(self.introspect()),
+               getattr(self, '_interact_output', None),
+               self.worksheet().docbrowser(), _current_locale(),
+               publish and self.notebook().conf()['pub_interact'])
+        return self._cached(
+            ('html', wrap, div_wrap, do_print, publish), key,
+            lambda: template(os.path.join('html', 'notebook', 'cell.html'),
+                             cell=self, wrap=wrap, div_wrap=div_wrap,
+                             do_print=do_print, publish=publish))
 
     def url_to_self(self):
         """
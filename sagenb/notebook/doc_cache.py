@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*
+r"""
+Cache of live documentation pages
+
+Opening a page of the live documentation used to run the SGML parser
+of :class:`~sagenb.notebook.docHTMLProcessor.SphinxHTMLProcessor` on
+the Sphinx HTML file every time.  For the big pages of the reference
+manual this takes seconds.  A :class:`DocPageCache` remembers the
+worksheet text and the title of every processed page, keyed on the
+path of the HTML file and its modification time, so that a page is
+only processed again after the documentation was rebuilt.
+
+The processed pages are kept in memory (the most recently used ones)
+and on disk, one pickle per page, so they survive restarting the
+server.  All pages of the documentation can be processed ahead of
+time with :meth:`DocPageCache.prebuild`, or from the command line::
+
+    sage -python -m sagenb.notebook.doc_cache [DOC_DIRECTORY]
+
+EXAMPLES::
+
+    sage: from sagenb.notebook.doc_cache import DocPageCache
+    sage: C = DocPageCache(tmp_dir())
+    sage: html = tmp_filename(ext='.html')
+    sage: open(html, 'w').write('<html><head><title>Test</title></head><body><div class="body">2+2</div></body></html>')
+    sage: title, text = C.get(html)
+    sage: title
+    'Test'
+    sage: C.get(html)[1] == text
+    True
+    sage: C.stats()['hits'], C.stats()['misses']
+    (1, 1)
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from sagenb.misc.misc import DOT_SAGENB
+
+# Bump this when the output of SphinxHTMLProcessor or of
+# process_doc_page changes, so that pages processed by an older
+# version are processed again.
+FORMAT_VERSION = 3
+
+# Default number of processed pages kept in memory.
+MAX_ENTRIES = 200
+
+
+def process_doc_page(path):
+    """
+    Return a pair ``(title, text)``: the title of the Sphinx HTML file
+    with the given path (see :func:`~sagenb.notebook.misc.extract_title`)
+    and its contents as worksheet text.
+
+    The title is '' if the page has none, rather than "Untitled"
+    translated for whoever opened the page first, since the cache is
+    shared by all users.
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.doc_cache import process_doc_page
+        sage: html = tmp_filename(ext='.html')
+        sage: open(html, 'w').write('<html><body><div class="body">2+2</div></body></html>')
+        sage: process_doc_page(html)[0]
+        ''
+    """
+    from .docHTMLProcessor import SphinxHTMLProcessor
+    from .misc import extract_title
+    with open(path) as f:
+        html = f.read()
+    text = SphinxHTMLProcessor().process_doc_html(html)
+    if '<title>' not in html.lower():
+        return '', text
+    return extract_title(html).replace('&mdash;', '--'), text
+
+
+class DocPageCache(object):
+    def __init__(self, directory=None, max_entries=MAX_ENTRIES):
+        """
+        INPUT:
+
+        - ``directory`` -- string or None (default); where the
+          processed pages are stored (default: ``doc_cache`` in
+          ``DOT_SAGENB``); it is created if it does not exist
+
+        - ``max_entries`` -- integer (default: 200); number of
+          processed pages kept in memory
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.doc_cache import DocPageCache
+            sage: DocPageCache(tmp_dir())
+            Cache of live documentation pages in ... (0 in memory)
+        """
+        if directory is None:
+            directory = os.path.join(DOT_SAGENB, 'doc_cache')
+        self._dir = directory
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # path -> (key, title, text), least recently used first
+        self._pages = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __repr__(self):
+        return "Cache of live documentation pages in %s (%s in memory)" % (
+            self._dir, len(self._pages))
+
+    def _key(self, path):
+        st = os.stat(path)
+        return (FORMAT_VERSION, st.st_mtime, st.st_size)
+
+    def _filename(self, path):
+        return os.path.join(self._dir, hashlib.md5(path).hexdigest() + '.pickle')
+
+    def _load(self, path, key):
+        try:
+            with open(self._filename(path), 'rb') as f:
+                obj = pickle.load(f)
+        except Exception:
+            # missing or unreadable; the page is processed again
+            return None
+        if obj.get('path') != path or obj.get('key') != key:
+            return None
+        return obj['title'], obj['text']
+
+    def _store(self, path, key, title, text):
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+        filename = self._filename(path)
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump({'path': path, 'key': key, 'title': title, 'text': text}, f, 2)
+        os.rename(tmp, filename)
+
+    def _remember(self, path, key, title, text):
+        with self._lock:
+            self._pages.pop(path, None)
+            self._pages[path] = (key, title, text)
+            while len(self._pages) > self._max_entries:
+                self._pages.popitem(last=False)
+
+    def get(self, path):
+        """
+        Return a pair ``(title, text)``: the title of the Sphinx HTML
+        file with the given path and its contents as worksheet text.
+        The file is only processed if it changed since it was last
+        processed.
+
+        Raise an OSError if there is no such file.
+        """
+        path = os.path.abspath(path)
+        key = self._key(path)
+        with self._lock:
+            page = self._pages.get(path)
+            if page is not None and page[0] == key:
+                self._pages[path] = self._pages.pop(path)
+                self._hits += 1
+                return page[1], page[2]
+        page = self._load(path, key)
+        if page is None:
+            page = process_doc_page(path)
+            with self._lock:
+                self._misses += 1
+            try:
+                self._store(path, key, *page)
+            except (IOError, OSError) as msg:
+                print("Error caching live documentation page %s: %s" % (path, msg))
+        else:
+            with self._lock:
+                self._hits += 1
+        self._remember(path, key, *page)
+        return page
+
+    def stats(self):
+        """
+        Return a dictionary with the number of cache hits and misses
+        and the number of pages in memory.
+        """
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'entries': len(self._pages)}
+
+    def prebuild(self, root, verbose=False):
+        """
+        Process all HTML files below the directory ``root`` that are
+        not already in the cache, and store them on disk (but not in
+        memory).  Return the number of files processed.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.doc_cache import DocPageCache
+            sage: C = DocPageCache(tmp_dir())
+            sage: root = tmp_dir()
+            sage: open(os.path.join(root, 'a.html'), 'w').write('<html><title>A</title></html>')
+            sage: C.prebuild(root)
+            1
+            sage: C.prebuild(root)
+            0
+        """
+        n = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            # static files of the manuals
+            dirnames[:] = [d for d in dirnames if not d.startswith('_')]
+            for name in filenames:
+                if not name.endswith('.html'):
+                    continue
+                path = os.path.abspath(os.path.join(dirpath, name))
+                key = self._key(path)
+                if self._load(path, key) is not None:
+                    continue
+                try:
+                    self._store(path, key, *process_doc_page(path))
+                except Exception as msg:
+                    print("Error processing %s: %s" % (path, msg))
+                    continue
+                n += 1
+                if verbose:
+                    print(path)
+        return n
+
+
+_cache = None
+
+def doc_page_cache():
+    """
+    Return the cache of live documentation pages used by the
+    notebook server.
+    """
+    global _cache
+    if _cache is None:
+        _cache = DocPageCache()
+    return _cache
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        root = sys.argv[1]
+    else:
+        from sage.env import SAGE_DOC
+        root = os.path.join(SAGE_DOC, 'html', 'en')
+    print("Processed %s pages" % doc_page_cache().prebuild(root, verbose=True))
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*
+"""
+Quitting idle worksheet processes
+
+The notebook quits the compute process of a worksheet that has not
+been used for ``idle_timeout`` seconds (``doc_timeout`` for live
+documentation).  This used to be done by looking at every loaded
+worksheet from a request handler every ``idle_check_interval``
+seconds, although only a few of them have a running process.
+
+An :class:`IdleReaper` keeps the worksheets whose process was
+started in a heap, ordered by the time at which they would become
+idle if nobody used them any more, and a background thread wakes up
+when the first of them is due.  A worksheet that was used in the
+meantime is pushed back with its new deadline, so only worksheets
+that are actually due are looked at.
+
+AUTHORS:
+
+  - The Sage notebook developers
+"""
+import heapq
+import itertools
+import threading
+
+from sagenb.misc.misc import walltime
+
+# How long (in seconds) to wait before looking at a worksheet again
+# if it has no idle timeout.
+RECHECK_INTERVAL = 600
+
+
+class IdleReaper(object):
+    def __init__(self, timeout):
+        """
+        INPUT:
+
+        - ``timeout`` -- function; called with a worksheet, returns
+          the number of seconds after which its process is quit if the
+          worksheet is not used (0 for never)
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.idle_reaper import IdleReaper
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('test', 'admin')
+            sage: R = IdleReaper(lambda W: 0)
+            sage: R.add(W)
+            sage: R
+            Idle worksheet process reaper (1 worksheets)
+            sage: R.reap()
+            []
+            sage: R.discard(W)
+            sage: R
+            Idle worksheet process reaper (0 worksheets)
+        """
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # heap of triples (deadline, counter, worksheet)
+        self._heap = []
+        self._counter = itertools.count()
+        # filename -> (worksheet, counter of its current heap entry);
+        # the other heap entries of a worksheet are stale
+        self._worksheets = {}
+        self._quit = 0
+        self._checked = 0
+        self._thread = None
+        self._stopped = False
+
+    def __repr__(self):
+        return "Idle worksheet process reaper (%s worksheets)" % len(self._worksheets)
+
+    def _deadline(self, W):
+        timeout = self._timeout(W)
+        if timeout > 0:
+            return W.last_compute_walltime() + timeout
+        return walltime() + RECHECK_INTERVAL
+
+    def _push(self, W, deadline):
+        first = not self._heap or deadline < self._heap[0][0]
+        n = next(self._counter)
+        heapq.heappush(self._heap, (deadline, n, W))
+        self._worksheets[W.filename()] = (W, n)
+        if first:
+            self._wakeup.set()
+
+    def add(self, W):
+        """
+        Watch the worksheet ``W``, whose compute process was just
+        started.
+        """
+        with self._lock:
+            if self._worksheets.get(W.filename(), (None,))[0] is W:
+                return
+            self._push(W, self._deadline(W))
+
+    def discard(self, W):
+        """
+        Stop watching the worksheet ``W``.
+        """
+        with self._lock:
+            if self._worksheets.get(W.filename(), (None,))[0] is W:
+                del self._worksheets[W.filename()]
+
+    def next_deadline(self):
+        """
+        Return the walltime at which the next worksheet may become
+        idle, or None if no worksheet is watched.
+        """
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def reap(self):
+        """
+        Quit the processes of the worksheets that became idle and
+        return the list of their filenames.
+        """
+        due = []
+        with self._lock:
+            now = walltime()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, n, W = heapq.heappop(self._heap)
+                entry = self._worksheets.get(W.filename())
+                if entry is None or entry[0] is not W or entry[1] != n:
+                    # stale entry
+                    continue
+                self._checked += 1
+                if not W.compute_process_has_been_started():
+                    del self._worksheets[W.filename()]
+                    continue
+                deadline = self._deadline(W)
+                if deadline > now:
+                    # used since it was pushed
+                    self._push(W, deadline)
+                else:
+                    del self._worksheets[W.filename()]
+                    due.append(W)
+        quit = []
+        for W in due:
+            # The worksheet may be in use by a request right now.
+            with W.lock():
+                W.quit_if_idle(self._timeout(W))
+                if W.compute_process_has_been_started():
+                    self.add(W)
+                else:
+                    quit.append(W.filename())
+        with self._lock:
+            self._quit += len(quit)
+        return quit
+
+    def stats(self):
+        """
+        Return a dictionary with the number of watched worksheets, the
+        number of times a worksheet was looked at and the number of
+        processes quit.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.idle_reaper import IdleReaper
+            sage: sorted(IdleReaper(lambda W: 0).stats().items())
+            [('checked', 0), ('quit', 0), ('watched', 0)]
+        """
+        with self._lock:
+            return {'watched': len(self._worksheets),
+                    'checked': self._checked,
+                    'quit': self._quit}
+
+    def _run(self):
+        while not self._stopped:
+            deadline = self.next_deadline()
+            if deadline is None:
+                self._wakeup.wait()
+            else:
+                self._wakeup.wait(max(0, deadline - walltime()))
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            try:
+                self.reap()
+            except Exception as msg:
+                print("Error quitting idle worksheet processes: %s" % msg)
+
+    def start(self):
+        """
+        Start the background thread that quits idle processes.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stop the background thread.
+        """
+        self._stopped = True
+        self._wakeup.set()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*
+r"""
+Lazily created cells of a worksheet
+
+When a worksheet is opened, its body is read from ``worksheet.html``.
+This used to create every :class:`~sagenb.notebook.cell.Cell` and
+:class:`~sagenb.notebook.cell.TextCell` with its input and output at
+once, even if only one cell was then updated.  A :class:`LazyCellList`
+behaves like the list of cells of a worksheet, but only records where
+the text of every cell is in the body and the cell ID, and creates a
+cell object the first time it is accessed.
+
+Cells that were never accessed are written back to the body with
+their original text (see :meth:`LazyCellList.block_text`), so saving
+a worksheet does not create them either.
+
+EXAMPLES::
+
+    sage: from sagenb.notebook.lazy_cells import LazyCellList, Block
+    sage: text = 'hello {{{id=5|\n2+3\n}}}'
+    sage: blocks = [Block(0, 'plain', 0, 6, True), Block(5, 'compute', 6, 22, True)]
+    sage: L = LazyCellList(blocks, text, lambda text, block: (block.id, text[block.start:block.end]))
+    sage: len(L), L.ids(), L.loaded()
+    (2, [0, 5], 0)
+    sage: L[1]
+    (5, '{{{id=5|\n2+3\n}}}')
+    sage: L.loaded()
+    1
+    sage: L.block_text(0)
+    'hello'
+"""
+from collections import namedtuple
+try:
+    from collections.abc import MutableSequence
+except ImportError:
+    from collections import MutableSequence
+
+# The position of the text of a cell that was not created yet:
+#
+# - ``id`` -- the ID the cell gets
+# - ``typ`` -- 'plain' for a text cell, 'compute' for a compute cell
+# - ``start``, ``end`` -- the cell is ``text[start:end]``
+# - ``verbatim`` -- whether ``text[start:end].strip()`` is what the
+#   cell would return as its edit text
+Block = namedtuple('Block', 'id typ start end verbatim')
+
+
+class LazyCellList(MutableSequence):
+    def __init__(self, cells=(), text=None, make_cell=None):
+        """
+        INPUT:
+
+        - ``cells`` -- a list of cells and :class:`Block`\ s
+
+        - ``text`` -- string or None (default); the body of the
+          worksheet the blocks refer to
+
+        - ``make_cell`` -- a function; called with ``text`` and a
+          block, returns the cell for the block
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.lazy_cells import LazyCellList
+            sage: LazyCellList([1, 2])
+            [1, 2]
+        """
+        self._cells = list(cells)
+        self._text = text
+        self._make_cell = make_cell
+        self._blocks = len([C for C in self._cells if isinstance(C, Block)])
+        if not self._blocks:
+            self._text = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __len__(self):
+        return len(self._cells)
+
+    def _create(self, i):
+        C = self._cells[i]
+        if isinstance(C, Block):
+            C = self._cells[i] = self._make_cell(self._text, C)
+            self._forget(1)
+        return C
+
+    def _forget(self, n):
+        self._blocks -= n
+        if not self._blocks:
+            # all cells were created; free the body
+            self._text = None
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._create(j) for j in range(*i.indices(len(self._cells)))]
+        return self._create(i)
+
+    def __setitem__(self, i, C):
+        if isinstance(i, slice):
+            old = self._cells[i]
+            C = list(C)
+        else:
+            old = [self._cells[i]]
+        self._cells[i] = C
+        self._forget(len([X for X in old if isinstance(X, Block)]))
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            old = self._cells[i]
+        else:
+            old = [self._cells[i]]
+        del self._cells[i]
+        self._forget(len([X for X in old if isinstance(X, Block)]))
+
+    def __iter__(self):
+        # like a list iterator, tolerate changes of the list
+        i = 0
+        while i < len(self._cells):
+            yield self._create(i)
+            i += 1
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyCellList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, (list, LazyCellList)):
+            return list(self) != list(other)
+        return NotImplemented
+
+    def insert(self, i, C):
+        self._cells.insert(i, C)
+
+    def id(self, i):
+        """
+        Return the ID of the cell at position ``i``, without creating
+        it.
+        """
+        C = self._cells[i]
+        if isinstance(C, Block):
+            return C.id
+        return C.id()
+
+    def ids(self):
+        """
+        Return the list of the IDs of the cells, without creating
+        them.
+        """
+        return [C.id if isinstance(C, Block) else C.id() for C in self._cells]
+
+    def is_compute_cell(self, i):
+        """
+        Return whether the cell at position ``i`` is a compute cell,
+        without creating it.
+        """
+        C = self._cells[i]
+        if isinstance(C, Block):
+            return C.typ == 'compute'
+        return C.is_compute_cell()
+
+    def block_text(self, i):
+        """
+        Return the edit text of the cell at position ``i`` if it was
+        not created yet and its text in the body can be used as is,
+        and None otherwise.
+        """
+        C = self._cells[i]
+        if isinstance(C, Block) and C.verbatim:
+            return self._text[C.start:C.end].strip()
+        return None
+
+    def loaded(self):
+        """
+        Return the number of cells that were created.
+        """
+        return len(self._cells) - self._blocks
+
+    def created_cells(self):
+        """
+        Return the list of the cells that were created.
+        """
+        return [C for C in self._cells if not isinstance(C, Block)]
+
+    def pending_size(self):
+        """
+        Return the number of characters of the body taken by the
+        cells that were not created yet.
+        """
+        return sum([C.end - C.start for C in self._cells if isinstance(C, Block)])
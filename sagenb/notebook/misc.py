@@ -231,9 +231,22 @@ def encode_response(obj, separators=(',', ':'), **kwargs):
     return json.dumps(obj, separators = separators, **kwargs)
 
 def extract_title(html_page, username=None):
+    """
+    Return the title of the HTML page ``html_page``, or "Untitled"
+    (translated) if it has none.
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.misc import extract_title
+        sage: extract_title('<html><head><TITLE>Test</TITLE></head></html>')
+        'Test'
+        sage: print(extract_title('<html></html>'))
+        Untitled
+    """
     h = html_page.lower()
     i = h.find('<title>')
     if i == -1:
-        return _("Untitled", username)
+        from flask.ext.babel import gettext
+        return gettext("Untitled")
     j = h.find('</title>')
     return html_page[i + len('<title>') : j]
@@ -20,15 +20,21 @@ from __future__ import print_function, absolute_import
 # For debugging sometimes it is handy to use only the reference implementation.
 USE_REFERENCE_WORKSHEET_PROCESSES = False
 
+# Code sent to pre-started worksheet processes while they are idle.
+PROCESS_POOL_WARMUP = 'exec("try:\\n import sage.all_notebook\\nexcept ImportError:\\n pass")'
+
 # System libraries
 import os
 import random
 import re
 import shutil
 import socket
+import threading
 import time
-import bz2
+import copy
 from cgi import escape
+from functools import partial
+from collections import OrderedDict
 
 try:
     import cPickle as pickle
@@ -39,7 +45,7 @@ from six import iteritems
 
 # Sage libraries
 from sagenb.misc.misc import (pad_zeros, cputime, tmp_dir, load, save,
-                              ignore_nonexistent_files, unicode_str)
+                              ignore_nonexistent_files, unicode_str, walltime)
 
 # Sage Notebook
 from . import css          # style
@@ -92,14 +98,36 @@ MATHJAX = True
 JEDITABLE_TINYMCE  = True
 
 class WorksheetDict(dict):
+    """
+    Dictionary mapping worksheet filenames to the loaded worksheets.
+    Worksheets are loaded from storage on first access.
+
+    The dictionary remembers in which order the worksheets were used,
+    so that :meth:`evict` can forget the least recently used ones.
+    Request threads use it concurrently, so the entries and the order
+    are only changed while holding its lock.
+    """
     def __init__(self, notebook, *args, **kwds):
         self.notebook = notebook
         self.storage = notebook._Notebook__storage
+        self._lock = threading.RLock()
+        # filename -> walltime of last use, least recently used first
+        self._lru = OrderedDict()
         dict.__init__(self, *args, **kwds)
+        for item in dict.keys(self):
+            self._touch(item)
+
+    def _touch(self, item):
+        # call with self._lock held
+        self._lru.pop(item, None)
+        self._lru[item] = walltime()
 
     def __getitem__(self, item):
-        if item in self:
-            return dict.__getitem__(self, item)
+        with self._lock:
+            worksheet = dict.get(self, item)
+            if worksheet is not None:
+                self._touch(item)
+                return worksheet
 
         try:
             if '/' not in item:
@@ -117,10 +145,98 @@ class WorksheetDict(dict):
         except ValueError:
             raise KeyError(item)
 
-        dict.__setitem__(self, item, worksheet)
+        with self._lock:
+            # unless another thread loaded it in the meantime
+            worksheet = dict.setdefault(self, item, worksheet)
+        self[item] = worksheet
         return worksheet
-        
-        
+
+    def __setitem__(self, item, worksheet):
+        with self._lock:
+            dict.__setitem__(self, item, worksheet)
+            self._touch(item)
+        max_entries = self.notebook.conf()['max_loaded_worksheets']
+        if max_entries and len(self) > max_entries:
+            self.evict(max_entries=max_entries)
+
+    def __delitem__(self, item):
+        with self._lock:
+            dict.__delitem__(self, item)
+            self._lru.pop(item, None)
+
+    def evict(self, max_entries=0, max_memory=0, min_idle=60):
+        """
+        Forget least recently used worksheets until at most
+        ``max_entries`` worksheets are loaded and their cells use at
+        most ``max_memory`` bytes (roughly; see
+        :meth:`~sagenb.notebook.worksheet.Worksheet.memory_size`).  A
+        limit of 0 means no limit.
+
+        Only worksheets that are not in use are forgotten: they were
+        not used in the last ``min_idle`` seconds, have no running
+        worksheet process and nobody holds their lock.  Changed
+        worksheets are saved first.  A forgotten worksheet is
+        loaded again the next time it is accessed.
+
+        OUTPUT:
+
+        - list of filenames of the worksheets that were forgotten
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W1 = nb.create_new_worksheet('one', 'admin')
+            sage: W2 = nb.create_new_worksheet('two', 'admin')
+            sage: W1.set_name('one again')
+            sage: D = nb._Notebook__worksheets
+            sage: D.evict(max_entries=1)
+            []
+            sage: D.evict(max_entries=1, min_idle=0)
+            ['admin/0']
+            sage: sorted(D.keys())
+            ['admin/1']
+            sage: D['admin/0'].name()
+            u'one again'
+        """
+        with self._lock:
+            entries = [(item, used, dict.get(self, item))
+                       for item, used in self._lru.items()]
+        entries = [e for e in entries if e[2] is not None]
+        sizes = {}
+        if max_memory:
+            for item, used, W in entries:
+                sizes[item] = W.memory_size()
+        memory = sum(sizes.values())
+        evicted = []
+        for item, used, W in entries:
+            if (not max_entries or len(self) <= max_entries) and \
+               (not max_memory or memory <= max_memory):
+                break
+            if walltime() - used < min_idle:
+                # the rest were used even more recently
+                break
+            if not self.notebook._can_evict(W):
+                continue
+            lock = W.lock()
+            if not lock.acquire(False):
+                continue
+            try:
+                if W.is_dirty():
+                    self.notebook.save_worksheet(W)
+                with self._lock:
+                    if dict.get(self, item) is not W or self._lru.get(item) != used:
+                        # used again in the meantime
+                        continue
+                    dict.__delitem__(self, item)
+                    del self._lru[item]
+            finally:
+                lock.release()
+            memory -= sizes.get(item, 0)
+            evicted.append(item)
+        return evicted
+
+
 class Notebook(object):
     HISTORY_MAX_OUTPUT = 92*5
     HISTORY_NCOLS = 90
@@ -168,17 +284,6 @@ class Notebook(object):
         W = WorksheetDict(self)
         self.__worksheets = W
 
-        # Store / Refresh public worksheets
-        for id_number in os.listdir(self.__storage._abspath(self.__storage._user_path("pub"))):
-            if id_number.isdigit():
-                a = "pub/"+str(id_number)
-                if a not in self.__worksheets:
-                    try:
-                        self.__worksheets[a] = self.__storage.load_worksheet("pub",int(id_number))
-                    except Exception:
-                        import traceback
-                        print("Warning: problem loading %s/%s: %s" % ("pub", int(id_number), traceback.format_exc()))
-
         # Set the openid-user dict
         try:
             self._user_manager.load(S)
@@ -359,31 +464,16 @@ class Notebook(object):
         W.save()
 
     def pub_worksheets(self):
-        path = self.__storage._abspath(self.__storage._user_path("pub"))
-        v = []
-        a = ""
-        for id_number in os.listdir(path):
-            if id_number.isdigit():
-                a = "pub"+"/"+id_number
-                if a in self.__worksheets:
-                    v.append(self.__worksheets[a])
-                else:
-                    try:
-                        self.__worksheets[a] = self.__storage.load_worksheet("pub", int(id_number))
-                        v.append(self.__worksheets[a])
-                    except Exception:
-                        import traceback
-                        print("Warning: problem loading %s/%s: %s" % ("pub", id_number, traceback.format_exc()))
-        return v
+        """
+        Return all published worksheets.
+        """
+        return self.users_worksheets('pub')
 
     def users_worksheets(self, username):
         r"""
         Returns all worksheets owned by `username`
         """
 
-        if username == "pub":
-            return self.pub_worksheets()
-
         worksheets = self.__storage.worksheets(username)
         # if a worksheet has already been loaded in self.__worksheets, return
         # that instead since worksheets that are already running should be
@@ -397,7 +487,7 @@ class Notebook(object):
         # Should return worksheets from self.__worksheets if possible
         worksheets = self.users_worksheets(username)
         user=self.user_manager().user(username)
-        viewable_worksheets=[self.__storage.load_worksheet(owner, id) for owner,id in user.viewable_worksheets()]
+        viewable_worksheets=[self.__storage.load_worksheet_from_index(owner, id) for owner,id in user.viewable_worksheets()]
         # we double-check that we can actually view these worksheets
         # just in case someone forgets to update the map
         worksheets.extend([w for w in viewable_worksheets if w.is_viewer(username)])
@@ -436,9 +526,12 @@ class Notebook(object):
         W = None
 
         # Reuse an existing published version
-        for X in self.get_worksheets_with_owner('pub'):
-            if (X.worksheet_that_was_published() == worksheet):
+        try:
+            X = worksheet.published_version()
+            if X.worksheet_that_was_published() == worksheet:
                 W = X
+        except ValueError:
+            pass
 
         # Or create a new one.
         if W is None:
@@ -504,7 +597,8 @@ class Notebook(object):
             raise KeyError("Attempt to delete missing worksheet '%s'" % filename)
         
         W.quit()
-        shutil.rmtree(W.directory(), ignore_errors=False)
+        self._writer().discard(W.filename())
+        self.__storage.delete_worksheet(W.owner(), W.id_number())
         self.deleted_worksheets()[filename] = W
 
     def deleted_worksheets(self):
@@ -538,8 +632,7 @@ class Notebook(object):
             sage: nb.worksheet_names()
             []
         """
-        X = self.get_worksheets_with_viewer(username)
-        X = [W for W in X if W.is_trashed(username)]
+        X = self.worksheet_list_for_user(username, typ='trash')
         for W in X:
             W.delete_user(username)
             if W.owner() is None:
@@ -592,29 +685,89 @@ class Notebook(object):
         self.__ulimit = ulimit
 
     def get_server(self):
-        P = self.server_pool()
-        if P is None or len(P) == 0:
-            return None
+        """
+        Return the host of the server pool on which the next worksheet
+        process should run, as chosen by the :meth:`server_scheduler`,
+        or None if the server pool is empty.
+        """
+        return self.server_scheduler().choose(self.server_pool())
+
+    def server_scheduler(self):
+        """
+        Return the :class:`~sagenb.interfaces.scheduler.ServerScheduler`
+        that places new worksheet processes on the hosts of the server
+        pool, configured by the ``server_pool_policy`` and
+        ``server_pool_check_interval`` settings.  Its health checks are
+        started by :meth:`start_server_scheduler`.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.server_scheduler()
+            Server scheduler (least_loaded, 0 hosts)
+        """
         try:
-            self.__server_number = (self.__server_number + 1) % len(P)
-            i = self.__server_number
+            S = self.__server_scheduler
         except AttributeError:
-            self.__server_number = 0
-            i = 0
-        return P[i]
+            from sagenb.interfaces import ServerScheduler
+            S = ServerScheduler()
+            self.__server_scheduler = S
+        S.configure(self.conf()['server_pool_policy'],
+                    self.conf()['server_pool_check_interval'])
+        return S
+
+    def start_server_scheduler(self):
+        """
+        Start the health checks of the hosts in the server pool, if
+        there are any.
+        """
+        if not self.server_pool():
+            return
+        self.server_scheduler().start(lambda: self.server_pool() or [])
 
     def new_worksheet_process(self):
         """
         Return a new worksheet process object with parameters determined by
         configuration of this notebook server.
         """
+        if USE_REFERENCE_WORKSHEET_PROCESSES:
+            from sagenb.interfaces import WorksheetProcess_ReferenceImplementation
+            return WorksheetProcess_ReferenceImplementation()
+
+        server_pool = self.server_pool()
+        if not server_pool or len(server_pool) == 0:
+            return self._new_worksheet_process()
+        else:
+            scheduler = self.server_scheduler()
+            user_at_host = scheduler.choose(server_pool)
+            S = self._new_worksheet_process(user_at_host)
+            scheduler.assign(user_at_host, S)
+            return S
+
+    def _new_worksheet_process(self, user_at_host=None):
+        """
+        Return a new expect worksheet process, running locally if
+        ``user_at_host`` is None and as ``user_at_host`` otherwise.
+        """
         from sagenb.interfaces import (WorksheetProcess_ExpectImplementation,
-                                       WorksheetProcess_ReferenceImplementation,
                                        WorksheetProcess_RemoteExpectImplementation)
 
-        if USE_REFERENCE_WORKSHEET_PROCESSES:
-            return WorksheetProcess_ReferenceImplementation()
+        process_limits = self._process_limits()
+        if user_at_host is None:
+            return WorksheetProcess_ExpectImplementation(process_limits=process_limits,
+                                                         pool=self.process_pool())
+        else:
+            python_command = os.path.join(os.environ['SAGE_ROOT'], 'sage -python')
+            return WorksheetProcess_RemoteExpectImplementation(user_at_host=user_at_host,
+                             process_limits=process_limits,
+                             remote_python=python_command,
+                             pool=self.process_pool())
 
+    def _process_limits(self):
+        """
+        Return the ProcessLimits of worksheet processes, as given by
+        the ulimit setting of this notebook server.
+        """
         ulimit = self.get_ulimit()
         from sagenb.interfaces import ProcessLimits
         # We have to parse the ulimit format to our ProcessLimits.
@@ -627,7 +780,6 @@ class Notebook(object):
         #    -v --> max_vmem (but we divide by 1000)
         #    -t -- > max_walltime
 
-        max_vmem = max_cputime = max_walltime = None
         tbl = {'v': None, 'u': None, 't': None}
         for x in ulimit.split('-'):
             for k in tbl.keys():
@@ -636,21 +788,47 @@ class Notebook(object):
         if tbl['v'] is not None:
             tbl['v'] = tbl['v'] / 1000.0
 
+        return ProcessLimits(max_vmem=tbl['v'], max_walltime=tbl['t'],
+                             max_processes=tbl['u'])
 
-        process_limits = ProcessLimits(max_vmem=tbl['v'], max_walltime=tbl['t'],
-                                       max_processes=tbl['u'])
+    def process_pool(self):
+        """
+        Return the pool of pre-started worksheet processes of this
+        notebook server, with the size and maximum age given by the
+        server configuration.
 
-        server_pool = self.server_pool()
-        if not server_pool or len(server_pool) == 0:
-            return WorksheetProcess_ExpectImplementation(process_limits=process_limits)
-        else:
-            import random
-            user_at_host = random.choice(server_pool)
-            python_command = os.path.join(os.environ['SAGE_ROOT'], 'sage -python')
-            return WorksheetProcess_RemoteExpectImplementation(user_at_host=user_at_host,
-                             process_limits=process_limits,
-                             remote_python=python_command)
+        EXAMPLES::
 
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir()+'.sagenb')
+            sage: nb.process_pool()
+            Pool of pre-started worksheet processes (size 0, 0 idle)
+        """
+        try:
+            P = self.__process_pool
+        except AttributeError:
+            from sagenb.interfaces import WorksheetProcessPool
+            # Pre-import the Sage library, which is what takes most of
+            # the time when a worksheet process starts.
+            P = WorksheetProcessPool(warmup=PROCESS_POOL_WARMUP)
+            self.__process_pool = P
+        P.configure(self.conf()['process_pool_size'],
+                    self.conf()['process_pool_max_age'])
+        return P
+
+    def start_process_pool(self):
+        """
+        Start pre-starting worksheet processes for every host in the
+        server pool (or for this machine if the server pool is empty),
+        so that the first worksheets evaluated after the server starts
+        do not have to wait for Sage to start.
+        """
+        if USE_REFERENCE_WORKSHEET_PROCESSES:
+            return
+        P = self.process_pool()
+        for user_at_host in (self.server_pool() or [None]):
+            S = self._new_worksheet_process(user_at_host)
+            P.register(S.pool_key(), S.command())
+        P.start()
 
     def _python_command(self):
         """
@@ -749,11 +927,44 @@ class Notebook(object):
         """
         S = self.__storage
         W = self.get_worksheet_with_filename(worksheet_filename)
-        S.save_worksheet(W)
+        self.save_worksheet(W)
         username = W.owner()
         id_number = W.id_number()
         S.export_worksheet(username, id_number, output_filename, title=title)
 
+    def export_worksheet_stream(self, worksheet_filename, title=None,
+                                compression=None):
+        """
+        Export a worksheet, returning an iterator over the contents of
+        the sws file, which is produced while it is read; e.g., to
+        send it to the browser without writing it to disk first.
+
+        INPUT:
+
+            -  ``worksheet_filename`` - a string e.g., 'username/id_number'
+
+            - ``title`` - title to use for the exported worksheet (if
+               None, just use current title)
+
+            - ``compression`` - 'bz2', 'gz', 'none' or None (default),
+              which means the ``sws_compression`` server option
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Test', 'admin')
+            sage: sws = ''.join(nb.export_worksheet_stream(W.filename()))
+            sage: sws.startswith('BZh')
+            True
+        """
+        if compression is None:
+            compression = self.conf()['sws_compression']
+        W = self.get_worksheet_with_filename(worksheet_filename)
+        self.save_worksheet(W)
+        return self.__storage.export_worksheet_stream(
+            W.owner(), W.id_number(), title=title, compression=compression)
+
     def worksheet(self, username, id_number=None):
         """
         Create a new worksheet with given id_number belonging to the
@@ -799,7 +1010,7 @@ class Notebook(object):
         ws[new_key] = W
         del ws[old_key]
 
-    def import_worksheet(self, filename, owner):
+    def import_worksheet(self, filename, owner, fileobj=None):
         r"""
         Import a worksheet with the given ``filename`` and set its
         ``owner``.  If the file extension is not recognized, raise a
@@ -811,6 +1022,10 @@ class Notebook(object):
 
         -  ``owner`` - a string
 
+        -  ``fileobj`` - a file object or None (default); if given, an
+           sws file is read from it instead of from ``filename``,
+           which then only tells the format
+
         OUTPUT:
 
         -  ``worksheet`` - a newly created Worksheet instance
@@ -835,17 +1050,20 @@ class Notebook(object):
             sage: W.cell_list()
             [TextCell 0: foo, Cell 1: in=2+3, out=]
         """
-        if not os.path.exists(filename):
-            raise ValueError("no file %s" % filename)
-
         # Figure out the file extension
         ext = os.path.splitext(filename)[1]
+        if fileobj is not None:
+            if ext.lower() != '.sws':
+                raise ValueError("only sws files can be imported from a file object")
+        elif not os.path.exists(filename):
+            raise ValueError("no file %s" % filename)
+
         if ext.lower() == '.txt':
             # A plain text file with {{{'s that defines a worksheet (no graphics).
             W = self._import_worksheet_txt(filename, owner)
         elif ext.lower() == '.sws':
             # An sws file (really a tar.bz2) which defines a worksheet with graphics, etc.
-            W = self._import_worksheet_sws(filename, owner)
+            W = self._import_worksheet_sws(filename if fileobj is None else fileobj, owner)
         elif ext.lower() == '.html':
             # An html file, which should contain the static version of
             # a sage help page, as generated by Sphinx
@@ -917,7 +1135,8 @@ class Notebook(object):
         INPUT:
 
         - ``filename`` - a string; a filename that ends in .sws;
-           internally it must be a tar'd bz2'd file.
+           internally it must be a tar file, usually bz2 compressed.
+           May also be a file object.
 
         - ``username`` - a string
 
@@ -1265,20 +1484,84 @@ class Notebook(object):
     def quit(self):
         for W in self.__worksheets.values():
             W.quit()
+        try:
+            self.__process_pool.shutdown()
+        except AttributeError:
+            pass
+        try:
+            self.__idle_reaper.shutdown()
+        except AttributeError:
+            pass
+        try:
+            self.__server_scheduler.shutdown()
+        except AttributeError:
+            pass
 
     def update_worksheet_processes(self):
         worksheet.update_worksheets()
 
     def quit_idle_worksheet_processes(self):
-        timeout = self.conf()['idle_timeout']
-        doc_timeout = self.conf()['doc_timeout']
+        """
+        Quit the processes of the worksheets that are idle and return
+        the list of their filenames.  This is done by the thread of
+        the :meth:`idle_reaper` every time a worksheet may have become
+        idle, so there is usually no need to call this.
+        """
+        return self.idle_reaper().reap()
 
-        for W in self.__worksheets.values():
-            if W.compute_process_has_been_started():
-                if W.docbrowser():
-                    W.quit_if_idle(doc_timeout)
-                else:
-                    W.quit_if_idle(timeout)
+    def _idle_timeout(self, W):
+        """
+        Return the number of seconds after which the process of the
+        worksheet ``W`` is quit if the worksheet is not used.
+        """
+        if W.docbrowser():
+            return self.conf()['doc_timeout']
+        return self.conf()['idle_timeout']
+
+    def idle_reaper(self):
+        """
+        Return the :class:`~sagenb.notebook.idle_reaper.IdleReaper`
+        that watches the worksheets of this notebook whose process was
+        started.  Its thread is started by :meth:`start_idle_reaper`.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir()+'.sagenb')
+            sage: nb.idle_reaper()
+            Idle worksheet process reaper (0 worksheets)
+        """
+        try:
+            return self.__idle_reaper
+        except AttributeError:
+            from .idle_reaper import IdleReaper
+            self.__idle_reaper = IdleReaper(self._idle_timeout)
+            return self.__idle_reaper
+
+    def start_idle_reaper(self):
+        """
+        Start the thread that quits the processes of idle worksheets.
+        """
+        self.idle_reaper().start()
+
+    def evict_idle_worksheets(self):
+        """
+        Forget least recently used worksheets that are not in use, if
+        more of them are loaded than the server configuration allows
+        (see :meth:`WorksheetDict.evict`).
+        """
+        self.__worksheets.evict(max_entries=self.conf()['max_loaded_worksheets'],
+                                max_memory=self.conf()['max_loaded_worksheets_memory'] * 2**20)
+
+    def _can_evict(self, W):
+        """
+        Return True if the worksheet ``W`` may be forgotten, to be
+        loaded again from storage the next time it is accessed.
+        """
+        if W.owner() == '_sage_' or W.docbrowser():
+            # e.g., the scratch worksheet and live docs, which are
+            # referred to elsewhere and never saved
+            return False
+        return not W.compute_process_has_been_started()
 
     def quit_worksheet(self, W):
         try:
@@ -1289,27 +1572,115 @@ class Notebook(object):
     ##########################################################
     # Worksheet HTML generation
     ##########################################################
-    def worksheet_list_for_public(self, username, sort='last_edited', reverse=False, search=None):
-        W = self.users_worksheets('pub')
+    def worksheet_list_for_public(self, username, sort='last_edited', reverse=False, search=None,
+                                  offset=0, limit=None):
+        """
+        Return the published worksheets, sorted by ``sort``, starting
+        at ``offset`` and at most ``limit`` of them (default: all).
+        Without a search, only the worksheets on the requested page
+        are looked at.
 
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: for name in ['b', 'a', 'c']:
+            ....:     _ = nb.publish_worksheet(nb.create_new_worksheet(name, 'admin'), 'admin')
+            sage: [W.name() for W in nb.worksheet_list_for_public('admin', sort='name', offset=1, limit=1)]
+            [u'b']
+            sage: nb.public_worksheet_count()
+            3
+        """
         if search:
-            W = [x for x in W if x.satisfies_search(search)]
+            W = self.__storage.search_worksheets(self.users_worksheets('pub'), search)
+            sort_worksheet_list(W, sort, reverse)  # changed W in place
+            return W[offset:] if limit is None else W[offset:offset + limit]
 
-        sort_worksheet_list(W, sort, reverse)  # changed W in place
-        return W
+        W = self.__storage.worksheets_page('pub', sort, reverse, offset, limit)
+        # Use the worksheets that are already loaded, like users_worksheets.
+        return [self.__worksheets[w.filename()] if w.filename() in self.__worksheets else w for w in W]
 
-    def worksheet_list_for_user(self, user, typ="active", sort='last_edited', reverse=False, search=None):
-        X = self.get_worksheets_with_viewer(user)
+    def public_worksheet_count(self, search=None):
+        """
+        Return the number of published worksheets, or of those that
+        satisfy the given search.
+        """
+        if search:
+            return len(self.__storage.search_worksheets(self.users_worksheets('pub'), search))
+        return self.__storage.count_worksheets('pub')
+
+    def _listing_args(self, user, typ):
+        """
+        Return the arguments of
+        :meth:`~sagenb.storage.abstract_storage.Datastore.worksheets_for_user`
+        for the listing of type ``typ`` of the given user.
+
+        Loaded worksheets that changed since they were last saved
+        (e.g., worksheets moved to the trash) are saved first, so that
+        the listing, which is read from storage, sees them.
+        """
+        writer = self._writer()
+        for n, W in list(self.__worksheets.items()):
+            if not n.startswith('doc_browser') and not n.startswith('_sage_/') and W.is_dirty():
+                writer.write_now(W.filename(), *self._worksheet_snapshot(W))
         if typ == "trash":
-            W = [x for x in X if x.is_trashed(user)]
+            view = worksheet.TRASH
         elif typ == "active":
-            W = [x for x in X if x.is_active(user)]
+            view = worksheet.ACTIVE
         else: # typ must be archived
-            W = [x for x in X if not (x.is_trashed(user) or x.is_active(user))]
+            view = worksheet.ARCHIVED
+        if self._user_manager.user_is_admin(user):
+            owners = [u for u in self._user_manager.users() if u not in ['_sage_', 'pub']]
+            return user, view, owners, True
+        owners = set([user] + [owner for owner, id_number in
+                               self.user_manager().user(user).viewable_worksheets()])
+        return user, view, list(owners), False
+
+    def worksheet_list_for_user(self, user, typ="active", sort='last_edited', reverse=False, search=None,
+                                offset=0, limit=None):
+        """
+        Return the worksheets in the listing of type ``typ`` ('active',
+        'archived' or 'trash') of the given user, sorted by ``sort``,
+        starting at ``offset`` and at most ``limit`` of them (default:
+        all).  Without a search, only the worksheets on the requested
+        page are looked at.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: nb.user_manager().add_user('sage', 'sage', '', force=True)
+            sage: for name in ['b', 'a', 'c']:
+            ....:     _ = nb.create_new_worksheet(name, 'sage')
+            sage: [W.name() for W in nb.worksheet_list_for_user('sage', sort='name', limit=2)]
+            [u'a', u'b']
+            sage: nb.get_worksheet_with_filename('sage/0').move_to_trash('sage')
+            sage: [W.name() for W in nb.worksheet_list_for_user('sage', typ='trash')]
+            [u'b']
+            sage: nb.worksheet_count_for_user('sage')
+            2
+        """
+        args = self._listing_args(user, typ)
         if search:
-            W = [x for x in W if x.satisfies_search(search)]
-        sort_worksheet_list(W, sort, reverse)  # changed W in place
-        return W
+            W = self.__storage.worksheets_for_user(*args, sort=sort, reverse=reverse)
+            W = self.__storage.search_worksheets(W, search)
+            W = W[offset:] if limit is None else W[offset:offset + limit]
+        else:
+            W = self.__storage.worksheets_for_user(*args, sort=sort, reverse=reverse,
+                                                   offset=offset, limit=limit)
+        # Use the worksheets that are already loaded, like users_worksheets.
+        return [self.__worksheets[w.filename()] if w.filename() in self.__worksheets else w for w in W]
+
+    def worksheet_count_for_user(self, user, typ="active", search=None):
+        """
+        Return the number of worksheets in the listing of type ``typ``
+        of the given user, or of those that satisfy the given search.
+        """
+        args = self._listing_args(user, typ)
+        if search:
+            return len(self.__storage.search_worksheets(
+                self.__storage.worksheets_for_user(*args), search))
+        return self.__storage.count_worksheets_for_user(*args)
 
     ##########################################################
     # Revision history for a worksheet
@@ -1367,11 +1738,10 @@ class Notebook(object):
 
         - a string - the revision rendered as HTML
         """
-        t = time.time() - float(rev[:-4])
+        t = time.time() - ws.snapshot_time(rev)
         time_ago = prettify_time_ago(t)
 
-        filename = ws.get_snapshot_text_filename(rev)
-        txt = bz2.decompress(open(filename).read())
+        txt = ws.snapshot_text(rev)
         W = self.scratch_worksheet()
         W.set_name('Revision of ' + ws.name())
         W.delete_cells_directory()
@@ -1477,15 +1847,16 @@ class Notebook(object):
     
     def get_all_worksheets(self):
         """
+        Iterate over the worksheets of all users, one user at a time,
+        so that they are never all in memory at once.
+
         We should only call this if the user is admin!
         """
-        all_worksheets = []
-        for username in self._user_manager.users():
+        for username in list(self._user_manager.users()):
             if username in ['_sage_', 'pub']:
                 continue
             for w in self.users_worksheets(username):
-                all_worksheets.append(w)
-        return all_worksheets
+                yield w
 
     def get_worksheets_with_viewer(self, username):
         if self._user_manager.user_is_admin(username): return self.get_all_worksheets()
@@ -1516,24 +1887,99 @@ class Notebook(object):
     # Saving the whole notebook
     ###########################################################
 
-    def save(self):
+    def save(self, background=False):
         """
         Save this notebook server to disk.
+
+        Users and worksheets are copied while holding their locks,
+        which are released before the copies are written.  Worksheets
+        whose lock another thread holds are skipped, since that thread
+        may be waiting for a lock held by the caller (e.g., a request
+        for another worksheet that saves the notebook); they stay
+        dirty and are saved the next time.
+
+        INPUT:
+
+        - ``background`` -- bool (default: False); if True, only the
+          worksheets that changed since they were last saved are
+          copied, and the copies are written by a background thread,
+          so this does not wait for the disk.  Otherwise, everything
+          is written before this returns.
         """
         S = self.__storage
-        S.save_users(self.user_manager().users())
-        S.save_server_conf(self.conf())
-        self._user_manager.save(S)
+        writer = self._writer()
+        write = writer.submit if background else writer.write_now
+        U = self.user_manager()
+        with U.lock().read():
+            users = copy.deepcopy(U.users())
+        write('users', writer.next_number(), lambda: S.save_users(users))
+
+        def save_conf():
+            with U.lock().read():
+                S.save_server_conf(self.conf())
+                U.save(S)
+        write('conf', writer.next_number(), save_conf)
         # Save the non-doc-browser worksheets.
-        for n, W in self.__worksheets.items():
-            if not n.startswith('doc_browser'):
-                S.save_worksheet(W)
+        for n, W in list(self.__worksheets.items()):
+            if not n.startswith('doc_browser') and (W.is_dirty() or not background):
+                snapshot = self._worksheet_snapshot(W, blocking=False)
+                if snapshot is not None:
+                    write(W.filename(), *snapshot)
         if hasattr(self, '_user_history'):
-            for username, H in iteritems(self._user_history):
-                S.save_user_history(username, H)
+            for username, H in list(iteritems(self._user_history)):
+                write(('history', username), writer.next_number(),
+                      partial(S.save_user_history, username, list(H)))
+        if not background:
+            writer.flush()
 
     def save_worksheet(self, W, conf_only=False):
-        self.__storage.save_worksheet(W, conf_only=conf_only)
+        """
+        Save the worksheet ``W`` now.
+
+        INPUT:
+
+        - ``W`` -- a worksheet
+
+        - ``conf_only`` -- default: False; if True, only save
+          the config file, not the actual body of the worksheet
+        """
+        self._writer().write_now(W.filename(), *self._worksheet_snapshot(W, conf_only))
+
+    def _worksheet_snapshot(self, W, conf_only=False, blocking=True):
+        """
+        Return a pair ``(n, write)``, where ``write`` is a function
+        that saves the worksheet ``W`` as it is now and ``n`` is the
+        worksheet's :meth:`~sagenb.notebook.worksheet.Worksheet.dirty_number`.
+
+        If ``blocking`` is False and another thread holds the lock of
+        ``W``, return None instead.
+        """
+        lock = W.lock()
+        if not lock.acquire(blocking):
+            return None
+        try:
+            n = W.dirty_number()
+            write = self.__storage.worksheet_snapshot(W, conf_only=conf_only)
+        finally:
+            lock.release()
+
+        def save():
+            write()
+            if not conf_only:
+                W.mark_saved(n)
+        return n, save
+
+    def _writer(self):
+        """
+        Return the :class:`~sagenb.storage.background_writer.BackgroundWriter`
+        used to save this notebook.
+        """
+        try:
+            return self.__writer
+        except AttributeError:
+            from sagenb.storage.background_writer import BackgroundWriter
+            self.__writer = BackgroundWriter()
+            return self.__writer
 
     def logout(self, username):
         r"""
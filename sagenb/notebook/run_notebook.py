@@ -110,6 +110,11 @@ from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 
+# The app runs in the thread of the IOLoop, which must not wait for
+# the output of worksheets.
+import sagenb.flask_version.worksheet
+sagenb.flask_version.worksheet.CELL_UPDATES_MAX_WAITING = 0
+
 %(open_page)s
 wsgi_app = WSGIContainer(flask_app)
 http_server = HTTPServer(wsgi_app)
@@ -130,6 +135,11 @@ IOLoop.instance().start()
 class NotebookRunuWSGI(NotebookRun):
     name="uWSGI"
     uWSGI_NOTEBOOK_CONFIG  = """
+# Do not let requests wait for the output of worksheets in the few
+# threads of uWSGI.
+import sagenb.flask_version.worksheet
+sagenb.flask_version.worksheet.CELL_UPDATES_MAX_WAITING = 0
+
 import atexit
 from functools import partial
 atexit.register(partial(save_notebook,flask_base.notebook))
@@ -259,6 +269,10 @@ signal.signal(signal.SIGINT, my_sigint)
 
 from twisted.web import server
 from twisted.web.wsgi import WSGIResource
+# Add threads for the requests that wait for the output of worksheets
+# to the 10 threads of the pool, so that they do not hold up others.
+import sagenb.flask_version.worksheet
+reactor.suggestThreadPoolSize(10 + sagenb.flask_version.worksheet.CELL_UPDATES_MAX_WAITING)
 resource = WSGIResource(reactor, reactor.getThreadPool(), flask_app)
 
 class QuietSite(server.Site):
@@ -22,9 +22,14 @@ defaults = {'word_wrap_cols':72,
 
             'doc_pool_size':128,
 
+            'max_loaded_worksheets':0,  # 0 means no limit
+            'max_loaded_worksheets_memory':0, # MB; 0 means no limit
+
             'pub_interact':False,
 
             'server_pool':[],
+            'server_pool_policy':'least_loaded',
+            'server_pool_check_interval':60, # seconds; 0 means never
 
             'system':'sage',
 
@@ -32,6 +37,11 @@ defaults = {'word_wrap_cols':72,
 
             'ulimit':'',
 
+            'process_pool_size':0,      # idle worksheet processes kept
+            'process_pool_max_age':3600, # seconds
+
+            'sws_compression':'bz2',    # of exported worksheets
+
             'notification_recipients': None,
 
             'email':False,
@@ -102,6 +112,18 @@ defaults_descriptions = {
         TYPE : T_INTEGER,
         },
 
+    'max_loaded_worksheets': {
+        DESC : _('Maximum number of worksheets kept in memory (0 for no limit)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'max_loaded_worksheets_memory': {
+        DESC : _('Maximum memory used by worksheets kept in memory, in MB (0 for no limit)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
     'pub_interact': {
         DESC : _('Enable published interacts (EXPERIMENTAL; USE AT YOUR OWN RISK)'),
         GROUP : G_SERVER,
@@ -114,6 +136,19 @@ defaults_descriptions = {
         TYPE : T_LIST,
         },
 
+    'server_pool_policy': {
+        DESC : _('How to choose the worksheet process user for a new process'),
+        GROUP : G_SERVER,
+        TYPE : T_CHOICE,
+        CHOICES : ['least_loaded', 'round_robin', 'random'],
+        },
+
+    'server_pool_check_interval': {
+        DESC : _('Worksheet process user health check interval (seconds)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
     'system': {
         DESC : _('Default system'),
         GROUP : G_SERVER,
@@ -126,6 +161,25 @@ defaults_descriptions = {
         TYPE : T_STRING,
         },
 
+    'process_pool_size': {
+        DESC : _('Number of pre-started worksheet processes'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'process_pool_max_age': {
+        DESC : _('Maximum age of pre-started worksheet processes (seconds)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'sws_compression': {
+        DESC : _('Compression of downloaded worksheets (gz is faster, bz2 smaller)'),
+        GROUP : G_SERVER,
+        TYPE : T_CHOICE,
+        CHOICES : ['bz2', 'gz', 'none'],
+        },
+
     'model_version': {
         DESC : _('Model Version'),
         GROUP : G_SERVER,
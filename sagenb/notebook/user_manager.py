@@ -43,6 +43,32 @@ class UserManager(object):
             return False
         return True
 
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d.pop('_UserManager__lock', None)
+        return d
+
+    def lock(self):
+        """
+        Return the reader/writer lock protecting the users.  Request
+        handlers that change users hold it for writing; saving the
+        notebook holds it for reading while it copies the users.
+
+        EXAMPLES:
+            sage: from sagenb.notebook.user_manager import SimpleUserManager
+            sage: U = SimpleUserManager()
+            sage: U.lock()
+            Reader/writer lock 'users' (0 readers, no writer)
+            sage: U == loads(dumps(U))
+            True
+        """
+        try:
+            return self.__lock
+        except AttributeError:
+            from sagenb.misc.locking import RWLock
+            self.__lock = RWLock('users')
+            return self.__lock
+
     def user_list(self):
         """
         Returns a sorted list of the users that have logged into the notebook.
@@ -28,9 +28,8 @@ from six import iteritems
 
 # Import standard Python libraries that we will use below
 import base64
-import bz2
-import calendar
 import copy
+import hashlib
 import os
 import re
 import shutil
@@ -48,6 +47,8 @@ from sagenb.misc.misc import (cython, load, save, verbose, DOT_SAGENB,
 
 from sagenb.misc.remote_file import get_remote_file
 
+from sage.misc.temporary_file import atomic_write
+
 from sagenb.interfaces import (WorksheetProcess_ExpectImplementation,
                                WorksheetProcess_ReferenceImplementation,
                                WorksheetProcess_RemoteExpectImplementation)
@@ -56,7 +57,10 @@ import sagenb.misc.support  as support
 from sagenb.misc.format import relocate_future_imports
 
 # Imports specifically relevant to the sage notebook
-from .cell import Cell, TextCell
+from .cell import Cell, TextCell, MAX_OUTPUT, MAX_OUTPUT_LINES
+from .interact import INTERACT_TEXT
+from .lazy_cells import LazyCellList, Block
+from sagenb.storage.revision_store import RevisionStore
 from .template import template, clean_name, prettify_time_ago
 from flask.ext.babel import gettext, lazy_gettext
 _ = gettext
@@ -65,7 +69,8 @@ _ = gettext
 whitespace = re.compile('\s')  # Match any whitespace character
 non_whitespace = re.compile('\S')
 
-# The file to which the Sage code that will be evaluated is written.
+# The file to which the Sage code that was evaluated used to be
+# written; cell directories of old worksheets may still contain it.
 CODE_PY = "___code___.py"
 
 # Constants that control the behavior of the worksheet.
@@ -78,15 +83,6 @@ WARN_THRESHOLD = 100   # The number of seconds, so if there was no
                        # Used when multiple people are editing the
                        # same worksheet.
 
-# The strings used to synchronized the compute subprocesses.
-# WARNING:  If you make any changes to this, be sure to change the
-# error line below that looks like this:
-#         cmd += 'print("\\x01r\\x01e%s")' % self.synchro()
-SC         = '\x01'
-SAGE_BEGIN = SC + 'b'
-SAGE_END   = SC + 'e'
-SAGE_ERROR = SC + 'r'
-
 # Integers that define which folder this worksheet is in relative to a
 # given user.
 ARCHIVED = 0
@@ -238,6 +234,7 @@ class Worksheet(object):
         self.clear()
 
     def increase_state_number(self):
+        self.mark_dirty()
         if self.is_published() or self.docbrowser():
             return
 
@@ -431,6 +428,8 @@ class Worksheet(object):
             elif key == 'worksheet_that_was_published':
                 self.set_worksheet_that_was_published(value)
         self.create_directories()
+        # what was just loaded need not be saved
+        self.mark_saved(self.dirty_number())
 
     def __lt__(self, other):
         """
@@ -495,6 +494,84 @@ class Worksheet(object):
         """
         return len(self.cell_list())
 
+    def lock(self):
+        """
+        Return the lock of this worksheet.  It is held while a request
+        for this worksheet is handled and while a snapshot of the
+        worksheet is taken to save it.  The lock is reentrant, since
+        handling a request may save the notebook.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('test1', 'admin')
+            sage: W.lock()
+            Timed lock 'worksheet'
+            sage: W.lock() is W.lock()
+            True
+        """
+        try:
+            return self.__lock
+        except AttributeError:
+            import threading
+            from sagenb.misc.locking import TimedLock
+            self.__lock = TimedLock('worksheet', threading.RLock())
+            return self.__lock
+
+    def mark_dirty(self):
+        """
+        Record that this worksheet changed and has to be saved.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('test1', 'admin')
+            sage: W.is_dirty()
+            False
+            sage: W.set_name('test2')
+            sage: W.is_dirty()
+            True
+            sage: nb.save()
+            sage: W.is_dirty()
+            False
+        """
+        try:
+            self.__dirty_number += 1
+        except AttributeError:
+            self.__dirty_number = 1
+
+    def dirty_number(self):
+        """
+        Return the number of changes of this worksheet so far, which
+        is used to tell snapshots of the worksheet apart when saving.
+        """
+        try:
+            return self.__dirty_number
+        except AttributeError:
+            self.__dirty_number = 0
+            return 0
+
+    def mark_saved(self, dirty_number):
+        """
+        Record that the worksheet was saved as it was when
+        :meth:`dirty_number` returned ``dirty_number``.
+        """
+        try:
+            self.__saved_number = max(self.__saved_number, dirty_number)
+        except AttributeError:
+            self.__saved_number = dirty_number
+
+    def is_dirty(self):
+        """
+        Return True if this worksheet changed since it was last saved.
+        """
+        try:
+            return self.__saved_number < self.dirty_number()
+        except AttributeError:
+            return True
+
     def worksheet_html_filename(self):
         """
         Return path to the underlying plane text file that defines the
@@ -610,6 +687,7 @@ class Worksheet(object):
             sage: W.collaborators()
             ['hilbert', 'sage']
         """
+        self.mark_dirty()
         users = self.notebook().user_manager().users()
         owner = self.owner()
         collaborators = set([u for u in v if u in users and u != owner])
@@ -738,6 +816,7 @@ class Worksheet(object):
             sage: W.name()
             u'A renamed worksheet'
         """
+        self.mark_dirty()
         if len(name.strip()) == 0:
             name = gettext('Untitled')
         name = unicode_str(name)
@@ -785,9 +864,15 @@ class Worksheet(object):
             sage: W.filename()
             'admin/10'
         """
+        self.mark_dirty()
         old_filename = self.__filename
         self.__filename = filename
         self.__dir = os.path.join(self.notebook()._dir, filename)
+        try:
+            # it is in the old directory
+            del self.__revision_store
+        except AttributeError:
+            pass
         self.notebook().change_worksheet_key(old_filename, filename)
 
     def filename(self):
@@ -996,6 +1081,7 @@ class Worksheet(object):
             sage: W.system()
             'magma'
         """
+        self.mark_dirty()
         self.__system = system.strip()
 
     def pretty_print(self):
@@ -1056,6 +1142,7 @@ class Worksheet(object):
             sage: W.quit()
             sage: nb.delete()
         """
+        self.mark_dirty()
         if check == 'false':
             check = False
         else:
@@ -1113,6 +1200,7 @@ class Worksheet(object):
             sage: W.quit()
             sage: nb.delete()
         """
+        self.mark_dirty()
         self.__live_3D = check
 
     ##########################################################
@@ -1129,6 +1217,7 @@ class Worksheet(object):
             return False
 
     def set_auto_publish(self, x):
+        self.mark_dirty()
         self.__autopublish = x
 
     def is_published(self):
@@ -1195,7 +1284,11 @@ class Worksheet(object):
             sage: S.publisher()
             'admin'
         """
-        return self.worksheet_that_was_published().owner()
+        try:
+            # no need to load the published worksheet for its owner
+            return self.__worksheet_came_from[0]
+        except AttributeError:
+            return self.worksheet_that_was_published().owner()
 
     def is_publisher(self, username):
         """
@@ -1263,6 +1356,7 @@ class Worksheet(object):
             sage: W._Worksheet__published_version
             'pub/1'
         """
+        self.mark_dirty()
         self.__published_version = filename
 
     def published_version(self):
@@ -1316,6 +1410,7 @@ class Worksheet(object):
             sage: P.worksheet_that_was_published() is P
             True
         """
+        self.mark_dirty()
         if isinstance(W, tuple):
             self.__worksheet_came_from = W
         else:
@@ -1353,6 +1448,7 @@ class Worksheet(object):
             sage: W.ratings()
             [('hilbert', 3, 'this is great'), ('riemann', 0, 'this lacks content')]
         """
+        self.mark_dirty()
         r = self.ratings()
         x = int(x)
         for i in range(len(r)):
@@ -1576,6 +1672,7 @@ class Worksheet(object):
               list of tags, where a tag is a string or ARCHIVED,
               ACTIVE, TRASH.
         """
+        self.mark_dirty()
         d = {}
         for user, v in iteritems(tags):
             if len(v) >= 1:
@@ -1602,14 +1699,21 @@ class Worksheet(object):
             sage: W.set_user_view('admin', sagenb.notebook.worksheet.ARCHIVED)
             sage: W.user_view('admin') == sagenb.notebook.worksheet.ARCHIVED
             True
+
+        Setting the view it already has does not change the worksheet
+        (every request for a worksheet makes it active)::
+
+            sage: nb.save_worksheet(W)
+            sage: W.set_user_view('admin', sagenb.notebook.worksheet.ARCHIVED)
+            sage: W.is_dirty()
+            False
         """
         if not isinstance(user, (str, unicode)):
             raise TypeError("user (=%s) must be a string" % user)
-        try:
-            self.__user_view[user] = x
-        except (KeyError, AttributeError):
-            self.user_view(user)
-            self.__user_view[user] = x
+        if self.user_view(user) == x:
+            return
+        self.mark_dirty()
+        self.__user_view[user] = x
 
         # it is important to save the configuration and changing the
         # views, e.g., moving to trash, etc., since the user can't
@@ -1836,6 +1940,7 @@ class Worksheet(object):
         return self.owner() == username
 
     def set_owner(self, owner):
+        self.mark_dirty()
         self.__owner = owner
         if not owner in self.collaborators():
             self.__collaborators.append(owner)
@@ -1947,6 +2052,7 @@ class Worksheet(object):
 
             sage: nb.delete()
         """
+        self.mark_dirty()
         if user in self.collaborators():
             self.__collaborators.remove(user)
         if user in self.__viewers:
@@ -1980,6 +2086,7 @@ class Worksheet(object):
             sage: W.viewers()
             ['diophantus']
         """
+        self.mark_dirty()
         try:
             if not user in self.__viewers:
                 self.__viewers.append(user)
@@ -2006,6 +2113,7 @@ class Worksheet(object):
             sage: W.collaborators()
             ['diophantus']
         """
+        self.mark_dirty()
         try:
             if not user in self.__collaborators:
                 self.__collaborators.append(user)
@@ -2015,6 +2123,25 @@ class Worksheet(object):
     ##########################################################
     # Searching
     ##########################################################
+    def search_header(self):
+        """
+        Return the lower case owner, publisher and name of this
+        worksheet, separated by spaces.  Searches look for keywords in
+        this string followed by a space and the body of the worksheet.
+
+        OUTPUT:
+
+        - a unicode string
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: W = Worksheet('My Test', 0, tmp_dir(), owner='sageuser')
+            sage: W.search_header()
+            u'sageuser sageuser my test'
+        """
+        return u" ".join([unicode(x.lower()) for x in [self.owner(), self.publisher(), self.name()]])
+
     def satisfies_search(self, search):
         """
         Return True if all words in search are in the saved text of the
@@ -2038,8 +2165,7 @@ class Worksheet(object):
             contents = u' '
 
         try:
-            r = [unicode(x.lower()) for x in [self.owner(), self.publisher(), self.name(), contents]]
-            r = u" ".join(r)
+            r = self.search_header() + u" " + contents.lower()
         except UnicodeDecodeError as e:
             return False
 
@@ -2057,30 +2183,78 @@ class Worksheet(object):
     # Saving
     ##########################################################
     def save_snapshot(self, user, E=None):
+        r"""
+        Save the current text of this worksheet as a new revision.
+
+        INPUT:
+
+        - ``user`` - a string; who saves the revision
+
+        - ``E`` - a string or None (default); the text to save, by
+          default the worksheet's :meth:`edit_text`
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Test', 'admin')
+            sage: W.edit_save('{{{\n2+3\n}}}')
+            sage: W.save_snapshot('admin')
+            sage: W.edit_save('{{{\n2+5\n}}}')
+            sage: W.save_snapshot('admin')
+            sage: [key for desc, key in W.snapshot_data()]
+            ['1', '2']
+            sage: W.snapshot_text('1')
+            u'{{{id=0|\n2+3\n///\n}}}'
+            sage: nb.delete()
+        """
         if not self.body_is_loaded(): 
             return
-        self.uncache_snapshot_data()
-        path = self.snapshot_directory()
-        basename = str(int(time.time()))
-        filename = os.path.join(path, '%s.bz2' % basename)
+        body = self.body()
         if E is None:
-            E = self.edit_text()
-        worksheet_html = self.worksheet_html_filename()
-        open(filename, 'w').write(bz2.compress(E.encode('utf-8', 'ignore')))
-        open(worksheet_html, 'w').write(self.body().encode('utf-8', 'ignore'))
-        self.limit_snapshots()
-        try:
-            X = self.__saved_by_info
-        except AttributeError:
-            X = {}
-            self.__saved_by_info = X
-        X[basename] = user
+            E = body
+        self.revision_store().add(unicode_str(E), user)
+        data = body.encode('utf-8', 'ignore')
+        digest = hashlib.md5(data).digest()
+        if getattr(self, '_last_body', None) != digest:
+            # only write the body if it changed since it was last read
+            # or written, like the storage does
+            with atomic_write(self.worksheet_html_filename()) as f:
+                f.write(data)
+            self._last_body = digest
         if self.is_auto_publish():
             self.notebook().publish_worksheet(self, user)
 
-    def get_snapshot_text_filename(self, name):
-        path = self.snapshot_directory()
-        return os.path.join(path, name)
+    def revision_store(self):
+        """
+        Return the :class:`~sagenb.storage.revision_store.RevisionStore`
+        holding the snapshots of this worksheet.
+        """
+        try:
+            return self.__revision_store
+        except AttributeError:
+            try:
+                legacy_users = self.__saved_by_info
+            except AttributeError:
+                legacy_users = {}
+            self.__revision_store = RevisionStore(self.snapshot_directory(),
+                                                  legacy_users=legacy_users)
+            return self.__revision_store
+
+    def snapshot_text(self, key):
+        """
+        Return the text of the revision with the given key, as listed
+        by :meth:`snapshot_data`.
+
+        Raise a KeyError if there is no such revision.
+        """
+        return self.revision_store().text(key)
+
+    def snapshot_time(self, key):
+        """
+        Return the time the revision with the given key was saved.
+        """
+        return self.revision_store().time(key)
 
     def user_autosave_interval(self, username):
         return self.notebook().user(username)['autosave_interval']
@@ -2098,45 +2272,27 @@ class Worksheet(object):
             self.save_snapshot(username)
 
     def revert_to_snapshot(self, name):
-        path = self.snapshot_directory()
-        filename = os.path.join(path, '%s.txt' % name)
-        E = bz2.decompress(open(filename).read())
-        self.edit_save(E)
-
-    def _saved_by_info(self, x, username=None):
-        try:
-            u = self.__saved_by_info[x]
-            return u
-        except (KeyError, AttributeError):
-            return ''
+        self.edit_save(self.snapshot_text(name))
 
     def snapshot_data(self):
-        try:
-            self.__filenames
-        except AttributeError:
-            filenames = os.listdir(self.snapshot_directory())
-            filenames.sort()
-            self.__filenames = filenames
+        """
+        Return a list of pairs (description, key) for the revisions
+        of this worksheet, oldest first; the description says how long
+        ago and by whom the revision was saved.
+        """
         t = time.time()
         v = []
-        for x in self.__filenames:
-            base = os.path.splitext(x)[0]
-            if self._saved_by_info(x):
+        for key, saved, user in self.revision_store().revisions():
+            if user:
                 v.append((_('%(t)s ago by %(le)s',) %
-                            {'t': prettify_time_ago(t - float(base)),
-                             'le': self._saved_by_info(base)},
-                          x))
+                            {'t': prettify_time_ago(t - saved),
+                             'le': user},
+                          key))
             else:
-                v.append((_('%(seconds)s ago', seconds=prettify_time_ago(t - float(base))),
-                          x))
+                v.append((_('%(seconds)s ago', seconds=prettify_time_ago(t - saved)),
+                          key))
         return v
 
-    def uncache_snapshot_data(self):
-        try:
-            del self.__snapshot_data
-        except AttributeError:
-            pass
-
     def revert_to_last_saved_state(self):
         filename = self.worksheet_html_filename()
         if os.path.exists(filename):
@@ -2152,31 +2308,6 @@ class Worksheet(object):
             os.makedirs(path)
         return path
 
-    def limit_snapshots(self):
-        r"""
-        This routine will limit the number of snapshots of a worksheet,
-        as specified by a hard-coded value below.
-
-        Prior behavior was to allow unlimited numbers of snapshots and
-        so this routine will not delete files created prior to this change.
-
-        This assumes snapshot names correspond to the ``time.time()``
-        method used to create base filenames in seconds in UTC time,
-        and that there are no other extraneous files in the directory.
-        """
-
-        # This should be user-configurable with an option like 'max_snapshots'
-        max_snaps = 30
-        amnesty = int(calendar.timegm(time.strptime("01 May 2009", "%d %b %Y")))
-
-        path = self.snapshot_directory()
-        snapshots = os.listdir(path)
-        snapshots.sort()
-        for i in range(len(snapshots) - max_snaps):
-            creation = int(os.path.splitext(snapshots[i])[0])
-            if creation > amnesty:
-                os.remove(os.path.join(path, snapshots[i]))
-
     ##########################################################
     # Exporting the worksheet in plain text command-line format
     ##########################################################
@@ -2217,14 +2348,18 @@ class Worksheet(object):
             -- ``string`` -- Plain text representation of the body of
                the worksheet.
         """
-        s = ''
-        for C in self.cell_list():
-            t = C.edit_text().strip()
+        cells = self.cell_list()
+        s = []
+        for i in range(len(cells)):
+            t = cells.block_text(i)
+            if t is None:
+                t = cells[i].edit_text().strip()
             if t: 
-                s += '\n\n' + t
-        return s
+                s.append('\n\n' + t)
+        return ''.join(s)
 
     def set_body(self, body):
+        self.mark_dirty()
         self.edit_save(body)
 
     def body_is_loaded(self):
@@ -2237,6 +2372,30 @@ class Worksheet(object):
         except AttributeError:
             return False
 
+    def memory_size(self):
+        """
+        Return a rough estimate of the memory used by the cells of
+        this worksheet, namely the number of characters of their
+        input and output, or 0 if the body is not loaded.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('test1', 'admin')
+            sage: W.edit_save('{{{\n2+3\n///\n5\n}}}')
+            sage: W.memory_size() > 0
+            True
+        """
+        if not self.body_is_loaded():
+            return 0
+        cells = self.cell_list()
+        n = cells.pending_size()
+        for C in cells.created_cells():
+            for a in ['_in', '_out', '_out_html', '_text']:
+                n += len(getattr(C, a, ''))
+        return n
+
     def edit_text(self):
         """
         Returns a plain-text version of the worksheet with {{{}}}
@@ -2334,6 +2493,7 @@ class Worksheet(object):
             sage: W.next_id()
             3
         """
+        self.mark_dirty()
         # Clear any caching.
         try:
             del self.__html
@@ -2344,61 +2504,27 @@ class Worksheet(object):
 
         text.replace('\r\n', '\n')
 
-        data = []
-        while True:
-            plain_text = extract_text_before_first_compute_cell(text).strip()
-            if len(plain_text) > 0:
-                T = plain_text
-                data.append(('plain', T))
-            try:
-                meta, input, output, i = extract_first_compute_cell(text)
-                data.append(('compute', (meta, input, output)))
-            except EOFError as msg:
-                # print(msg) # -- don't print msg, just outputs a blank
-                #                 line every time, which makes for an
-                #                 ugly and unprofessional log.
-                break
-            text = text[i:]
-
-        ids = set([x[0]['id'] for typ, x in data if typ == 'compute' and  'id' in x[0]])
-        used_ids = set([])
-
         cells = []
-        for typ, T in data:
+        for id, typ, T in worksheet_text_cells(text, ignore_ids):
             if typ == 'plain':
-                if len(T) > 0:
-                    id = next_available_id(ids)
-                    ids.add(id)
-                    cells.append(self._new_text_cell(T, id=id))
-                    used_ids.add(id)
-            elif typ == 'compute':
-                meta, input, output = T
-                if not ignore_ids and 'id' in meta:
-                    id = meta['id']
-                    if id in used_ids:
-                        # In this case don't reuse, since ids must be unique.
-                        id = next_available_id(ids)
-                        ids.add(id)
-                    html = True
-                else:
-                    id = next_available_id(ids)
-                    ids.add(id)
-                    html = False
-                used_ids.add(id)
-                try:
-                    self.__cells
-                    C = self.get_cell_with_id(id = id)
-                    if C.is_text_cell():
-                        C = self._new_cell(id)
-                except AttributeError:
+                cells.append(self._new_text_cell(T, id=id))
+                continue
+            meta, input, output = T
+            try:
+                self.__cells
+                C = self.get_cell_with_id(id = id)
+                if C.is_text_cell():
                     C = self._new_cell(id)
-                C.set_input_text(input)
-                C.set_output_text(output, '')
-                if html:
-                    C.update_html_output(output)
-                cells.append(C)
-
-        self.__cells = cells
+            except AttributeError:
+                C = self._new_cell(id)
+            C.set_input_text(input)
+            C.set_output_text(output, '')
+            if not ignore_ids and 'id' in meta:
+                C.update_html_output(output)
+            cells.append(C)
+
+        self.__cells = LazyCellList(cells)
+        self._index_cells()
         # Set the next id.  This *depends* on self.cell_list() being
         # set!!
         self.set_cell_counter()
@@ -2577,6 +2703,7 @@ class Worksheet(object):
             return self.owner()
 
     def record_edit(self, user):
+        self.mark_dirty()
         self.__last_edited = (time.time(), user)
         self.__date_edited = (time.localtime(), user)
         self.autosave(user)
@@ -2661,7 +2788,7 @@ class Worksheet(object):
             sage: W.cell_id_list()
             [0, 10]
         """
-        return [C.id() for C in self.cell_list()]
+        return self.cell_list().ids()
 
     def compute_cell_id_list(self):
         """
@@ -2671,7 +2798,8 @@ class Worksheet(object):
 
         - a new list of integers and/or strings
         """
-        return [C.id() for C in self.cell_list() if C.is_compute_cell()]
+        cells = self.cell_list()
+        return [cells.id(i) for i in range(len(cells)) if cells.is_compute_cell(i)]
 
     def onload_id_list(self):
         """
@@ -2699,7 +2827,9 @@ class Worksheet(object):
         .. note::
 
            This function loads the cell list from disk (the file
-           worksheet.html) if it isn't available in memory.
+           worksheet.html) if it isn't available in memory.  The
+           cells are only created when they are accessed, see
+           :class:`~sagenb.notebook.lazy_cells.LazyCellList`.
 
         EXAMPLES::
 
@@ -2721,11 +2851,76 @@ class Worksheet(object):
             # load from disk
             worksheet_html = self.worksheet_html_filename()
             if not os.path.exists(worksheet_html):
-                self.__cells = []
+                self.__cells = LazyCellList()
             else:
-                self.set_body(open(worksheet_html).read())
+                text = open(worksheet_html).read()
+                self._load_body(text)
+                # so that the storage does not write it back unchanged
+                self._last_body = hashlib.md5(text).digest()
             return self.__cells
 
+    def _load_body(self, text):
+        r"""
+        Set the cells of this worksheet to those in ``text``, the body
+        of the worksheet as saved in ``worksheet.html``, like
+        :meth:`edit_save`, but without creating the cells until they
+        are accessed.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Test', 'admin')
+            sage: W._load_body('{{{id=0|\n2+3\n///\n5\n}}}\n\n<p>text</p>')
+            sage: W.cell_id_list(), W.cell_list().loaded()
+            ([0, 1, 2], 1)
+            sage: W.body()
+            u'\n\n{{{id=0|\n2+3\n///\n5\n}}}\n\n<p>text</p>\n\n{{{id=2|\n\n///\n}}}'
+            sage: W.cell_list()[0]
+            Cell 0: in=2+3, out=
+            5
+        """
+        try:
+            del self.__html
+        except AttributeError:
+            pass
+        self.reset_interact_state()
+
+        text = unicode_str(text)
+        blocks = []
+        for id, typ, T, start, end in _numbered_text_blocks(text):
+            if typ == 'plain':
+                verbatim = True
+            else:
+                meta, input, output = T
+                verbatim = text[start:end].strip() == _saved_cell_text(id, input, output)
+            blocks.append(Block(id, typ, start, end, verbatim))
+        self.__cells = LazyCellList(blocks, text, self._make_cell)
+        self._index_cells()
+        self.set_cell_counter()
+
+        # There must be at least one cell.
+        cells = self.__cells
+        if len(cells) == 0 or not cells.is_compute_cell(-1):
+            self.append_new_cell()
+
+    def _make_cell(self, text, block):
+        """
+        Create the cell for the :class:`~sagenb.notebook.lazy_cells.Block`
+        ``block`` of the body ``text`` loaded by :meth:`_load_body`.
+        """
+        if block.typ == 'plain':
+            return self._new_text_cell(text[block.start:block.end].strip(), id=block.id)
+        meta, input, output, end = _compute_cell_at(text, block.start)
+        C = self._new_cell(block.id)
+        C.set_input_text(input)
+        C.set_output_text(output, '')
+        if 'id' in meta:
+            C.update_html_output(output)
+        if not self.is_published() and C.is_interactive_cell():
+            C.delete_output()
+        return C
+
     def compute_cell_list(self):
         r"""
         Returns a list of this worksheet's compute cells.
@@ -2771,8 +2966,9 @@ class Worksheet(object):
             sage: W
             admin/0: [Cell 1: in=, out=, Cell 2: in=, out=]
         """
+        self.mark_dirty()
         C = self._new_cell()
-        self.cell_list().append(C)
+        self.append(C)
         return C
 
     def new_cell_before(self, id, input=''):
@@ -2791,15 +2987,8 @@ class Worksheet(object):
 
         - a new :class:`sagenb.notebook.cell.Cell` instance
         """
-        cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_cell(input=input)
-                cells.insert(i, C)
-                return C
-        C = self._new_cell(input=input)
-        cells.append(C)
-        return C
+        self.mark_dirty()
+        return self._insert_cell(self._new_cell(input=input), id, 0)
 
     def new_text_cell_before(self, id, input=''):
         """
@@ -2818,15 +3007,8 @@ class Worksheet(object):
 
         - a new :class:`sagenb.notebook.cell.TextCell` instance
         """
-        cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_text_cell(plain_text=input)
-                cells.insert(i, C)
-                return C
-        C = self._new_text_cell(plain_text=input)
-        cells.append(C)
-        return C
+        self.mark_dirty()
+        return self._insert_cell(self._new_text_cell(plain_text=input), id, 0)
 
     def new_cell_after(self, id, input=''):
         """
@@ -2844,15 +3026,8 @@ class Worksheet(object):
 
         - a new :class:`sagenb.notebook.cell.Cell` instance
         """
-        cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_cell(input=input)
-                cells.insert(i + 1, C)
-                return C
-        C = self._new_cell(input=input)
-        cells.append(C)
-        return C
+        self.mark_dirty()
+        return self._insert_cell(self._new_cell(input=input), id, 1)
 
     def new_text_cell_after(self, id, input=''):
         """
@@ -2870,15 +3045,8 @@ class Worksheet(object):
 
         - a new :class:`sagenb.notebook.cell.TextCell` instance
         """
-        cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_text_cell(plain_text=input)
-                cells.insert(i + 1, C)
-                return C
-        C = self._new_text_cell(plain_text=input)
-        cells.append(C)
-        return C
+        self.mark_dirty()
+        return self._insert_cell(self._new_text_cell(plain_text=input), id, 1)
 
     def delete_cell_with_id(self, id):
         r"""
@@ -2918,25 +3086,25 @@ class Worksheet(object):
             sage: W.cell_id_list()
             ['foo', 'dont_delete_me']
         """
+        self.mark_dirty()
         cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-
-                # Delete this cell from the queued up calculation list:
-                C = cells[i]
-                if C in self.__queue and self.__queue[0] != C:
-                    self.__queue.remove(C)
-
-                # Delete the cell's output.
-                C.delete_output()
+        i = self.cell_position(id)
+        if i is not None:
+            # Delete this cell from the queued up calculation list:
+            C = cells[i]
+            if C.id() in self.__queue_ids and self.__queue[0] != C:
+                self.__queue.remove(C)
+                self.__queue_ids.discard(C.id())
+
+            # Delete the cell's output.
+            C.delete_output()
 
-                # Delete this cell from the list of cells in this worksheet:
-                del cells[i]
+            # Delete this cell from the list of cells in this worksheet:
+            del cells[i]
+            self._index_cells(i)
 
-                if i > 0:
-                    return cells[i - 1].id()
-                else:
-                    break
+            if i > 0:
+                return cells[i - 1].id()
         return cells[0].id()
 
     ##########################################################
@@ -2945,7 +3113,8 @@ class Worksheet(object):
     def clear(self):
         self.__comp_is_running = False
         self.__queue = []
-        self.__cells = []
+        self.__queue_ids = set()
+        self.__cells = LazyCellList()
         for i in range(INITIAL_NUM_CELLS):
             self.append_new_cell()
 
@@ -2962,6 +3131,7 @@ class Worksheet(object):
     def set_not_computing(self):
         self.__comp_is_running = False
         self.__queue = []
+        self.__queue_ids = set()
 
     def quit(self):
         try:
@@ -2978,6 +3148,12 @@ class Worksheet(object):
         except Exception as msg:
             print(msg)
             print("WARNING: Error deleting Sage object!")
+        try:
+            all_worksheet_processes.remove(S)
+        except ValueError:
+            pass
+        self.notebook().idle_reaper().discard(self)
+        self.notebook().server_scheduler().release(S)
 
         try:
             os.kill(pid, 9)
@@ -2992,11 +3168,8 @@ class Worksheet(object):
         del self.__cells
 
         import shutil
-        for cell in self.cell_list():
-            try:
-                dir = cell._directory_name()
-            except AttributeError:
-                continue
+        for id in self.compute_cell_id_list():
+            dir = os.path.join(self.directory(), 'cells', str(id))
             if os.path.exists(dir) and not os.listdir(dir):
                 shutil.rmtree(dir, ignore_errors=True)
         self.notebook().quit_worksheet(self)
@@ -3010,6 +3183,32 @@ class Worksheet(object):
         self.__next_block_id = i
         return i
 
+    def output_generation(self):
+        """
+        Return a number that changes whenever the compute process of
+        this worksheet produces output.  See
+        :meth:`~sagenb.interfaces.worksheet_process.WorksheetProcess.output_generation`.
+        """
+        try:
+            return self.__sage.output_generation()
+        except AttributeError:
+            return 0
+
+    def wait_for_output(self, generation, timeout):
+        """
+        Wait at most ``timeout`` seconds until the compute process of
+        this worksheet produces output, i.e., until
+        :meth:`output_generation` is different from ``generation``,
+        and return the new generation.
+
+        This should be called without holding the worksheet's lock.
+        """
+        try:
+            S = self.__sage
+        except AttributeError:
+            return 0
+        return S.wait_for_output(generation, timeout)
+
     def compute_process_has_been_started(self):
         """
         Return True precisely if the compute process has been started,
@@ -3100,6 +3299,7 @@ except (KeyError, IOError):
             pass
         self.__sage = self.notebook().new_worksheet_process()
         all_worksheet_processes.append(self.__sage)
+        self.notebook().idle_reaper().add(self)
         self.__next_block_id = 0
         
         # make sure we have a __sage attribute
@@ -3209,7 +3409,7 @@ except (KeyError, IOError):
                     v = [w for w in t.split('\n') if w]
                     t = '\n'.join(['Syntax Error:'] + v[0:-1])
                 C.set_output_text(t, '')
-                del self.__queue[0]
+                self._dequeue()
                 return
             except ValueError:
                 pass
@@ -3250,7 +3450,7 @@ except (KeyError, IOError):
 
         if C.interrupted():
             self.__comp_is_running = False
-            del self.__queue[0]
+            self._dequeue()
             return 'd', C
 
         try:
@@ -3262,6 +3462,7 @@ except (KeyError, IOError):
             return 'w', C
 
         out = self.postprocess_output(output_status.output, C)
+        self.mark_dirty()
 
         if not output_status.done:
             # Still computing
@@ -3307,7 +3508,7 @@ except (KeyError, IOError):
 
         # Finished a computation.
         self.__comp_is_running = False
-        del self.__queue[0]
+        self._dequeue()
 
         if C.is_no_output():
             # Clean up the temp directories associated to C, and do
@@ -3430,11 +3631,19 @@ except (KeyError, IOError):
         else:
             return True
         
+    def _dequeue(self):
+        """
+        Remove the first cell from the queue of cells to compute.
+        """
+        C = self.__queue.pop(0)
+        self.__queue_ids.discard(C.id())
+
     def clear_queue(self):
         # empty the queue
         for C in self.__queue:
             C.interrupt()
         self.__queue = []
+        self.__queue_ids = set()
         self.__comp_is_running = False
 
     def restart_sage(self):
@@ -3517,6 +3726,7 @@ except (KeyError, IOError):
            "asap" cells.  Otherwise, ``C`` goes at the end of the
            queue.
         """
+        self.mark_dirty()
         if self.is_published():
             return
         self._record_that_we_are_computing(username)
@@ -3526,7 +3736,7 @@ except (KeyError, IOError):
             raise ValueError("C must be have self as worksheet.")
 
         # Now enqueue the requested cell.
-        if not (C in self.__queue):
+        if C.id() not in self.__queue_ids:
             if C.is_asap():
                 if self.computing():
                     i = 1
@@ -3537,6 +3747,7 @@ except (KeyError, IOError):
                 self.__queue.insert(i, C)
             else:
                 self.__queue.append(C)
+            self.__queue_ids.add(C.id())
         self.start_next_comp()
 
     def _enqueue_auto_cells(self):
@@ -3552,7 +3763,7 @@ except (KeyError, IOError):
             return self.__next_id
 
     def set_cell_counter(self):
-        self.__next_id = 1 + max([C.id() for C in self.cell_list() if isinstance(C.id(), int)] + [-1])
+        self.__next_id = 1 + max([id for id in self.cell_list().ids() if isinstance(id, int)] + [-1])
 
     def _new_text_cell(self, plain_text, id=None):
         if id is None:
@@ -3579,19 +3790,110 @@ except (KeyError, IOError):
         return Cell(id, input, '', self)
 
     def append(self, L):
-        self.cell_list().append(L)
+        cells = self.cell_list()
+        cells.append(L)
+        self._index_cells(len(cells) - 1)
+
+    def _insert_cell(self, C, id, offset):
+        """
+        Insert the cell ``C`` before (if ``offset`` is 0) or after (if
+        ``offset`` is 1) the cell with the given ID, or at the end if
+        there is no such cell, and return ``C``.
+        """
+        i = self.cell_position(id)
+        if i is None:
+            self.append(C)
+        else:
+            self.cell_list().insert(i + offset, C)
+            self._index_cells(i + offset)
+        return C
 
     ##########################################################
     # Accessing existing cells
     ##########################################################
+    def _index_cells(self, start=0):
+        """
+        Update the map from cell IDs to positions in :meth:`cell_list`
+        for the cells from position ``start`` on, e.g., after a cell
+        was inserted or deleted there, and return the map.
+        """
+        cells = self.cell_list()
+        try:
+            index = self.__cell_index
+            if self.__cell_index_list is not cells:
+                start = 0
+        except AttributeError:
+            start = 0
+        if start == 0:
+            index = {}
+        else:
+            for id in [id for id, i in iteritems(index) if i >= start]:
+                del index[id]
+        for i in range(start, len(cells)):
+            # like a linear search, the first cell with an ID wins
+            index.setdefault(cells.id(i), i)
+        self.__cell_index = index
+        self.__cell_index_list = cells
+        self.__cell_index_length = len(cells)
+        return index
+
+    def cell_position(self, id):
+        """
+        Return the position in :meth:`cell_list` of the cell with the
+        given ID, or None if there is no such cell.
+
+        The positions are kept in a dictionary, which is rebuilt if the
+        cell list was replaced or changed length without this
+        worksheet knowing, e.g., through ``W.cell_list().pop()``.
+
+        INPUT:
+
+        - ``id`` - an integer or a string; the ID of the cell to find
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Test', 'admin')
+            sage: W.edit_save('{{{id=foo|\n2+3\n///\n5\n}}}\n{{{id=9|\n2+8\n///\n10\n}}}')
+            sage: W.cell_position(9), W.cell_position('foo'), W.cell_position('bar')
+            (1, 0, None)
+            sage: W.new_cell_before(9)
+            Cell 10: in=, out=
+            sage: W.cell_position(9), W.cell_position(10)
+            (2, 1)
+            sage: W.delete_cell_with_id('foo')
+            10
+            sage: W.cell_position(9), W.cell_position('foo')
+            (1, None)
+            sage: W.cell_list().pop()
+            Cell 9: in=2+8, out=
+            10
+            sage: W.cell_position(9)
+        """
+        cells = self.cell_list()
+        try:
+            if (self.__cell_index_list is cells and
+                self.__cell_index_length == len(cells)):
+                index = self.__cell_index
+            else:
+                index = self._index_cells()
+        except AttributeError:
+            index = self._index_cells()
+        i = index.get(id)
+        if i is not None and cells.id(i) != id:
+            # the cells were rearranged behind our back
+            i = self._index_cells().get(id)
+        return i
+
     def get_cell_with_id_or_none(self, id):
         """
         Gets a pre-existing cell with this id, or returns None. 
         """
-        for c in self.cell_list():
-            if c.id() == id:
-                return c
-        return None
+        i = self.cell_position(id)
+        if i is None:
+            return None
+        return self.cell_list()[i]
         
     def get_cell_with_id(self, id):
         """
@@ -3599,20 +3901,6 @@ except (KeyError, IOError):
         """
         return self.get_cell_with_id_or_none(id) or self._new_cell(id)
 
-    def synchronize(self, s):
-        try:
-            i = (self.__synchro + 1)%65536
-        except AttributeError:
-            i = 0
-        self.__synchro = i
-        return 'print("%s%s")\n'%(SAGE_BEGIN,i) + s + '\nprint("%s%s")\n' % (SAGE_END, i)
-
-    def synchro(self):
-        try:
-            return self.__synchro
-        except AttributeError:
-            return 0
-
     def check_cell(self, id):
         """
         Checks the status of a given compute cell.
@@ -3629,7 +3917,7 @@ except (KeyError, IOError):
         """
         cell = self.get_cell_with_id(id)
 
-        if cell in self.__queue:
+        if cell.id() in self.__queue_ids:
             status = 'w'
         else:
             status = 'd'
@@ -3742,23 +4030,6 @@ except (KeyError, IOError):
         input = self.preparse(input)
         return input
 
-    def _strip_synchro_from_start_of_output(self, s):
-        z = SAGE_BEGIN + str(self.synchro())
-        i = s.find(z)
-        if i == -1:
-            # Did not find any synchronization info in the output
-            # stream.
-            j = s.find('Traceback')
-            if j != -1:
-                # Probably there was an error; better not hide it.
-                return s[j:]
-            else:
-                # Maybe we just read too early -- suppress displaying
-                # anything yet.
-                return ''
-        else:
-            return s[i + len(z):]
-
     def postprocess_output(self, out, C):
         if C.introspect():
             return out
@@ -3803,9 +4074,7 @@ except (KeyError, IOError):
 
             - a string
         """
-        # The extra newline below is necessary, since otherwise source
-        # code introspection doesn't include the last line.
-        return 'open("%s","w").write("# -*- coding: utf-8 -*-\\n" + _support_.preparse_worksheet_cell(base64.b64decode("%s"),globals())+"\\n"); execfile(os.path.abspath("%s"))'%(CODE_PY, base64.b64encode(s.encode('utf-8', 'ignore')), CODE_PY)
+        return '_support_.execute_worksheet_cell(base64.b64decode("%s"),globals())' % base64.b64encode(s.encode('utf-8', 'ignore'))
 
     ##########################################################
     # Loading and attaching files
@@ -4235,35 +4504,160 @@ def extract_first_compute_cell(text):
     i = text.find('{{{')
     if i == -1:
         raise EOFError
-    j = text[i:].find('\n')
-    if j == -1:
+    cell = _compute_cell_at(text, i)
+    if cell is None:
         raise EOFError
-    k = text[i:].find('|')
-    if k != -1 and k < j:
+    return cell
+
+def _compute_cell_at(text, i):
+    """
+    Return the tuple ``(meta, input, output, end)`` of
+    :func:`extract_first_compute_cell` for the compute cell starting
+    with the ``{{{`` at position ``i`` of ``text``, or None if the
+    line with the ``{{{`` is not terminated.
+
+    This only looks at the text of the cell, so that parsing all cells
+    of a worksheet takes time linear in its size.
+    """
+    j = text.find('\n', i)
+    if j == -1:
+        return None
+    k = text.find('|', i, j)
+    if k != -1:
         try:
-            meta = dictify(text[i + 3:i + k])
+            meta = dictify(text[i + 3:k])
         except TypeError:
             meta = {}
-        i += k + 1
+        i = k + 1
     else:
         meta = {}
         i += 3
 
-    j = text[i:].find('\n}}}')
+    j = text.find('\n}}}', i)
     if j == -1:
         j = len(text)
-    else:
-        j += i
-    k = text[i:].find('\n///')
-    if k == -1 or k + i > j:
+    k = text.find('\n///', i, j)
+    if k == -1:
         input = text[i:j]
         output = ''
     else:
-        input = text[i:i + k].strip()
-        output = text[i + k + 4:j]
+        input = text[i:k].strip()
+        output = text[k + 4:j]
 
     return meta, input.strip(), output, j + 4
 
+def _saved_cell_text(id, input, output):
+    """
+    Return the edit text of the compute cell with the given ID, input
+    and output that loading a worksheet creates, or None if this
+    cannot be told without creating the cell (for interacts and output
+    that gets truncated).
+    """
+    if 'interact' in input or INTERACT_TEXT in output:
+        return None
+    output = output.replace('\r', '')
+    if ('notruncate' not in output and 'Output truncated!' not in output and
+        (len(output) > MAX_OUTPUT or output.count('\n') > MAX_OUTPUT_LINES)):
+        return None
+    text = input.strip('\n') + '\n' + ('///\n' + output.strip('\n')).strip('\r\n')
+    return (u'{{{id=%s|\n%s\n}}}' % (id, text.rstrip('\n'))).strip()
+
+def parse_worksheet_text(text):
+    r"""
+    Iterate over the cells in the body of a worksheet in the format of
+    ``worksheet.html`` and of :meth:`Worksheet.edit_text`, in one pass
+    over the text.
+
+    OUTPUT: an iterator over pairs
+
+    - ``('plain', text)`` for a text cell, where ``text`` is the
+      stripped text between two compute cells (empty text is skipped)
+
+    - ``('compute', (meta, input, output))`` for a compute cell, as in
+      :func:`extract_first_compute_cell`
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.worksheet import parse_worksheet_text
+        sage: list(parse_worksheet_text('<p>hi</p>\n{{{id=3|\n2+3\n///\n5\n}}}\n{{{\n1\n}}}'))
+        [('plain', '<p>hi</p>'), ('compute', ({'id': 3}, '2+3', '5')), ('compute', ({}, '1', ''))]
+    """
+    for typ, T, start, end in _text_blocks(text):
+        yield typ, T
+
+def _text_blocks(text):
+    """
+    Like :func:`parse_worksheet_text`, but iterate over quadruples
+    ``(typ, T, start, end)``, where ``text[start:end]`` is the text of
+    the cell.
+    """
+    p = 0
+    while True:
+        i = text.find('{{{', p)
+        if i == -1:
+            i = len(text)
+        plain = text[p:i].strip()
+        if plain:
+            yield 'plain', plain, p, i
+        if i == len(text):
+            return
+        cell = _compute_cell_at(text, i)
+        if cell is None:
+            return
+        meta, input, output, end = cell
+        yield 'compute', (meta, input, output), i, min(end, len(text))
+        p = end
+
+def worksheet_text_cells(text, ignore_ids=False):
+    r"""
+    Return the cells in the body of a worksheet in the format of
+    ``worksheet.html``, with the ids they get when the worksheet is
+    loaded (see :meth:`Worksheet.edit_save`), without creating any
+    cell objects.
+
+    INPUT:
+
+    - ``text`` -- a string
+
+    - ``ignore_ids`` -- bool (default: False); whether to ignore the
+      ids of compute cells given in the text
+
+    OUTPUT: a list of triples ``(id, 'plain', text)`` and ``(id,
+    'compute', (meta, input, output))``, see
+    :func:`parse_worksheet_text`
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.worksheet import worksheet_text_cells
+        sage: worksheet_text_cells('{{{id=1|\n1\n}}}\ntext\n{{{id=1|\n2\n}}}\n{{{\n3\n}}}')
+        [(1, 'compute', ({'id': 1}, '1', '')), (0, 'plain', 'text'), (2, 'compute', ({'id': 1}, '2', '')), (3, 'compute', ({}, '3', ''))]
+        sage: [c[0] for c in worksheet_text_cells('{{{id=1|\n1\n}}}\n{{{id=1|\n2\n}}}', ignore_ids=True)]
+        [0, 2]
+    """
+    return [(id, typ, T) for id, typ, T, start, end in _numbered_text_blocks(text, ignore_ids)]
+
+def _numbered_text_blocks(text, ignore_ids=False):
+    """
+    Like :func:`worksheet_text_cells`, but return a list of tuples
+    ``(id, typ, T, start, end)`` as in :func:`_text_blocks`.
+    """
+    data = list(_text_blocks(text))
+    ids = set([x[0]['id'] for typ, x, start, end in data if typ == 'compute' and 'id' in x[0]])
+    new_id = available_ids(ids)
+    used_ids = set([])
+    cells = []
+    for typ, T, start, end in data:
+        if typ == 'compute' and not ignore_ids and 'id' in T[0]:
+            id = T[0]['id']
+            if id in used_ids:
+                # In this case don't reuse, since ids must be unique.
+                id = next(new_id)
+        else:
+            id = next(new_id)
+        used_ids.add(id)
+        cells.append((id, typ, T, start, end))
+    return cells
+
 def after_first_word(s):
     r"""
     Return everything after the first whitespace in the string s.
@@ -4397,6 +4791,31 @@ def next_available_id(v):
         i += 1
     return i
 
+def available_ids(v):
+    """
+    Iterate over the nonnegative integers not in the set ``v``, adding
+    each to ``v``.  Calling ``next`` repeatedly gives the same ids as
+    :func:`next_available_id` followed by adding the id to ``v``, if
+    nothing else is added to ``v`` meanwhile, but does not start
+    looking at 0 every time.
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.worksheet import available_ids
+        sage: v = set([0, 2])
+        sage: new_id = available_ids(v)
+        sage: next(new_id), next(new_id), next(new_id)
+        (1, 3, 4)
+        sage: sorted(v)
+        [0, 1, 2, 3, 4]
+    """
+    i = 0
+    while True:
+        while i in v:
+            i += 1
+        v.add(i)
+        yield i
+
 def convert_time_to_string(t):
     """
     Converts ``t`` (in Unix time) to a locale-specific string
@@ -88,6 +88,23 @@ class Datastore(object):
         """
         raise NotImplementedError        
 
+    def worksheet_snapshot(self, worksheet, conf_only=False):
+        """
+        Return a function that saves the worksheet as it is now, so
+        that the worksheet only has to be locked while the snapshot
+        is taken and not while it is written.  Datastores that cannot
+        separate the two just save the worksheet when the function is
+        called.
+
+        INPUT:
+
+            - ``worksheet`` -- a Sage worksheet
+
+            - ``conf_only`` -- default: False; if True, only save
+              the config file, not the actual body of the worksheet      
+        """
+        return lambda: self.save_worksheet(worksheet, conf_only=conf_only)
+
     def create_worksheet(self, username, id_number):
         """
         Create worksheet with given id_number belonging to the given user.
@@ -126,7 +143,39 @@ class Datastore(object):
         raise NotImplementedError        
 
 
-    def export_worksheet(self, username, id_number, filename, title):
+    def load_worksheet_from_index(self, username, id_number):
+        """
+        Return worksheet with given id_number belonging to the given
+        user, using cached metadata if the datastore keeps any.
+        Datastores without such a cache just load the worksheet.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_number`` -- integer
+
+        OUTPUT:
+
+            - a worksheet
+        """
+        return self.load_worksheet(username, id_number)
+
+    def delete_worksheet(self, username, id_number):
+        """
+        Delete all files associated with the worksheet with given
+        id_number belonging to the given user.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_number`` -- integer
+        """
+        raise NotImplementedError
+
+    def export_worksheet(self, username, id_number, filename, title,
+                         compression='bz2'):
         """
         Export the worksheet with given username and id_number to the
         given filename (e.g., 'worksheet.sws').
@@ -138,10 +187,25 @@ class Datastore(object):
         """
         raise NotImplementedError        
 
+    def export_worksheet_stream(self, username, id_number, title=None,
+                                compression='bz2'):
+        """
+        Return an iterator over the contents of an sws file holding the
+        worksheet with given username and id_number.
+
+        INPUT:
+
+            - ``title`` - title to use for the exported worksheet (if
+               None, just use current title)
+
+            - ``compression`` - 'bz2' (default), 'gz' or 'none'
+        """
+        raise NotImplementedError
+
     def import_worksheet(self, username, id_number, filename):
         """
         Input the worksheet username/id_number from the file with
-        given filename.
+        given filename, or from a file object.
         """
         raise NotImplementedError        
         
@@ -163,6 +227,65 @@ class Datastore(object):
         raise NotImplementedError        
 
         
+    def worksheets_page(self, username, sort='last_edited', reverse=False,
+                        offset=0, limit=None):
+        """
+        Return the worksheets of the given user, sorted like the
+        worksheet listings, starting at ``offset`` and at most
+        ``limit`` of them (default: all).
+
+        Datastores that can sort and count their worksheets without
+        loading all of them should override this and
+        :meth:`count_worksheets`.
+        """
+        from sagenb.notebook.notebook import sort_worksheet_list
+        v = self.worksheets(username)
+        sort_worksheet_list(v, sort, reverse)
+        return v[offset:] if limit is None else v[offset:offset + limit]
+
+    def count_worksheets(self, username):
+        """
+        Return the number of worksheets of the given user.
+        """
+        return len(self.worksheets(username))
+
+    def worksheets_for_user(self, username, view, owners, everyone=False,
+                            sort='last_edited', reverse=False, offset=0, limit=None):
+        """
+        Return the worksheets of the given owners that ``username``
+        has in the given view (ARCHIVED, ACTIVE or TRASH), sorted like
+        the worksheet listings, starting at ``offset`` and at most
+        ``limit`` of them (default: all).  Unless ``everyone`` is
+        True, only the worksheets that ``username`` owns, collaborates
+        on or views are listed.
+        """
+        from sagenb.notebook.notebook import sort_worksheet_list
+        v = [W for owner in owners for W in self.worksheets(owner)
+             if (everyone or W.owner() == username or W.is_collaborator(username)
+                 or W.is_only_viewer(username)) and W.user_view_is(username, view)]
+        sort_worksheet_list(v, sort, reverse)
+        return v[offset:] if limit is None else v[offset:offset + limit]
+
+    def count_worksheets_for_user(self, username, view, owners, everyone=False):
+        """
+        Return the number of worksheets in the listing of the given
+        user; the input is as for :meth:`worksheets_for_user`.
+        """
+        return len(self.worksheets_for_user(username, view, owners, everyone))
+
+    def search_worksheets(self, worksheets, search):
+        """
+        Return the list of those worksheets in the list ``worksheets``
+        that satisfy the given search, in the same order.
+
+        INPUT:
+
+            - ``worksheets`` -- list of worksheets
+
+            - ``search`` -- string; a search query
+        """
+        return [W for W in worksheets if W.satisfies_search(search)]
+
     def delete(self):
         """
         Delete all files associated with this datastore.  Dangerous!
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*
+"""
+Writing saved data in a background thread
+
+A :class:`BackgroundWriter` runs functions that write data to disk
+(usually returned by
+:meth:`~sagenb.storage.abstract_storage.Datastore.worksheet_snapshot`)
+in its own thread, so that the thread saving the notebook does not
+wait for the disk.  Every write has a key (e.g., the worksheet's
+filename) and a sequence number that increases with every change of
+the saved object.  If a write for a key is submitted while an older
+one for that key is still waiting, only the newer one is done, and a
+write older than one already done for its key is dropped, so a stale
+snapshot never overwrites a newer one.
+"""
+import threading
+
+
+class BackgroundWriter(object):
+    def __init__(self):
+        """
+        EXAMPLES::
+
+            sage: from sagenb.storage.background_writer import BackgroundWriter
+            sage: B = BackgroundWriter()
+            sage: L = []
+            sage: B.submit('a', 1, lambda: L.append(1))
+            True
+            sage: B.submit('a', 2, lambda: L.append(2))
+            True
+            sage: B.flush()
+            sage: L[-1]
+            2
+            sage: B.submit('a', 1, lambda: L.append(1))
+            False
+            sage: B
+            Background writer (0 pending)
+        """
+        self._cond = threading.Condition()
+        # key -> (sequence number, write function)
+        self._pending = {}
+        # keys of pending writes, oldest first
+        self._order = []
+        # keys being written right now
+        self._writing = set()
+        # key -> sequence number of the newest write done
+        self._written = {}
+        self._counter = 0
+        self._thread = None
+        self._stats = {'writes': 0, 'coalesced': 0, 'stale': 0, 'errors': 0}
+
+    def __repr__(self):
+        return "Background writer (%s pending)" % len(self._pending)
+
+    def next_number(self):
+        """
+        Return a new sequence number, for saved objects that do not
+        count their changes themselves.
+        """
+        with self._cond:
+            self._counter += 1
+            return self._counter
+
+    def stats(self):
+        """
+        Return a dictionary with the number of writes done, writes
+        replaced by newer ones before they were done, stale writes
+        dropped and failed writes.
+        """
+        with self._cond:
+            return dict(self._stats)
+
+    def _is_stale(self, key, seq):
+        return seq < self._written.get(key, seq)
+
+    def submit(self, key, seq, write):
+        """
+        Schedule the function ``write`` to be called in the background
+        thread.
+
+        INPUT:
+
+        - ``key`` -- hashable; identifies what is written
+
+        - ``seq`` -- sequence number of the data being written
+
+        - ``write`` -- function taking no arguments
+
+        OUTPUT:
+
+        - False if the write was dropped because a newer one for the
+          same key was already done or is waiting, True otherwise
+        """
+        with self._cond:
+            if self._is_stale(key, seq):
+                self._stats['stale'] += 1
+                return False
+            if key in self._pending:
+                if seq < self._pending[key][0]:
+                    self._stats['stale'] += 1
+                    return False
+                self._stats['coalesced'] += 1
+            else:
+                self._order.append(key)
+            self._pending[key] = (seq, write)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        return True
+
+    def write_now(self, key, seq, write):
+        """
+        Call the function ``write`` in the calling thread, after any
+        older write for the same key.
+
+        INPUT: the same as for :meth:`submit`
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.background_writer import BackgroundWriter
+            sage: B = BackgroundWriter()
+            sage: L = []
+            sage: B.write_now('a', 1, lambda: L.append(1))
+            sage: B.write_now('a', 0, lambda: L.append(0))
+            sage: L
+            [1]
+        """
+        with self._cond:
+            while key in self._writing:
+                self._cond.wait()
+            if self._is_stale(key, seq):
+                self._stats['stale'] += 1
+                return
+            writes = [(seq, write)]
+            if key in self._pending:
+                writes.append(self._pending.pop(key))
+                self._order.remove(key)
+            writes.sort(key=lambda x: x[0])
+            self._writing.add(key)
+        try:
+            for s, f in writes:
+                f()
+        finally:
+            with self._cond:
+                self._writing.discard(key)
+                self._written[key] = max(writes[-1][0], self._written.get(key, seq))
+                self._stats['writes'] += len(writes)
+                self._cond.notify_all()
+
+    def discard(self, key):
+        """
+        Drop the waiting write for ``key``, if any, and wait until a
+        write for it that already started is done; e.g., before the
+        files of a worksheet are deleted.
+        """
+        with self._cond:
+            if key in self._pending:
+                del self._pending[key]
+                self._order.remove(key)
+            while key in self._writing:
+                self._cond.wait()
+
+    def flush(self):
+        """
+        Wait until all submitted writes are done.
+        """
+        with self._cond:
+            while self._order or self._writing:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._order:
+                    self._cond.wait()
+                key = self._order.pop(0)
+                seq, write = self._pending.pop(key)
+                while key in self._writing:
+                    self._cond.wait()
+                if self._is_stale(key, seq):
+                    self._stats['stale'] += 1
+                    self._cond.notify_all()
+                    continue
+                self._writing.add(key)
+            try:
+                write()
+            except Exception as msg:
+                print("Error saving %s: %s" % (key, msg))
+                with self._cond:
+                    self._stats['errors'] += 1
+            finally:
+                with self._cond:
+                    self._writing.discard(key)
+                    self._written[key] = max(seq, self._written.get(key, seq))
+                    self._stats['writes'] += 1
+                    self._cond.notify_all()
@@ -16,6 +16,7 @@ Sage notebook server::
          users.pickle
          openid.pickle (optional)
          readonly.txt (optional)
+         worksheet_index.sqlite
          home/
              username0/
                 history.pickle
@@ -38,10 +39,14 @@ Sage notebook server::
 """
 
 import copy
+import hashlib
 import shutil
 import tarfile
-import tempfile
+import time
 import os
+import bz2
+import zlib
+from cStringIO import StringIO
 try:
    import cPickle as pickle
 except ImportError:
@@ -49,7 +54,8 @@ except ImportError:
 from six import iteritems
 
 from .abstract_storage import Datastore
-from sagenb.misc.misc import set_restrictive_permissions, encoded_str
+from .worksheet_index import WorksheetIndex
+from sagenb.misc.misc import set_restrictive_permissions, encoded_str, unicode_str
 
 from sage.misc.temporary_file import atomic_write
 
@@ -66,6 +72,40 @@ def is_safe(a):
     return '..' not in a and not a.startswith('/')
 
 
+class _CompressedStream(object):
+    """
+    A file object that compresses what is written to it and keeps it
+    until it is taken out with :meth:`read`.
+    """
+    def __init__(self, compression):
+        if compression == 'bz2':
+            self._compressor = bz2.BZ2Compressor(9)
+        elif compression == 'gz':
+            # 16 + MAX_WBITS asks zlib for a gzip header
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression in ['none', '', None]:
+            self._compressor = None
+        else:
+            raise ValueError("unknown compression '%s'" % compression)
+        self._chunks = []
+
+    def write(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self._chunks.append(data)
+
+    def close(self):
+        if self._compressor is not None:
+            self._chunks.append(self._compressor.flush())
+            self._compressor = None
+
+    def read(self):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
 class FilesystemDatastore(Datastore):
     def __init__(self, path):
         """
@@ -86,6 +126,7 @@ class FilesystemDatastore(Datastore):
         self._conf_filename = 'conf.pickle'
         self._users_filename = 'users.pickle'
         self._readonly_filename = 'readonly.txt'
+        self._index_filename = 'worksheet_index.sqlite'
         self._readonly_mtime = 0
         self._readonly = None
 
@@ -150,6 +191,23 @@ class FilesystemDatastore(Datastore):
     def _history_filename(self, username):
         return os.path.join(self._user_path(username), 'history.pickle')
 
+    def _index(self):
+        """
+        Return the index of worksheet metadata of this datastore,
+        opening it the first time this is called.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: FilesystemDatastore(tmp_dir())._index()
+            Worksheet index at ...worksheet_index.sqlite
+        """
+        try:
+            return self.__index
+        except AttributeError:
+            self.__index = WorksheetIndex(self._abspath(self._index_filename))
+            return self.__index
+
     def _abspath(self, file):
         """
         Return absolute path to filename got by joining self._path
@@ -372,18 +430,167 @@ class FilesystemDatastore(Datastore):
             sage: DS = FilesystemDatastore(tmp)
             sage: DS.save_worksheet(W)
         """
+        self.worksheet_snapshot(worksheet, conf_only=conf_only)()
+
+    def worksheet_snapshot(self, worksheet, conf_only=False):
+        """
+        Return a function that saves the worksheet as it is now.
+
+        The worksheet's config and body are copied right away; the
+        files are only written when the returned function is called,
+        which need not be done while holding the worksheet's lock.
+
+        INPUT:
+
+            - ``worksheet`` -- a Sage worksheet
+
+            - ``conf_only`` -- default: False; if True, only save
+              the config file, not the actual body of the worksheet
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: W = Worksheet('test', 2, tmp, system='gap', owner='sageuser')
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: write = DS.worksheet_snapshot(W)
+            sage: W.set_name('changed')
+            sage: write()
+            sage: DS.load_worksheet('sageuser', 2).name()
+            u'test'
+
+        The body is only written if it changed::
+
+            sage: W.edit_save('{{{\n2+3\n}}}')
+            sage: DS.save_worksheet(W)
+            sage: filename = DS._abspath(DS._worksheet_html_filename('sageuser', 2))
+            sage: os.remove(filename)
+            sage: DS.save_worksheet(W)
+            sage: os.path.exists(filename)
+            False
+        """
         username = worksheet.owner(); id_number = worksheet.id_number()
         basic = self._worksheet_to_basic(worksheet)
-        if not hasattr(worksheet, '_last_basic') or worksheet._last_basic != basic:
+        if getattr(worksheet, '_last_basic', None) == basic:
             # only save if changed
-            self._save(basic, self._worksheet_conf_filename(username, id_number))
-            worksheet._last_basic = basic
+            basic = None
+        body = None
         if not conf_only and worksheet.body_is_loaded():
-            # only save if loaded
-            # todo -- add check if changed
-            filename = self._worksheet_html_filename(username, id_number)
-            with atomic_write(self._abspath(filename)) as f:
-                f.write(worksheet.body().encode('utf-8', 'ignore'))
+            # only save if loaded and changed since it was last read
+            # or written
+            body = worksheet.body()
+            data = body.encode('utf-8', 'ignore')
+            digest = hashlib.md5(data).digest()
+            if getattr(worksheet, '_last_body', None) == digest:
+                body = None
+        try:
+            header = worksheet.search_header()
+        except UnicodeDecodeError:
+            # such worksheets never satisfy any search
+            header = None
+
+        def write():
+            if basic is not None:
+                self._save(basic, self._worksheet_conf_filename(username, id_number))
+                self._index().update(basic)
+                worksheet._last_basic = basic
+            if body is not None:
+                filename = self._worksheet_html_filename(username, id_number)
+                with atomic_write(self._abspath(filename)) as f:
+                    f.write(data)
+                worksheet._last_body = digest
+            if header is not None:
+                self._update_search_index(worksheet, header, body)
+        return write
+
+    def _update_search_index(self, worksheet, header, body=None):
+        """
+        Update the search index entry of the given worksheet if its
+        searchable text changed since it was last indexed.
+
+        INPUT:
+
+            - ``worksheet`` -- a Sage worksheet
+
+            - ``header`` -- unicode string; the worksheet's
+              :meth:`~sagenb.notebook.worksheet.Worksheet.search_header`
+
+            - ``body`` -- unicode string or None; the body of the
+              worksheet as it was just saved to disk, or None if the
+              body was not saved
+        """
+        if body is not None:
+            body = body.lower()
+            digest = hashlib.md5(body.encode('utf-8', 'ignore')).hexdigest()
+        else:
+            digest = getattr(worksheet, '_last_search', (None, None))[1]
+        if getattr(worksheet, '_last_search', None) == (header, digest):
+            return
+        self._index().update_search_text(worksheet.owner(), worksheet.id_number(), header, body)
+        worksheet._last_search = (header, digest)
+
+    def search_worksheets(self, worksheets, search):
+        """
+        Return the list of those worksheets in the list ``worksheets``
+        that satisfy the given search, in the same order.
+
+        This gives the same result as calling
+        :meth:`Worksheet.satisfies_search` on each worksheet, but the
+        worksheets are looked up in the search index, so (except the
+        first time a worksheet is searched) no worksheet file is read.
+
+        INPUT:
+
+            - ``worksheets`` -- list of worksheets
+
+            - ``search`` -- string; a search query as understood by
+              :func:`~sagenb.notebook.worksheet.split_search_string_into_keywords`
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp_dir())
+            sage: W = DS.create_worksheet('sageuser', 0)
+            sage: W.set_name('Modular forms')
+            sage: W.edit_save('{{{\nModularForms(11)\n}}}')
+            sage: DS.save_worksheet(W)
+            sage: V = DS.create_worksheet('sageuser', 1)
+            sage: V.set_name('Elliptic curves')
+            sage: DS.save_worksheet(V)
+            sage: [w.filename() for w in DS.search_worksheets([W, V], 'sageuser')]
+            ['sageuser/0', 'sageuser/1']
+            sage: [w.filename() for w in DS.search_worksheets([W, V], 'modularforms(11)')]
+            ['sageuser/0']
+            sage: [w.filename() for w in DS.search_worksheets([W, V], '"elliptic curves" sageuser')]
+            ['sageuser/1']
+            sage: DS.search_worksheets([W, V], 'elliptic modular')
+            []
+        """
+        from sagenb.notebook.worksheet import split_search_string_into_keywords
+        keywords = [unicode_str(x).lower() for x in split_search_string_into_keywords(search)]
+        if len(keywords) == 0:
+            return list(worksheets)
+        index = self._index()
+        keys = [(unicode_str(W.owner()), W.id_number()) for W in worksheets]
+        indexed = index.search_indexed(keys)
+        for W, key in zip(worksheets, keys):
+            if key not in indexed:
+                # Never indexed (e.g., not saved since the index was
+                # created), so we read the saved body from disk once.
+                filename = W.worksheet_html_filename()
+                if os.path.exists(filename):
+                    with open(filename) as f:
+                        contents = f.read().decode('utf-8', 'ignore')
+                else:
+                    contents = u' '
+                try:
+                    self._update_search_index(W, W.search_header(), contents)
+                except UnicodeDecodeError:
+                    # such worksheets never satisfy any search
+                    pass
+        matches = index.search(keywords, keys)
+        return [W for W, key in zip(worksheets, keys) if key in matches]
 
     def create_worksheet(self, username, id_number):
         """
@@ -458,7 +665,35 @@ class FilesystemDatastore(Datastore):
         return W
 
 
-    def export_worksheet(self, username, id_number, filename, title):
+    def load_worksheet_from_index(self, username, id_number):
+        """
+        Return the worksheet username/id_number reconstructed from the
+        worksheet index, without reading its configuration file.  The
+        body of the returned worksheet is loaded from disk when it is
+        needed, exactly like for :meth:`load_worksheet`.
+
+        If the worksheet is not in the index, this is the same as
+        :meth:`load_worksheet`.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp_dir())
+            sage: W = DS.create_worksheet('sageuser', 2)
+            sage: W.set_name('indexed')
+            sage: DS.save_worksheet(W)
+            sage: DS.load_worksheet_from_index('sageuser', 2).name()
+            u'indexed'
+        """
+        basic = self._index().basic(username, id_number)
+        if basic is None:
+            return self.load_worksheet(username, id_number)
+        W = self._basic_to_worksheet(basic)
+        W._last_basic = basic
+        return W
+
+    def export_worksheet(self, username, id_number, filename, title,
+                         compression='bz2'):
         """
         Export the worksheet with given username and id_number to the
         given filename (e.g., 'worksheet.sws').
@@ -467,8 +702,51 @@ class FilesystemDatastore(Datastore):
     
             - ``title`` - title to use for the exported worksheet (if
                None, just use current title)
+
+            - ``compression`` - 'bz2' (default), 'gz' or 'none'; see
+              :meth:`export_worksheet_stream`
         """
-        T = tarfile.open(filename, 'w:bz2')
+        with open(filename, 'wb') as f:
+            for chunk in self.export_worksheet_stream(username, id_number,
+                                                      title, compression):
+                f.write(chunk)
+
+    def export_worksheet_stream(self, username, id_number, title=None,
+                                compression='bz2'):
+        """
+        Return an iterator over the contents of an sws file holding the
+        worksheet with given username and id_number.  The file is
+        produced while it is read, one worksheet file at a time, so
+        nothing is written to disk.
+
+        INPUT:
+
+            - ``title`` - title to use for the exported worksheet (if
+               None, just use current title)
+
+            - ``compression`` - 'bz2' (default), 'gz' or 'none'; how
+              the tar file is compressed.  Old versions of the
+              notebook can only import bz2 compressed worksheets, but
+              gz is several times faster.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp_dir())
+            sage: W = DS.create_worksheet('sageuser', 0)
+            sage: W.edit_save('{{{\n2+3\n}}}')
+            sage: DS.save_worksheet(W)
+            sage: sws = os.path.join(tmp_dir(), 'tmp.sws')
+            sage: with open(sws, 'wb') as f:
+            ....:     for chunk in DS.export_worksheet_stream('sageuser', 0, compression='gz'):
+            ....:         f.write(chunk)
+            sage: import tarfile
+            sage: tarfile.open(sws).getnames()
+            ['sage_worksheet/worksheet_conf.pickle', 'sage_worksheet/worksheet.html', 'sage_worksheet/worksheet.txt']
+            sage: DS.import_worksheet('sageuser', 1, sws).cell_list()
+            [Cell 0: in=2+3, out=]
+        """
+        out = _CompressedStream(compression)
         worksheet = self.load_worksheet(username, id_number)
         basic = copy.deepcopy(self._worksheet_to_basic(worksheet))
         if title:
@@ -480,131 +758,114 @@ class FilesystemDatastore(Datastore):
                   'collaborators', 'auto_publish']:
             if k in basic:
                 del basic[k]
-                
-        self._save(basic, self._worksheet_conf_filename(username, id_number) + '2')
-        tmp = self._abspath(self._worksheet_conf_filename(username, id_number) + '2')
-        T.add(tmp, os.path.join('sage_worksheet','worksheet_conf.pickle'))
-        os.unlink(tmp)
-
-        worksheet_html = self._abspath(self._worksheet_html_filename(username, id_number))
-        T.add(worksheet_html, os.path.join('sage_worksheet','worksheet.html'))
 
+        T = tarfile.open(fileobj=out, mode='w|')
+        mtime = time.time()
+
+        def add_string(name, s):
+            info = tarfile.TarInfo(name)
+            info.size = len(s)
+            info.mtime = mtime
+            info.mode = 0o600
+            T.addfile(info, StringIO(s))
+
+        add_string(os.path.join('sage_worksheet', 'worksheet_conf.pickle'),
+                   pickle.dumps(basic))
+        with open(self._abspath(self._worksheet_html_filename(username, id_number))) as f:
+            html = f.read()
+        add_string(os.path.join('sage_worksheet', 'worksheet.html'), html)
         # The following is purely for backwards compatibility with old
         # notebook servers prior to sage-4.1.2.
-        fd, worksheet_txt =  tempfile.mkstemp()
         old_heading = "%s\nsystem:%s\n"%(basic['name'], basic['system'])
-        with open(worksheet_txt,'w') as f:
-            with open(worksheet_html) as g:
-                f.write(old_heading + g.read())
-        T.add(worksheet_txt,
-              os.path.join('sage_worksheet','worksheet.txt'))
-        os.unlink(worksheet_txt)
-        # important, so we don't leave an open file handle!
-        os.close(fd)
-        # end backwards compat block.
-
-
-        # Add the contents of the DATA directory
+        add_string(os.path.join('sage_worksheet', 'worksheet.txt'),
+                   old_heading + html)
+        yield out.read()
+
+        # Add the contents of the DATA directory and of each of the
+        # cell directories.
         path = self._abspath(self._worksheet_pathname(username, id_number))
-        data = os.path.join(path, 'data')
-        if os.path.exists(data):
-            for X in os.listdir(data):
-                T.add(os.path.join(data, X), os.path.join('sage_worksheet','data',X))
-                    
-        # Add the contents of each of the cell directories.
-        cells = os.path.join(path, 'cells')
-        if os.path.exists(cells):
-            for X in os.listdir(cells):
-                T.add(os.path.join(cells, X), os.path.join('sage_worksheet','cells',X))
+        for sub in ['data', 'cells']:
+            top = os.path.join(path, sub)
+            if not os.path.exists(top):
+                continue
+            for dirpath, dirnames, filenames in os.walk(top):
+                dirnames.sort()
+                arcdir = os.path.join('sage_worksheet', os.path.relpath(dirpath, path))
+                if dirpath != top:
+                    T.add(dirpath, arcdir, recursive=False)
+                for X in sorted(filenames):
+                    T.add(os.path.join(dirpath, X), os.path.join(arcdir, X))
+                    yield out.read()
 
         # NOTE: We do not export the snapshot/undo data.  People
         # frequently *complain* about Sage exporting a record of their
         # mistakes anyways.
         T.close()
-
-
-    def _import_old_worksheet(self, username, id_number, filename):
-        """
-        Import a worksheet from an old version of Sage. 
-        """
-        T = tarfile.open(filename, 'r:bz2')
-        members = [a for a in T.getmembers() if 'worksheet.txt' in a.name and is_safe(a.name)]
-        if len(members) == 0:
-            raise RuntimeError("unable to import worksheet")
-
-        worksheet_txt = members[0].name
-        W = self.load_worksheet(username, id_number)
-        W.edit_save_old_format(T.extractfile(worksheet_txt).read().decode('utf-8', 'ignore'))
-        # '/' is right, since old worksheets always unix
-        dir = worksheet_txt.split('/')[0]
-            
-        path = self._abspath(self._worksheet_pathname(username, id_number))
-
-        base = os.path.join(dir,'data')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            dest = os.path.join(path, 'data')
-            if os.path.exists(dest): shutil.rmtree(dest)
-            shutil.move(os.path.join(path,base), path)
-        
-        base = os.path.join(dir,'cells')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            dest = os.path.join(path, 'cells')
-            if os.path.exists(dest): shutil.rmtree(dest)
-            shutil.move(os.path.join(path, base), path)
-            
-        tmp = os.path.join(path, dir)
-        if os.path.exists(tmp):
-            shutil.rmtree(tmp)
-
-        T.close()
-
-        return W
-            
+        out.close()
+        yield out.read()
 
     def import_worksheet(self, username, id_number, filename):
         """
         Import the worksheet username/id_number from the file with
-        given filename.
+        given filename, or from a file object, e.g., an upload.
+
+        The file is read once, in order, and every member of the tar
+        file is written to its place in the worksheet directory right
+        away.  Any compression is detected automatically.  Worksheets
+        from old versions of Sage, which only have a
+        ``worksheet.txt``, are imported too.
         """
         path = self._abspath(self._worksheet_pathname(username, id_number))
         if os.path.exists(path):
             shutil.rmtree(path, ignore_errors=True)
         os.makedirs(path)
-        T = tarfile.open(filename, 'r:bz2')
+        if isinstance(filename, basestring):
+            T = tarfile.open(filename, 'r|*')
+        else:
+            T = tarfile.open(fileobj=filename, mode='r|*')
+        conf = html = worksheet_txt = None
         try:
+            for member in T:
+                parts = member.name.split('/')
+                if not is_safe(member.name) or len(parts) < 2:
+                    continue
+                if member.isfile() and len(parts) == 2:
+                    if parts[1] == 'worksheet_conf.pickle':
+                        conf = T.extractfile(member).read()
+                    elif parts[1] == 'worksheet.html':
+                        html = T.extractfile(member).read()
+                    elif parts[1] == 'worksheet.txt' and worksheet_txt is None:
+                        worksheet_txt = T.extractfile(member).read()
+                elif parts[1] in ['data', 'cells']:
+                    dest = os.path.join(path, *parts[1:])
+                    if member.isdir():
+                        if not os.path.exists(dest):
+                            os.makedirs(dest)
+                    elif member.isfile():
+                        if not os.path.exists(os.path.dirname(dest)):
+                            os.makedirs(os.path.dirname(dest))
+                        with open(dest, 'wb') as f:
+                            shutil.copyfileobj(T.extractfile(member), f)
+        finally:
+            T.close()
+
+        if conf is not None and html is not None:
             with open(self._abspath(self._worksheet_conf_filename(username, id_number)),'w') as f:
-                f.write(T.extractfile(os.path.join('sage_worksheet','worksheet_conf.pickle')).read())
-        except KeyError:
-            # Not a valid worksheet.  This might mean it is an old
-            # worksheet from a previous version of Sage.
-            return self._import_old_worksheet(username, id_number, filename)
-
-        with open(self._abspath(self._worksheet_html_filename(username, id_number)),'w') as f:
-            f.write(T.extractfile(os.path.join('sage_worksheet','worksheet.html')).read())
-
-        base = os.path.join('sage_worksheet','data')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            shutil.move(os.path.join(path,base), path)
-        
-        base = os.path.join('sage_worksheet','cells')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            shutil.move(os.path.join(path, base), path)
-
-        tmp = os.path.join(path, 'sage_worksheet')
-        if os.path.exists(tmp):
-            shutil.rmtree(tmp)
-        
-        T.close()
-        
-        return self.load_worksheet(username, id_number)
+                f.write(conf)
+            with open(self._abspath(self._worksheet_html_filename(username, id_number)),'w') as f:
+                f.write(html)
+            W = self.load_worksheet(username, id_number)
+        elif worksheet_txt is not None:
+            # This is a worksheet from a previous version of Sage.
+            W = self.create_worksheet(username, id_number)
+            W.edit_save_old_format(worksheet_txt.decode('utf-8', 'ignore'))
+            self.save_worksheet(W)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            raise RuntimeError("unable to import worksheet")
+
+        self._index().update(W.basic())
+        return W
         
     def worksheets(self, username):
         """
@@ -612,6 +873,11 @@ class FilesystemDatastore(Datastore):
         given name.  If the given user does not exists, an empty list
         is returned.
 
+        The worksheets are constructed from the worksheet index, so
+        no worksheet configuration file is read, except the first
+        time the worksheets of a given user are listed (e.g., right
+        after upgrading), when the index is built.
+
         EXAMPLES: The load_user_data function must be defined in the
         derived class::
         
@@ -626,18 +892,198 @@ class FilesystemDatastore(Datastore):
             sage: DS.save_worksheet(W)
             sage: DS.worksheets('sageuser')
             [sageuser/2: [Cell 0: in=, out=]]
+
+        The index survives restarting the server::
+
+            sage: DS = FilesystemDatastore(tmp)
+            sage: DS._index().is_indexed('sageuser')
+            True
+            sage: [w.name() for w in DS.worksheets('sageuser')]
+            [u'test']
+        """
+        from sagenb.notebook.worksheet import Worksheet_from_basic
+        index = self._index()
+        if not index.is_indexed(username):
+            self._build_index(username)
+        # All worksheets of a user live in the same directory, so we
+        # compute it once instead of in _basic_to_worksheet.
+        path = self._abspath(self._worksheet_path(username))
+        v = []
+        for basic in index.basics(username):
+            W = Worksheet_from_basic(basic, path)
+            W._last_basic = basic
+            v.append(W)
+        return v
+
+    def worksheets_page(self, username, sort='last_edited', reverse=False,
+                        offset=0, limit=None):
+        """
+        Return the worksheets of the given user, sorted like the
+        worksheet listings (see
+        :func:`~sagenb.notebook.notebook.sort_worksheet_list`),
+        starting at ``offset`` and at most ``limit`` of them (default:
+        all).  Only the worksheets on the requested page are read
+        from the index.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp_dir())
+            sage: for i, name in enumerate(['b', 'a', 'c']):
+            ....:     W = DS.create_worksheet('pub', i)
+            ....:     W.set_name(name)
+            ....:     DS.save_worksheet(W)
+            sage: [W.name() for W in DS.worksheets_page('pub', 'name', offset=1)]
+            [u'b', u'c']
+            sage: DS.count_worksheets('pub')
+            3
+        """
+        from sagenb.notebook.worksheet import Worksheet_from_basic
+        index = self._index()
+        if not index.is_indexed(username):
+            self._build_index(username)
+        path = self._abspath(self._worksheet_path(username))
+        v = []
+        for basic in index.page(username, sort, reverse, offset, limit):
+            W = Worksheet_from_basic(basic, path)
+            W._last_basic = basic
+            v.append(W)
+        return v
+
+    def count_worksheets(self, username):
+        """
+        Return the number of worksheets of the given user.
+        """
+        index = self._index()
+        if not index.is_indexed(username):
+            self._build_index(username)
+        return index.count(username)
+
+    def index_users(self, usernames):
+        """
+        Make sure the worksheets of all the given users are in the
+        worksheet index, building the missing entries.
+        """
+        indexed = self._index().indexed_users()
+        for username in usernames:
+            if unicode_str(username) not in indexed:
+                self._build_index(username)
+
+    def worksheets_for_user(self, username, view, owners, everyone=False,
+                            sort='last_edited', reverse=False, offset=0, limit=None):
+        """
+        Return the worksheets in the listing of the given user,
+        sorted like the worksheet listings, starting at ``offset``
+        and at most ``limit`` of them (default: all).  Only the
+        worksheets on the requested page are read from the index.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``view`` -- integer; only the worksheets the user has in
+              this view (ARCHIVED, ACTIVE or TRASH, see
+              :mod:`sagenb.notebook.worksheet`) are listed
+
+            - ``owners`` -- list of strings; the users whose worksheets
+              may be listed
+
+            - ``everyone`` -- bool (default: False); if True, all
+              worksheets of the given owners are listed, otherwise only
+              those that ``username`` owns, collaborates on or views
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp_dir())
+            sage: W = DS.create_worksheet('sageuser', 0)
+            sage: W.add_collaborator('bob')
+            sage: DS.save_worksheet(W)
+            sage: V = DS.create_worksheet('sageuser', 1)
+            sage: V.move_to_trash('sageuser')
+            sage: DS.save_worksheet(V)
+            sage: DS.worksheets_for_user('bob', 1, ['bob', 'sageuser'])
+            [sageuser/0: [Cell 0: in=, out=]]
+            sage: [W.filename() for W in DS.worksheets_for_user('admin', 1, ['sageuser'], everyone=True)]
+            ['sageuser/1', 'sageuser/0']
+            sage: DS.count_worksheets_for_user('sageuser', 2, ['sageuser'])
+            1
+        """
+        from sagenb.notebook.worksheet import Worksheet_from_basic
+        exclude = self._listing_owners(owners, everyone)
+        v = []
+        for basic in self._index().listing(username, view, sort, reverse, offset, limit,
+                                           everyone, exclude):
+            W = Worksheet_from_basic(basic, self._abspath(self._worksheet_path(basic['owner'])))
+            W._last_basic = basic
+            v.append(W)
+        return v
+
+    def count_worksheets_for_user(self, username, view, owners, everyone=False):
+        """
+        Return the number of worksheets in the listing of the given
+        user; the input is as for :meth:`worksheets_for_user`.
+        """
+        exclude = self._listing_owners(owners, everyone)
+        return self._index().listing_count(username, view, everyone, exclude)
+
+    def _listing_owners(self, owners, everyone):
+        """
+        Index the worksheets of the given owners and return the list
+        of other users in the index whose worksheets must be left
+        out of a listing.
+        """
+        self.index_users(owners)
+        if not everyone:
+            # the listing only has rows for the user anyway
+            return []
+        return list(self._index().indexed_users().difference(
+            [unicode_str(u) for u in owners]))
+
+    def _build_index(self, username):
+        """
+        Build the index entries for all worksheets of the given user
+        by loading their configuration files from disk.
         """
         path = self._abspath(self._user_path(username))
-        if not os.path.exists(path): return []
+        if not os.path.exists(path):
+            return
         v = []
         for id_number in os.listdir(path):
             if id_number.isdigit():
                 try:
-                    v.append(self.load_worksheet(username, int(id_number)))
+                    v.append(self.load_worksheet(username, int(id_number)).basic())
                 except Exception:
                     import traceback
                     print("Warning: problem loading %s/%s: %s" % (username, id_number, traceback.format_exc()))
-        return v
+        self._index().set_user_worksheets(username, v)
+
+    def delete_worksheet(self, username, id_number):
+        """
+        Delete all files of the worksheet username/id_number and
+        remove it from the worksheet index.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_number`` -- integer
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: W = DS.create_worksheet('sageuser', 2)
+            sage: DS.save_worksheet(W)
+            sage: DS.delete_worksheet('sageuser', 2)
+            sage: DS.worksheets('sageuser')
+            []
+        """
+        path = self._abspath(self._worksheet_pathname(username, id_number))
+        self._index().remove(username, id_number)
+        shutil.rmtree(path, ignore_errors=False)
 
     def readonly_user(self, username):
         """
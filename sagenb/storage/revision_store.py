@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*
+"""
+Compact storage of worksheet revisions
+
+Every snapshot of a worksheet used to be a separate bz2 file holding
+the whole text of the worksheet, and listing the revisions meant
+listing and sorting the snapshot directory.  For big worksheets that
+are saved often, the snapshots took most of the disk space and of the
+time spent saving.
+
+A :class:`RevisionStore` keeps all revisions of a worksheet in one
+append-only pack file ``revisions.pack`` in the snapshot directory.
+Every ``KEYFRAME_INTERVAL``-th revision is stored in full; the others
+are stored as a line based delta against the previous revision, so
+reconstructing any revision applies at most ``KEYFRAME_INTERVAL - 1``
+deltas to a keyframe.  Both are compressed with zlib.  The text file
+``revisions.index`` has one line per revision with its key, the time
+it was saved, who saved it and where its record is in the pack, so
+listing the revisions does not read the pack at all.
+
+Snapshots in the old format (``<time>.bz2`` files) are moved into the
+pack the first time the store is opened.  As before, those saved
+before ``AMNESTY`` (when the number of snapshots started to be
+limited) are kept and listed in addition to the most recent ones.
+
+EXAMPLES::
+
+    sage: from sagenb.storage.revision_store import RevisionStore
+    sage: R = RevisionStore(tmp_dir())
+    sage: R.add(u'{{{\\n2+3\\n}}}', 'admin', 1300000000)
+    '1'
+    sage: R.add(u'{{{\\n2+3\\n}}}\\n\\n{{{\\n4+5\\n}}}', 'admin', 1300000100)
+    '2'
+    sage: R.revisions()
+    [('1', 1300000000.0, 'admin'), ('2', 1300000100.0, 'admin')]
+    sage: R.text('1')
+    u'{{{\\n2+3\\n}}}'
+"""
+import bz2
+import calendar
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+# Every this many revisions, the full text is stored instead of a delta.
+KEYFRAME_INTERVAL = 16
+
+# Default number of revisions kept.
+MAX_REVISIONS = 30
+
+# Revisions saved before this time (1 May 2009) are always kept.
+AMNESTY = calendar.timegm((2009, 5, 1, 0, 0, 0))
+
+PACK = 'revisions.pack'
+INDEX = 'revisions.index'
+
+re_legacy = re.compile(r'^(\d+)\.bz2$')
+
+
+def make_delta(old, new):
+    r"""
+    Return a list describing how to build the list of lines ``new``
+    from the list of lines ``old``: pairs ``[i, j]`` copy
+    ``old[i:j]``, and lists of strings are inserted as they are.
+
+    Only the lines that the two lists have in common at the start and
+    at the end are copied, so this takes linear time.  Saving a
+    worksheet usually changes a few neighbouring cells, so the rest of
+    the delta is small.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.revision_store import make_delta, apply_delta
+        sage: old = ['a\n', 'b\n', 'c\n', 'd\n']
+        sage: new = ['a\n', 'x\n', 'c\n', 'd\n']
+        sage: make_delta(old, new)
+        [[0, 1], ['x\n'], [2, 4]]
+        sage: apply_delta(old, make_delta(old, new)) == new
+        True
+        sage: make_delta(old, old[:2])
+        [[0, 2]]
+        sage: apply_delta(old, make_delta(old, ['y\n'] + old)) == ['y\n'] + old
+        True
+    """
+    n = min(len(old), len(new))
+    start = 0
+    while start < n and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < n - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    delta = []
+    if start:
+        delta.append([0, start])
+    if len(new) - end > start:
+        delta.append(new[start:len(new) - end])
+    if end:
+        delta.append([len(old) - end, len(old)])
+    return delta
+
+
+def apply_delta(old, delta):
+    """
+    Return the list of lines described by ``delta`` (see
+    :func:`make_delta`) relative to the list of lines ``old``.
+    """
+    new = []
+    for x in delta:
+        if len(x) == 2 and isinstance(x[0], int):
+            new.extend(old[x[0]:x[1]])
+        else:
+            new.extend(x)
+    return new
+
+
+def _entry_time(entry):
+    return entry['time']
+
+
+class RevisionStore(object):
+    def __init__(self, directory, max_revisions=MAX_REVISIONS, legacy_users=None):
+        """
+        The revisions of a worksheet, stored in ``directory``.
+
+        INPUT:
+
+        - ``directory`` -- string; the snapshot directory of the
+          worksheet, which must exist
+
+        - ``max_revisions`` -- integer (default: 30); number of most
+          recent revisions kept
+
+        - ``legacy_users`` -- dictionary or None (default); maps the
+          times of snapshots in the old format to who saved them
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.revision_store import RevisionStore
+            sage: RevisionStore(tmp_dir())
+            Store of 0 worksheet revisions
+        """
+        self._dir = directory
+        self._max = max_revisions
+        self._lock = threading.Lock()
+        self._index = None
+        self._legacy_users = legacy_users or {}
+        # (key, text) of the newest revision
+        self._last = None
+
+    def __repr__(self):
+        return "Store of %s worksheet revisions" % len(self._entries())
+
+    def _path(self, name):
+        return os.path.join(self._dir, name)
+
+    def _entries(self):
+        """
+        Return the list of index entries, oldest first.  An entry is a
+        dictionary with keys 'key', 'time', 'user', 'offset',
+        'length' and 'keyframe'.
+        """
+        if self._index is None:
+            self._index = self._read_index()
+            self._migrate()
+        return self._index
+
+    def _read_index(self):
+        entries = []
+        try:
+            f = open(self._path(INDEX))
+        except IOError:
+            return entries
+        with f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a partly written last line
+                    break
+        # Drop entries whose record did not make it into the pack.
+        try:
+            size = os.path.getsize(self._path(PACK))
+        except OSError:
+            size = 0
+        return [e for e in entries if e['offset'] + e['length'] <= size]
+
+    def _migrate(self):
+        """
+        Move snapshots in the old one file per revision format into
+        the pack.
+        """
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return
+        legacy = sorted([(int(m.group(1)), name) for name, m in
+                         [(name, re_legacy.match(name)) for name in names] if m])
+        if not legacy:
+            return
+        revisions = []
+        for t, name in legacy:
+            try:
+                text = bz2.decompress(open(self._path(name)).read())
+            except (IOError, EOFError):
+                continue
+            revisions.append((text.decode('utf-8', 'ignore'), t,
+                              self._legacy_users.get(str(t), '')))
+        revisions.extend([(self._text(e), e['time'], e['user'])
+                          for e in self._index])
+        self._rewrite([(str(i + 1),) + r for i, r in enumerate(revisions)])
+        for t, name in legacy:
+            os.unlink(self._path(name))
+
+    def _next_key(self):
+        entries = self._index
+        return str(int(entries[-1]['key']) + 1) if entries else '1'
+
+    def _append(self, f, offset, text, user, t, previous):
+        """
+        Write the record of a new revision with the given text to the
+        open pack file ``f`` at ``offset`` and return its index entry.
+
+        ``previous`` is the text of the previous revision or None.
+        """
+        lines = text.splitlines(True)
+        n = len(self._index)
+        keyframe = previous is None or n % KEYFRAME_INTERVAL == 0
+        if keyframe:
+            data = lines
+        else:
+            data = make_delta(previous.splitlines(True), lines)
+        record = zlib.compress(json.dumps(data))
+        f.write(record)
+        entry = {'key': self._next_key(), 'time': float(t), 'user': user,
+                 'offset': offset, 'length': len(record),
+                 'keyframe': keyframe}
+        self._index.append(entry)
+        return entry
+
+    def _kept(self, items, time):
+        """
+        Return the items (index entries or revisions, oldest first)
+        that are kept: the last ``max_revisions`` of them and those
+        saved before ``AMNESTY``.  ``time(x)`` is the time of item x.
+        """
+        if not self._max or len(items) <= self._max:
+            return items
+        n = len(items) - self._max
+        return [x for x in items[:n] if time(x) < AMNESTY] + items[n:]
+
+    def _rewrite(self, revisions):
+        """
+        Replace the pack and the index by new ones holding the given
+        revisions, which are tuples ``(key, text, time, user)``,
+        oldest first.  Only those that are kept (see :meth:`_kept`)
+        are written.
+        """
+        revisions = self._kept(revisions, lambda r: r[2])
+        self._index = []
+        self._last = None
+        pack = self._path(PACK + '.tmp')
+        index = self._path(INDEX + '.tmp')
+        previous = None
+        offset = 0
+        with open(pack, 'wb') as f:
+            for key, text, t, user in revisions:
+                entry = self._append(f, offset, text, user, t, previous)
+                entry['key'] = key
+                offset += entry['length']
+                previous = text
+        with open(index, 'w') as f:
+            for e in self._index:
+                f.write(json.dumps(e) + '\n')
+        os.rename(pack, self._path(PACK))
+        os.rename(index, self._path(INDEX))
+
+    def _read(self, entry):
+        with open(self._path(PACK), 'rb') as f:
+            f.seek(entry['offset'])
+            return json.loads(zlib.decompress(f.read(entry['length'])))
+
+    def _lines(self, i):
+        entries = self._index
+        start = i
+        while not entries[start]['keyframe']:
+            start -= 1
+        lines = self._read(entries[start])
+        for j in range(start + 1, i + 1):
+            lines = apply_delta(lines, self._read(entries[j]))
+        return lines
+
+    def _text(self, entry):
+        return u''.join(self._lines(self._index.index(entry)))
+
+    def add(self, text, user='', t=None):
+        """
+        Store a new revision and return its key.
+
+        INPUT:
+
+        - ``text`` -- unicode string; the text of the worksheet
+
+        - ``user`` -- string; who saved the revision
+
+        - ``t`` -- number or None (default); the time of the revision
+          (default: now)
+        """
+        if t is None:
+            t = time.time()
+        with self._lock:
+            entries = self._entries()
+            kept = self._kept(entries, _entry_time)
+            if self._max and len(entries) - len(kept) >= self._max:
+                # Drop the revisions nobody can see any more.
+                self._rewrite([(e['key'], self._text(e), e['time'], e['user'])
+                               for e in entries])
+                entries = self._index
+            if not entries:
+                previous = None
+            elif self._last is not None and self._last[0] == entries[-1]['key']:
+                previous = self._last[1]
+            else:
+                previous = u''.join(self._lines(len(entries) - 1))
+            pack = self._path(PACK)
+            offset = os.path.getsize(pack) if os.path.exists(pack) else 0
+            with open(pack, 'ab') as f:
+                entry = self._append(f, offset, text, user, t, previous)
+            with open(self._path(INDEX), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self._last = (entry['key'], text)
+            return entry['key']
+
+    def revisions(self):
+        """
+        Return a list of triples ``(key, time, user)`` describing the
+        revisions that are kept, oldest first.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.revision_store import RevisionStore
+            sage: R = RevisionStore(tmp_dir(), max_revisions=2)
+            sage: for t in range(5):
+            ....:     _ = R.add(u'%s' % t, 'admin', 1300000000 + t)
+            sage: [k for k, t, u in R.revisions()]
+            ['4', '5']
+            sage: R.text('5')
+            u'4'
+
+        Revisions saved before ``AMNESTY`` are kept too::
+
+            sage: R = RevisionStore(tmp_dir(), max_revisions=2)
+            sage: _ = R.add(u'old', 'admin', 1200000000)
+            sage: for t in range(5):
+            ....:     _ = R.add(u'%s' % t, 'admin', 1300000000 + t)
+            sage: [k for k, t, u in R.revisions()]
+            ['1', '5', '6']
+            sage: R.text('1')
+            u'old'
+        """
+        with self._lock:
+            entries = self._kept(self._entries(), _entry_time)
+            return [(str(e['key']), e['time'], e['user']) for e in entries]
+
+    def text(self, key):
+        """
+        Return the text of the revision with the given key.
+
+        Raise a KeyError if there is no such revision.
+        """
+        with self._lock:
+            for i, e in enumerate(self._entries()):
+                if e['key'] == key:
+                    return u''.join(self._lines(i))
+        raise KeyError(key)
+
+    def time(self, key):
+        """
+        Return the time the revision with the given key was saved.
+        """
+        for k, t, user in self.revisions():
+            if k == key:
+                return t
+        raise KeyError(key)
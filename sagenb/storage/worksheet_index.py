@@ -0,0 +1,740 @@
+# -*- coding: utf-8 -*
+"""
+A Persistent Index of Worksheet Metadata
+
+Listing the worksheets of a user used to mean one ``os.listdir`` of
+the user's directory followed by unpickling ``worksheet_conf.pickle``
+for every single worksheet.  On a server with tens of thousands of
+worksheets this dominates the time it takes to render the home page.
+
+This module keeps the basic configuration of every worksheet (the
+dictionary returned by :meth:`Worksheet.basic`) in one SQLite file in
+the notebook directory, together with a few columns that are useful
+for listing (name, last change and rating).  The index is only a
+cache: the worksheet directories stay authoritative and the index of
+a given user is rebuilt from them whenever it is missing.
+
+The index is updated by :class:`FilesystemDatastore` every time the
+configuration of a worksheet is saved.
+
+For the listing of the worksheets of a user, the table
+``worksheet_users`` has a row for every worksheet and every user who
+can see it (its owner, collaborators and viewers) or has a view of it
+(active, archived or trash; e.g., an admin who moved it to the trash)
+with the user's view of it, and the worksheets table has
+an SQL index for each sort order of the listings, so a page of a
+listing is read without looking at the other worksheets.
+
+The same file also holds the full-text search index used for the
+search box of the worksheet listings.  For each worksheet we store
+the lower case text that :meth:`Worksheet.satisfies_search` looks at,
+split into a header (owner, publisher and name) and the body, together
+with the set of all trigrams (substrings of length 3) of that text.
+Since a search keyword matches if it is a substring of the text, a
+worksheet can only match if it contains all trigrams of the keyword,
+so only the few candidates found through the trigram table are
+actually compared with the keyword.
+"""
+
+import os
+import sqlite3
+import threading
+try:
+   import cPickle as pickle
+except ImportError:
+   import pickle
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS worksheets (
+    owner TEXT NOT NULL,
+    id_number INTEGER NOT NULL,
+    name TEXT,
+    last_change_user TEXT,
+    last_change_time REAL,
+    rating REAL,
+    basic BLOB NOT NULL,
+    PRIMARY KEY (owner, id_number)
+);
+CREATE TABLE IF NOT EXISTS indexed_users (
+    username TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS search_text (
+    docid INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    id_number INTEGER NOT NULL,
+    header TEXT NOT NULL,
+    body TEXT NOT NULL,
+    UNIQUE (owner, id_number)
+);
+CREATE TABLE IF NOT EXISTS search_trigrams (
+    trigram TEXT NOT NULL,
+    docid INTEGER NOT NULL,
+    PRIMARY KEY (trigram, docid)
+);
+CREATE INDEX IF NOT EXISTS search_trigrams_docid ON search_trigrams (docid);
+CREATE TABLE IF NOT EXISTS worksheet_users (
+    username TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    id_number INTEGER NOT NULL,
+    view INTEGER NOT NULL,
+    member INTEGER NOT NULL,
+    PRIMARY KEY (username, owner, id_number)
+);
+CREATE INDEX IF NOT EXISTS worksheet_users_worksheet ON worksheet_users (owner, id_number);
+CREATE INDEX IF NOT EXISTS worksheets_last_change ON worksheets (owner, last_change_time);
+CREATE INDEX IF NOT EXISTS worksheets_name ON worksheets (owner, name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS worksheets_rating ON worksheets (owner, rating);
+CREATE INDEX IF NOT EXISTS worksheets_all_last_change ON worksheets (last_change_time);
+"""
+
+# Bumped whenever tables or columns are added that must be filled in
+# from the existing rows; see :meth:`WorksheetIndex._upgrade`.
+SCHEMA_VERSION = 2
+
+# The views of a worksheet, as in :mod:`sagenb.notebook.worksheet`.
+ARCHIVED = 0
+ACTIVE = 1
+TRASH = 2
+
+def _text(s):
+    """
+    Return ``s`` as a unicode string, which is what sqlite3 expects
+    for TEXT columns.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.worksheet_index import _text
+        sage: _text('admin')
+        u'admin'
+        sage: _text(u'\xe9')
+        u'\xe9'
+        sage: _text(None) is None
+        True
+    """
+    if s is None or isinstance(s, unicode):
+        return s
+    if not isinstance(s, str):
+        s = str(s)
+    return s.decode('utf-8', 'replace')
+
+def _rating(basic):
+    """
+    Return the average rating of the worksheet described by the
+    dictionary ``basic``, or -1 if it is not rated.  This mirrors
+    :meth:`Worksheet.rating`.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.worksheet_index import _rating
+        sage: _rating({'ratings': []})
+        -1
+        sage: _rating({'ratings': [('a', 0, ''), ('b', 3, '')]})
+        1.5
+    """
+    r = [x[1] for x in basic.get('ratings', [])]
+    if len(r) == 0:
+        return -1
+    return float(sum(r)) / float(len(r))
+
+# For each sort key of the worksheet listings, the columns to sort by
+# and whether they are sorted in descending order; this matches
+# :func:`~sagenb.notebook.notebook.sort_worksheet_list`.
+SORT_ORDERS = {
+    'last_edited': [('last_change_time', True)],
+    'name': [('name COLLATE NOCASE', False), ('last_change_time', True)],
+    'owner': [('owner COLLATE NOCASE', False), ('last_change_time', True)],
+    'rating': [('rating', True), ('last_change_time', False)],
+    }
+
+def _order_by(sort, reverse):
+    """
+    Return the ORDER BY clause for the given sort key of the
+    worksheet listings.  Ties are broken by the id number, so that
+    pages of a listing do not overlap.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.worksheet_index import _order_by
+        sage: _order_by('name', False)
+        'ORDER BY name COLLATE NOCASE ASC, last_change_time DESC, id_number ASC'
+        sage: _order_by('last_edited', True)
+        'ORDER BY last_change_time ASC, id_number DESC'
+        sage: _order_by('size', False)
+        Traceback (most recent call last):
+        ...
+        ValueError: invalid sort key 'size'
+    """
+    try:
+        columns = SORT_ORDERS[sort] + [('id_number', False)]
+    except KeyError:
+        raise ValueError("invalid sort key '%s'" % sort)
+    return 'ORDER BY ' + ', '.join(['%s %s' % (column, 'DESC' if desc != reverse else 'ASC')
+                                    for column, desc in columns])
+
+def _view(tags, username):
+    """
+    Return the view (ARCHIVED, ACTIVE or TRASH) that the given user
+    has of the worksheet with the given tags; like
+    :meth:`Worksheet.user_view`, it is ACTIVE if the user has none.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.worksheet_index import _view
+        sage: _view({'sage': [2]}, 'sage')
+        2
+        sage: _view({'sage': 0}, 'sage')
+        0
+        sage: _view({'sage': [2]}, 'admin')
+        1
+    """
+    view = tags.get(username, ACTIVE)
+    if isinstance(view, list):
+        view = view[0] if view else ACTIVE
+    return int(view)
+
+def _user_rows(basic):
+    """
+    Return the rows of the ``worksheet_users`` table for the
+    worksheet described by the dictionary ``basic``: one for its
+    owner and each collaborator and viewer, which are members, and
+    one for each other user who has a view of it in its tags.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.worksheet_index import _user_rows
+        sage: _user_rows({'owner': 'sage', 'id_number': 3, 'collaborators': ['a'],
+        ....:             'tags': {'a': [2], 'admin': [2]}})
+        [(u'sage', u'sage', 3, 1, 1), (u'a', u'sage', 3, 2, 1), (u'admin', u'sage', 3, 2, 0)]
+    """
+    owner = basic['owner']
+    tags = basic.get('tags', {})
+    members = []
+    for u in [owner] + list(basic.get('collaborators', [])) + list(basic.get('viewers', [])):
+        if u is not None and u not in members:
+            members.append(u)
+    others = sorted([u for u in tags if u not in members])
+    return [(_text(u), _text(owner), int(basic['id_number']), _view(tags, u), int(u in members))
+            for u in members + others]
+
+def _trigrams(text):
+    """
+    Return the set of all substrings of length 3 of ``text``.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.worksheet_index import _trigrams
+        sage: sorted(_trigrams(u'abcab'))
+        [u'abc', u'bca', u'cab']
+        sage: _trigrams(u'ab')
+        set([])
+    """
+    return set([text[i:i+3] for i in range(len(text) - 2)])
+
+
+class WorksheetIndex(object):
+    def __init__(self, filename):
+        """
+        INPUT:
+
+           - ``filename`` -- string, path to the SQLite file holding
+             the index; it is created if it does not exist
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: WorksheetIndex(tmp_filename())
+            Worksheet index at ...
+        """
+        self._filename = filename
+        self._lock = threading.Lock()
+        try:
+            self._connection = self._connect()
+        except sqlite3.DatabaseError:
+            # The index is only a cache, so if it is corrupted we
+            # just start over; it will be rebuilt from the worksheet
+            # directories.
+            print("Warning: worksheet index %s is corrupt; rebuilding it" % filename)
+            os.unlink(filename)
+            self._connection = self._connect()
+
+    def __repr__(self):
+        return "Worksheet index at %s" % self._filename
+
+    def _connect(self):
+        connection = sqlite3.connect(self._filename, check_same_thread=False)
+        connection.text_factory = unicode
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self._upgrade(connection)
+        connection.commit()
+        return connection
+
+    def _upgrade(self, connection):
+        """
+        Fill in the tables that were added since the index was
+        created from the basic dictionaries that are already in it.
+        """
+        # recreate it, since its columns may have changed
+        connection.execute('DROP TABLE worksheet_users')
+        connection.executescript(SCHEMA)
+        for row in connection.execute('SELECT basic FROM worksheets').fetchall():
+            connection.executemany('INSERT OR REPLACE INTO worksheet_users VALUES (?,?,?,?,?)',
+                                   _user_rows(pickle.loads(str(row[0]))))
+        connection.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            self._connection.execute(sql, args)
+            self._connection.commit()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+    def _row(self, basic):
+        last_change = basic.get('last_change', (None, 0))
+        return (_text(basic['owner']), int(basic['id_number']),
+                _text(basic.get('name', u'')), _text(last_change[0]),
+                float(last_change[1]), _rating(basic),
+                sqlite3.Binary(pickle.dumps(basic, 2)))
+
+    def is_indexed(self, username):
+        """
+        Return True if the worksheets of the given user are all in
+        the index.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.is_indexed('sage')
+            False
+            sage: I.set_user_worksheets('sage', [])
+            sage: I.is_indexed('sage')
+            True
+        """
+        return len(self._query('SELECT 1 FROM indexed_users WHERE username=?',
+                               (_text(username),))) > 0
+
+    def set_user_worksheets(self, username, basics):
+        """
+        Replace all index entries of the given user by the entries
+        for the worksheets described by the list ``basics`` and mark
+        the user as indexed.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``basics`` -- list of dictionaries as returned by
+              :meth:`Worksheet.basic`
+        """
+        rows = [self._row(basic) for basic in basics]
+        user_rows = [r for basic in basics for r in _user_rows(basic)]
+        with self._lock:
+            c = self._connection
+            c.execute('DELETE FROM worksheets WHERE owner=?', (_text(username),))
+            c.execute('DELETE FROM worksheet_users WHERE owner=?', (_text(username),))
+            c.executemany('INSERT OR REPLACE INTO worksheets VALUES (?,?,?,?,?,?,?)', rows)
+            c.executemany('INSERT OR REPLACE INTO worksheet_users VALUES (?,?,?,?,?)', user_rows)
+            c.execute('INSERT OR REPLACE INTO indexed_users VALUES (?)', (_text(username),))
+            c.commit()
+
+    def update(self, basic):
+        """
+        Insert or replace the index entry of a worksheet.
+
+        INPUT:
+
+            - ``basic`` -- dictionary as returned by
+              :meth:`Worksheet.basic`
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.set_user_worksheets('sage', [])
+            sage: I.update({'owner': 'sage', 'id_number': 3, 'name': u'test', 'last_change': ('sage', 10.0)})
+            sage: I.basics('sage')
+            [{'owner': 'sage', 'id_number': 3, 'last_change': ('sage', 10.0), 'name': u'test'}]
+        """
+        row = self._row(basic)
+        with self._lock:
+            c = self._connection
+            c.execute('INSERT OR REPLACE INTO worksheets VALUES (?,?,?,?,?,?,?)', row)
+            c.execute('DELETE FROM worksheet_users WHERE owner=? AND id_number=?', row[:2])
+            c.executemany('INSERT OR REPLACE INTO worksheet_users VALUES (?,?,?,?,?)',
+                          _user_rows(basic))
+            c.commit()
+
+    def remove(self, username, id_number):
+        """
+        Remove the index entry of the worksheet username/id_number.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.set_user_worksheets('sage', [{'owner': 'sage', 'id_number': 3}])
+            sage: I.remove('sage', 3)
+            sage: I.basics('sage')
+            []
+        """
+        key = (_text(username), int(id_number))
+        with self._lock:
+            c = self._connection
+            c.execute('DELETE FROM worksheets WHERE owner=? AND id_number=?', key)
+            c.execute('DELETE FROM worksheet_users WHERE owner=? AND id_number=?', key)
+            self._delete_search_text(c, key)
+            c.commit()
+
+    def basics(self, username):
+        """
+        Return the list of basic dictionaries of the worksheets of the
+        given user that are in the index, ordered by id number.
+        """
+        rows = self._query('SELECT basic FROM worksheets WHERE owner=? ORDER BY id_number',
+                           (_text(username),))
+        return [pickle.loads(str(row[0])) for row in rows]
+
+    def page(self, username, sort='last_edited', reverse=False,
+             offset=0, limit=None):
+        """
+        Return the list of basic dictionaries of the worksheets of the
+        given user, sorted like the worksheet listings, starting at
+        ``offset`` and at most ``limit`` of them (default: all).  Only
+        the requested rows are read.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.set_user_worksheets('pub', [{'owner': 'pub', 'id_number': i, 'name': n, 'last_change': ('sage', t)}
+            ....:                               for i, n, t in [(0, u'b', 1.0), (1, u'A', 3.0), (2, u'c', 2.0)]])
+            sage: [b['id_number'] for b in I.page('pub')]
+            [1, 2, 0]
+            sage: [b['name'] for b in I.page('pub', 'name', offset=1, limit=1)]
+            [u'b']
+            sage: I.count('pub')
+            3
+        """
+        sql = 'SELECT basic FROM worksheets WHERE owner=? ' + _order_by(sort, reverse)
+        args = (_text(username),)
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            args += (-1 if limit is None else int(limit), int(offset))
+        return [pickle.loads(str(row[0])) for row in self._query(sql, args)]
+
+    def count(self, username):
+        """
+        Return the number of worksheets of the given user in the index.
+        """
+        return self._query('SELECT COUNT(*) FROM worksheets WHERE owner=?',
+                           (_text(username),))[0][0]
+
+    def indexed_users(self):
+        """
+        Return the set of users whose worksheets are in the index.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.set_user_worksheets('sage', [])
+            sage: I.indexed_users()
+            set([u'sage'])
+        """
+        return set([row[0] for row in self._query('SELECT username FROM indexed_users')])
+
+    def _listing(self, username, view, everyone, exclude):
+        """
+        Return the FROM and WHERE clauses selecting the worksheets
+        of a listing (see :meth:`listing`) and their arguments.
+        """
+        if everyone:
+            sql = ('FROM worksheets LEFT JOIN '
+                   '(SELECT owner AS u_owner, id_number AS u_id, view AS u_view '
+                   'FROM worksheet_users WHERE username=?) '
+                   'ON u_owner=owner AND u_id=id_number WHERE COALESCE(u_view, ?)=?')
+            args = [_text(username), ACTIVE, int(view)]
+        else:
+            sql = ('FROM worksheets JOIN '
+                   '(SELECT owner AS u_owner, id_number AS u_id '
+                   'FROM worksheet_users WHERE username=? AND view=? AND member) '
+                   'ON u_owner=owner AND u_id=id_number WHERE 1')
+            args = [_text(username), int(view)]
+        exclude = [_text(u) for u in exclude]
+        if exclude:
+            sql += ' AND owner NOT IN (%s)' % ','.join('?' * len(exclude))
+            args += exclude
+        return sql, args
+
+    def listing(self, username, view, sort='last_edited', reverse=False,
+                offset=0, limit=None, everyone=False, exclude=()):
+        """
+        Return the list of basic dictionaries of the worksheets in
+        the listing of the given user, sorted like the worksheet
+        listings, starting at ``offset`` and at most ``limit`` of them
+        (default: all).  Only the requested rows are read.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``view`` -- integer; only the worksheets that the user
+              has in this view (ARCHIVED, ACTIVE or TRASH) are listed
+
+            - ``everyone`` -- bool (default: False); if False, the
+              worksheets the user owns, collaborates on or views are
+              listed, otherwise the worksheets of all users in the
+              index (for admins)
+
+            - ``exclude`` -- list of users whose worksheets are not
+              listed
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.set_user_worksheets('sage', [{'owner': 'sage', 'id_number': 0, 'name': u'b', 'collaborators': ['bob']},
+            ....:                                {'owner': 'sage', 'id_number': 1, 'name': u'a', 'tags': {'sage': [2]}}])
+            sage: I.set_user_worksheets('bob', [{'owner': 'bob', 'id_number': 0, 'name': u'c'}])
+            sage: [(b['owner'], b['id_number']) for b in I.listing('bob', 1, 'name')]
+            [('sage', 0), ('bob', 0)]
+            sage: [b['name'] for b in I.listing('sage', 2)]
+            [u'a']
+            sage: [b['name'] for b in I.listing('admin', 1, 'name', everyone=True)]
+            [u'a', u'b', u'c']
+            sage: [b['name'] for b in I.listing('admin', 1, 'name', offset=1, everyone=True, exclude=['bob'])]
+            [u'b']
+            sage: I.listing_count('admin', 1, everyone=True)
+            3
+
+        The view of a user who only has a tag (here, an admin who moved
+        the worksheet to the trash) counts for the listing of everyone,
+        but only members see the worksheet otherwise::
+
+            sage: I.set_user_worksheets('bob', [{'owner': 'bob', 'id_number': 0, 'name': u'c', 'tags': {'admin': [2]}}])
+            sage: [b['name'] for b in I.listing('admin', 2, everyone=True)]
+            [u'c']
+            sage: I.listing('admin', 2)
+            []
+        """
+        sql, args = self._listing(username, view, everyone, exclude)
+        sql = 'SELECT basic ' + sql + ' ' + _order_by(sort, reverse)
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            args += [-1 if limit is None else int(limit), int(offset)]
+        return [pickle.loads(str(row[0])) for row in self._query(sql, args)]
+
+    def listing_count(self, username, view, everyone=False, exclude=()):
+        """
+        Return the number of worksheets in the listing of the given
+        user; the input is as for :meth:`listing`.
+        """
+        sql, args = self._listing(username, view, everyone, exclude)
+        return self._query('SELECT COUNT(*) ' + sql, args)[0][0]
+
+    def basic(self, username, id_number):
+        """
+        Return the basic dictionary of the worksheet
+        username/id_number, or None if it is not in the index.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.update({'owner': 'sage', 'id_number': 3})
+            sage: I.basic('sage', 3)
+            {'owner': 'sage', 'id_number': 3}
+            sage: I.basic('sage', 4) is None
+            True
+        """
+        rows = self._query('SELECT basic FROM worksheets WHERE owner=? AND id_number=?',
+                           (_text(username), int(id_number)))
+        if len(rows) == 0:
+            return None
+        return pickle.loads(str(rows[0][0]))
+
+    def id_numbers(self, username):
+        """
+        Return the sorted list of id numbers of the worksheets of the
+        given user that are in the index.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.set_user_worksheets('sage', [{'owner': 'sage', 'id_number': 3}, {'owner': 'sage', 'id_number': 1}])
+            sage: I.id_numbers('sage')
+            [1, 3]
+        """
+        rows = self._query('SELECT id_number FROM worksheets WHERE owner=? ORDER BY id_number',
+                           (_text(username),))
+        return [row[0] for row in rows]
+
+    ##########################################################
+    # Full-text search
+    ##########################################################
+    def _docid(self, c, key):
+        rows = c.execute('SELECT docid FROM search_text WHERE owner=? AND id_number=?',
+                         key).fetchall()
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    def _delete_search_text(self, c, key):
+        docid = self._docid(c, key)
+        if docid is not None:
+            c.execute('DELETE FROM search_trigrams WHERE docid=?', (docid,))
+            c.execute('DELETE FROM search_text WHERE docid=?', (docid,))
+
+    def update_search_text(self, username, id_number, header, body=None):
+        """
+        Set the searchable text of the worksheet username/id_number.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_number`` -- integer
+
+            - ``header`` -- unicode string; the lower case owner,
+              publisher and name of the worksheet, separated by
+              spaces
+
+            - ``body`` -- unicode string or None (default); the lower
+              case body of the worksheet.  If None, the body that is
+              already in the index is kept, and nothing is done if
+              there is no such body.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.update_search_text('sage', 0, u'sage sage test', u'2+3')
+            sage: I.search_text('sage', 0)
+            u'sage sage test 2+3'
+            sage: I.update_search_text('sage', 0, u'sage sage renamed')
+            sage: I.search_text('sage', 0)
+            u'sage sage renamed 2+3'
+            sage: I.update_search_text('sage', 1, u'sage sage other')
+            sage: I.search_text('sage', 1) is None
+            True
+        """
+        key = (_text(username), int(id_number))
+        with self._lock:
+            c = self._connection
+            if body is None:
+                rows = c.execute('SELECT body FROM search_text WHERE owner=? AND id_number=?',
+                                 key).fetchall()
+                if len(rows) == 0:
+                    return
+                body = rows[0][0]
+            self._delete_search_text(c, key)
+            cursor = c.execute('INSERT INTO search_text (owner, id_number, header, body) VALUES (?,?,?,?)',
+                               key + (header, body))
+            docid = cursor.lastrowid
+            c.executemany('INSERT INTO search_trigrams VALUES (?,?)',
+                          [(t, docid) for t in _trigrams(header + u' ' + body)])
+            c.commit()
+
+    def search_text(self, username, id_number):
+        """
+        Return the searchable text of the worksheet username/id_number,
+        or None if it is not in the index.
+        """
+        rows = self._query('SELECT header, body FROM search_text WHERE owner=? AND id_number=?',
+                           (_text(username), int(id_number)))
+        if len(rows) == 0:
+            return None
+        return rows[0][0] + u' ' + rows[0][1]
+
+    def search_indexed(self, keys):
+        """
+        Return the set of those keys ``(username, id_number)`` in the
+        list ``keys`` whose worksheet has its text in the search
+        index.  The usernames in the output are unicode strings.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.update_search_text('sage', 0, u'sage sage test', u'')
+            sage: I.search_indexed([('sage', 0), ('sage', 1)])
+            set([(u'sage', 0)])
+        """
+        keys = set([(_text(u), int(i)) for u, i in keys])
+        indexed = set()
+        for owner in set([u for u, i in keys]):
+            rows = self._query('SELECT owner, id_number FROM search_text WHERE owner=?', (owner,))
+            indexed.update([(u, i) for u, i in rows])
+        return keys.intersection(indexed)
+
+    def search(self, keywords, keys):
+        """
+        Return the set of those keys ``(username, id_number)`` in the
+        list ``keys`` whose worksheet text contains every one of the
+        given keywords.  The usernames in the output are unicode
+        strings.
+
+        INPUT:
+
+            - ``keywords`` -- list of lower case unicode strings
+
+            - ``keys`` -- list of pairs ``(username, id_number)``
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.worksheet_index import WorksheetIndex
+            sage: I = WorksheetIndex(tmp_filename())
+            sage: I.update_search_text('sage', 0, u'sage sage modular', u'2+3')
+            sage: I.update_search_text('sage', 1, u'sage sage elliptic', u'e = ellipticcurve([1,2])')
+            sage: keys = [('sage', 0), ('sage', 1)]
+            sage: sorted(I.search([u'sage'], keys))
+            [(u'sage', 0), (u'sage', 1)]
+            sage: sorted(I.search([u'ellip', u'[1,2]'], keys))
+            [(u'sage', 1)]
+            sage: sorted(I.search([u'+'], keys))
+            [(u'sage', 0)]
+            sage: sorted(I.search([u'lar 2'], keys))
+            [(u'sage', 0)]
+            sage: sorted(I.search([u'modular', u'curve'], keys))
+            []
+        """
+        candidates = set([(_text(u), int(i)) for u, i in keys])
+        with self._lock:
+            c = self._connection
+            for keyword in keywords:
+                if len(candidates) == 0:
+                    break
+                trigrams = list(_trigrams(keyword))
+                if len(trigrams) == 0:
+                    continue
+                # sqlite limits the number of parameters of a query,
+                # so we intersect the postings in chunks.
+                for k in range(0, len(trigrams), 500):
+                    chunk = trigrams[k:k+500]
+                    rows = c.execute('SELECT t.owner, t.id_number FROM search_trigrams g, search_text t '
+                                     'WHERE g.docid = t.docid AND g.trigram IN (%s) '
+                                     'GROUP BY g.docid HAVING COUNT(*) = ?' % ','.join('?' * len(chunk)),
+                                     chunk + [len(chunk)]).fetchall()
+                    candidates.intersection_update([(u, i) for u, i in rows])
+            # Having all trigrams does not imply containing the
+            # keyword, so we check the remaining candidates.
+            result = set()
+            for key in candidates:
+                rows = c.execute('SELECT header, body FROM search_text WHERE owner=? AND id_number=?',
+                                 key).fetchall()
+                if len(rows) == 0:
+                    continue
+                text = rows[0][0] + u' ' + rows[0][1]
+                if all([keyword in text for keyword in keywords]):
+                    result.add(key)
+        return result
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*
+"""
+Benchmarks for performance sensitive parts of the notebook server
+
+These are not run by the test suite.  Run them by hand with::
+
+    sage -python -m sagenb.testing.benchmarks
+
+Each benchmark function returns a dictionary of timings (in seconds)
+and, if ``verbose`` is True, prints a short summary.
+"""
+import re
+import time
+
+
+def _report(name, timings, verbose):
+    if verbose:
+        print(name)
+        for key in sorted(timings):
+            print("    %-30s %.6f" % (key, timings[key]))
+    return timings
+
+
+def _poll_times(feed, total, chunk):
+    """
+    Feed ``total`` bytes of output in pieces of ``chunk`` bytes to the
+    function ``feed`` (one piece per poll) and return the average time
+    per poll over the first and the last tenth of the polls.
+    """
+    data = ('x' * 79 + '\n') * (chunk // 80)
+    polls = total // len(data)
+    times = []
+    for i in range(polls):
+        t = time.time()
+        feed(data)
+        times.append(time.time() - t)
+    n = max(1, polls // 10)
+    return {'first polls (s/poll)': sum(times[:n]) / n,
+            'last polls (s/poll)': sum(times[-n:]) / n,
+            'total (s)': sum(times)}
+
+
+def output_messages(total=10 * 2**20, chunk=2**16, verbose=True):
+    """
+    Time polling a cell that streams ``total`` bytes of output, as
+    seen by :class:`~sagenb.interfaces.channel.MessageReader`.
+
+    Every poll feeds the new output to the reader and then gets the
+    output so far, as
+    :meth:`~sagenb.interfaces.expect.WorksheetProcess_ExpectImplementation.output_status`
+    does.  Reading the messages does not depend on how much output
+    came before, but getting the output is a copy of all of it, so the
+    time per poll still grows (slowly) with the output.
+
+    INPUT:
+
+    - ``total`` -- integer (default: 10MB); number of bytes of output
+
+    - ``chunk`` -- integer (default: 64KB); number of bytes that
+      arrive between two polls
+    """
+    from sagenb.interfaces.channel import MessageReader
+    from sagenb.interfaces.channel_server import message
+    R = MessageReader(1)
+
+    def feed(data):
+        R.feed(message('o', 1, data))
+        R.done()
+        R.output()
+
+    return _report('MessageReader, %s bytes' % total,
+                   _poll_times(feed, total, chunk), verbose)
+
+
+def output_regex(total=10 * 2**20, chunk=2**16, verbose=True):
+    """
+    Like :func:`output_messages`, but with the whole buffer regular
+    expression search that the expect worksheet process used to do
+    on every poll.  The time per poll grows with the output too, but
+    the search costs several times as much as the copy.
+    """
+    state = {'so_far': 'START1'}
+
+    def feed(data):
+        state['so_far'] += data
+        v = re.findall('START1.*__SAGE__', state['so_far'], re.DOTALL)
+        if not v:
+            v = re.findall('START1.*', state['so_far'], re.DOTALL)
+
+    return _report('Regular expression, %s bytes' % total,
+                   _poll_times(feed, total, chunk), verbose)
+
+
+def _worksheet_body(cells):
+    """
+    Return the body of a worksheet with ``cells`` compute cells, each
+    followed by a text cell, in the format of ``worksheet.html``
+    (about 250 bytes per pair of cells).
+    """
+    return ''.join(['{{{id=%s|\nfactor(%s)\n///\n%s\n}}}\n\n<p>Text cell %s</p>\n\n'
+                    % (i, i, 'x' * 200, i) for i in range(cells)])
+
+
+def _parse_times(parse, sizes):
+    timings = {}
+    for cells in sizes:
+        body = _worksheet_body(cells)
+        t = time.time()
+        parse(body)
+        timings['%8d bytes (s)' % len(body)] = time.time() - t
+    return timings
+
+
+def worksheet_parser(sizes=(5000, 10000, 20000, 40000), verbose=True):
+    """
+    Time parsing worksheet bodies of several sizes (the default sizes
+    are between about 1MB and 10MB) with
+    :func:`~sagenb.notebook.worksheet.worksheet_text_cells`, which is
+    what :meth:`~sagenb.notebook.worksheet.Worksheet.edit_save` does
+    before creating the cells.  The time should be proportional to the
+    size.
+
+    INPUT:
+
+    - ``sizes`` -- list of integers; numbers of compute cells
+    """
+    from sagenb.notebook.worksheet import worksheet_text_cells
+    return _report('worksheet_text_cells',
+                   _parse_times(worksheet_text_cells, sizes), verbose)
+
+
+def worksheet_parser_slicing(sizes=(1000, 2000, 4000), verbose=True):
+    """
+    Like :func:`worksheet_parser`, but with the loop that
+    :meth:`~sagenb.notebook.worksheet.Worksheet.edit_save` used to
+    run, which copies the rest of the text after every cell and looks
+    for the next free id starting at 0; the time grows quadratically
+    with the size.  The default sizes are smaller.
+    """
+    from sagenb.notebook.worksheet import (extract_text_before_first_compute_cell,
+                                           extract_first_compute_cell,
+                                           next_available_id)
+
+    def parse(text):
+        data = []
+        while True:
+            plain_text = extract_text_before_first_compute_cell(text).strip()
+            if plain_text:
+                data.append(('plain', plain_text))
+            try:
+                meta, input, output, i = extract_first_compute_cell(text)
+            except EOFError:
+                break
+            data.append(('compute', (meta, input, output)))
+            text = text[i:]
+        ids = set([x[0]['id'] for typ, x in data if typ == 'compute' and 'id' in x[0]])
+        for typ, T in data:
+            if typ == 'plain':
+                ids.add(next_available_id(ids))
+
+    return _report('Slicing parser',
+                   _parse_times(parse, sizes), verbose)
+
+
+def _revision_times(save, sizes):
+    """
+    Return the time ``save(old, new)`` takes for bodies of worksheets
+    with the given numbers of compute cells, where ``new`` is ``old``
+    with the input of one cell in the middle changed.
+    """
+    timings = {}
+    for cells in sizes:
+        old = _worksheet_body(cells).decode('ascii')
+        new = old.replace(u'factor(%s)' % (cells // 2), u'factor(-1)', 1)
+        timings['%6d cells (s)' % cells] = save(old, new)
+    return timings
+
+
+def revision_delta(sizes=(1000, 4000, 16000), verbose=True):
+    """
+    Time saving a revision of a worksheet in a
+    :class:`~sagenb.storage.revision_store.RevisionStore` after the
+    input of one cell changed, which
+    :meth:`~sagenb.notebook.worksheet.Worksheet.save_snapshot` does
+    while holding the lock of the worksheet.  The time should be
+    proportional to the size.
+
+    INPUT:
+
+    - ``sizes`` -- list of integers; numbers of compute cells
+    """
+    import shutil
+    import tempfile
+    from sagenb.storage.revision_store import RevisionStore
+
+    def save(old, new):
+        directory = tempfile.mkdtemp()
+        try:
+            R = RevisionStore(directory)
+            R.add(old)
+            t = time.time()
+            R.add(new)
+            return time.time() - t
+        finally:
+            shutil.rmtree(directory)
+
+    return _report('RevisionStore.add', _revision_times(save, sizes), verbose)
+
+
+def revision_delta_difflib(sizes=(1000, 2000, 4000), verbose=True):
+    """
+    Like :func:`revision_delta`, but only computing the line based
+    delta with :mod:`difflib`, as the revision store used to.  The
+    lines ``}}}``, ``///`` and the blank lines repeat in every cell,
+    so the time grows quadratically with the size.  The default sizes
+    are smaller.
+    """
+    import difflib
+
+    def save(old, new):
+        t = time.time()
+        difflib.SequenceMatcher(None, old.splitlines(True), new.splitlines(True),
+                                autojunk=False).get_opcodes()
+        return time.time() - t
+
+    return _report('difflib.SequenceMatcher', _revision_times(save, sizes), verbose)
+
+
+def trivial_cells(cells=1000, python=None, verbose=True):
+    """
+    Time evaluating ``cells`` trivial cells one after the other in a
+    :class:`~sagenb.interfaces.expect.WorksheetProcess_ExpectImplementation`,
+    i.e., the overhead of sending a cell to the subprocess and getting
+    its output back.
+
+    INPUT:
+
+    - ``cells`` -- integer (default: 1000); number of cells
+
+    - ``python`` -- string (default: this Python); the command that
+      starts the subprocess
+    """
+    import sys
+    from sagenb.interfaces.expect import WorksheetProcess_ExpectImplementation
+    P = WorksheetProcess_ExpectImplementation(python=python or sys.executable)
+
+    def evaluate(code):
+        P.execute(code)
+        # Poll as fast as possible, so that we time the process and
+        # not the polling interval.
+        while not P.output_status().done:
+            pass
+
+    try:
+        evaluate('x = 0')
+        t = time.time()
+        for i in range(cells):
+            evaluate('x = %s' % i)
+        total = time.time() - t
+    finally:
+        P.quit()
+    return _report('Trivial cells, %s cells' % cells,
+                   {'per cell (s)': total / cells,
+                    'total (s)': total}, verbose)
+
+
+if __name__ == '__main__':
+    output_messages()
+    output_regex()
+    worksheet_parser()
+    worksheet_parser_slicing()
+    revision_delta()
+    revision_delta_difflib()
+    trivial_cells()